@@ -1,40 +1,350 @@
-from flask import Flask, jsonify, g
+from flask import (
+    Flask,
+    abort,
+    g,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context,
+    url_for,
+)
+import base64
+import itertools
+import json
+import os
+from socketserver import ThreadingMixIn
 import sqlite3
+import time
+from typing import Callable
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from werkzeug.wsgi import FileWrapper
 
 import config
+from src.body_file import BODY_SIZE_SQL, BodyFile
+from src.db import enable_wal, init_db
+from src.deadlines import StageTimeout
+from src.encoding import (
+    CONTENT_ENCODING_HEADER,
+    DecodingError,
+    get_header,
+    iter_decoded,
+    parse_content_encoding,
+)
+from src.har import HarError, import_har, iter_har, parse_timestamp
+from src.header_store import header_store
+from src.json_cache import JSONCache
 from src.response import Response
 from src.proxy import ProxyRequestHandler
+from src.read_pool import PoolTimeout, ReadPool
 from src.request import Request
+from src.retention import list_partitions, open_partition, partition_path
+from src import traffic_stats
+from src.websocket import TEXT
+
+
+read_pool = ReadPool()
+json_cache = JSONCache()
 
+# the detail views leave the body out and link to it; NULL takes its place
+# so that from_db reads the row as usual
+REQUEST_DETAIL_COLUMNS = (
+    'id, method, host, port, path, get_params, headers, cookies, NULL, '
+    'post_params, is_https, trace_id, header_refs, created_at'
+)
+RESPONSE_DETAIL_COLUMNS = (
+    'id, request_id, code, message, headers, set_cookie, NULL, header_refs, '
+    'from_cache, duration'
+)
+DETAIL_COLUMNS = {
+    'request': REQUEST_DETAIL_COLUMNS,
+    'response': RESPONSE_DETAIL_COLUMNS,
+}
+BODY_ENCODINGS = ('wire', 'decoded')
+BODY_CHUNK_SIZE = 256 * 1024
 
-def get_db():
+
+def get_db(snapshot: bool = True):
+    # ?partition=YYYY-MM-DD reads from a rotated day partition instead of
+    # the live database; the live database is read through the read-only
+    # pool, so the API never takes a lock the capture writer waits for
     if 'db' not in g:
-        g.db = sqlite3.connect(config.DB)
+        partition = request.args.get('partition')
+        if partition is None:
+            try:
+                g.db = read_pool.acquire(snapshot)
+            except PoolTimeout:
+                abort(make_response(
+                    jsonify({"error": "Database is busy"}),
+                    503,
+                ))
+            g.pooled = True
+        else:
+            g.db = open_partition(partition)
+            if g.db is None:
+                abort(make_response(
+                    jsonify({"error": "Partition not found"}),
+                    404,
+                ))
     return g.db
 
 
+def _take_db() -> tuple[sqlite3.Connection, Callable[[], None]]:
+    # hands the request's connection over to a streamed response, which
+    # outlives the view; the returned function gives it back
+    db_conn = get_db()
+    g.pop('db')
+    if g.pop('pooled', False):
+        return db_conn, lambda: read_pool.release(db_conn)
+    return db_conn, db_conn.close
+
+
+def _load_detail(conn: sqlite3.Connection, table: str, row_id: int):
+    # the record without its body, and the body's size; None when the row
+    # does not exist
+    row = conn.execute(
+        f'SELECT {DETAIL_COLUMNS[table]}, {BODY_SIZE_SQL} '
+        f'FROM {table} WHERE id = ?',
+        (row_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    record_class = Request if table == 'request' else Response
+    return record_class.from_db(row[:-1], header_store(conn)), row[-1] or 0
+
+
+def _with_body_link(data: dict, endpoint: str, size: int, **ids) -> dict:
+    data.pop('body', None)
+    data['body_size'] = size
+    data['body_url'] = url_for(
+        endpoint,
+        partition=request.args.get('partition'),
+        **ids,
+    )
+    return data
+
+
+def _cached_json(kind: str, record_id: int, load):
+    # records never change once captured, so their JSON is serialised once
+    # and revalidated with its ETag
+    key = (request.args.get('partition'), kind, record_id)
+    cached = json_cache.get(key)
+    if cached is None:
+        data = load()
+        if data is None:
+            return jsonify({"error": f"{kind.capitalize()} not found"}), 404
+        cached = json_cache.put(key, (app.json.dumps(data) + '\n').encode())
+    body, etag = cached
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
 app = Flask(config.APP_NAME)
 
 
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop('db', None)
+    if db is None:
+        return
+    if g.pop('pooled', False):
+        read_pool.release(db)
+    else:
+        db.close()
+
+
+@app.errorhandler(StageTimeout)
+def upstream_timeout(e):
+    # repeated and scanned requests that the upstream did not answer in time
+    return jsonify({"error": f"Upstream {e.stage} timed out"}), 504
+
+
+@app.route('/partitions', methods=['GET'])
+def get_partitions():
+    return jsonify([
+        {
+            'partition': day,
+            'size': os.path.getsize(partition_path(day)),
+        }
+        for day in list_partitions()
+    ])
+
+
 @app.route('/requests', methods=['GET'])
 def get_requests():
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM request')
     requests_rows = cursor.fetchall()
+    store = header_store(conn)
+    store.preload(row[12] for row in requests_rows)
     result = []
     for request_row in requests_rows:
-        result.append(Request.from_db(request_row).to_dict())
+        result.append(Request.from_db(request_row, store).to_dict())
     return jsonify(result)
 
 
 @app.route('/requests/<int:request_id>', methods=['GET'])
 def get_request(request_id):
+    def load():
+        detail = _load_detail(get_db(), 'request', request_id)
+        if detail is None:
+            return None
+        record, size = detail
+        return _with_body_link(
+            record.to_dict(),
+            'get_request_body',
+            size,
+            request_id=request_id,
+        )
+
+    return _cached_json('request', request_id, load)
+
+
+@app.route('/requests/<int:request_id>/body', methods=['GET'])
+def get_request_body(request_id):
+    return _serve_body('request', request_id)
+
+
+@app.route('/requests/<int:request_id>/websocket', methods=['GET'])
+def get_websocket_messages(request_id):
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM request WHERE id = ?', (request_id,))
-    request_row = cursor.fetchone()
-    return jsonify(Request.from_db(request_row).to_dict())
+    cursor.execute(
+        'SELECT direction, opcode, payload, size, truncated, created_at '
+        'FROM websocket_message WHERE request_id = ? ORDER BY id',
+        (request_id,),
+    )
+    result = []
+    for direction, opcode, payload, size, truncated, created_at in cursor:
+        message = {
+            'direction': direction,
+            'opcode': opcode,
+            'size': size,
+            'truncated': bool(truncated),
+            'created_at': created_at,
+        }
+        # text messages that were cut mid-character still decode
+        if opcode == TEXT:
+            message['text'] = payload.decode('utf-8', 'replace')
+        else:
+            message['data'] = base64.b64encode(payload).decode()
+        result.append(message)
+    return jsonify(result)
+
+
+@app.route('/findings', methods=['GET'])
+def get_findings():
+    # ?request_id=, ?analyzer= and ?severity= narrow the list, newest first
+    conditions = []
+    params = []
+    for column in ('request_id', 'analyzer', 'severity'):
+        value = request.args.get(column)
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    limit = request.args.get('limit', 1000, type=int)
+    cursor = get_db().execute(
+        'SELECT id, request_id, analyzer, rule, severity, evidence, created_at '
+        f'FROM finding {where} ORDER BY id DESC LIMIT ?',
+        (*params, limit),
+    )
+    return jsonify([
+        {
+            'id': finding_id,
+            'request_id': request_id,
+            'analyzer': analyzer,
+            'rule': rule,
+            'severity': severity,
+            'evidence': evidence,
+            'created_at': created_at,
+        }
+        for finding_id, request_id, analyzer, rule, severity, evidence, created_at
+        in cursor
+    ])
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    # traffic per host, busiest first, or per minute with ?by=minute;
+    # read from the aggregates, so the cost does not grow with the capture
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        since = parse_timestamp(since) if since \
+            else time.time() - config.API_STATS_WINDOW_SECONDS
+        until = parse_timestamp(until) if until else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    return jsonify(traffic_stats.query(
+        get_db(),
+        since,
+        until,
+        host=request.args.get('host'),
+        by_minute=request.args.get('by') == 'minute',
+    ))
+
+
+@app.route('/stats/rebuild', methods=['POST'])
+def rebuild_stats():
+    if 'partition' in request.args:
+        return jsonify({"error": "Partitions are read-only"}), 400
+    since = request.args.get('since')
+    try:
+        since = parse_timestamp(since) if since else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    db_conn = sqlite3.connect(config.DB, timeout=30)
+    try:
+        rebuilt = traffic_stats.rebuild(db_conn, since)
+    finally:
+        db_conn.close()
+    return jsonify({'exchanges': rebuilt})
+
+
+@app.route('/har', methods=['GET'])
+def export_har():
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        ids = request.args.get('ids')
+        filters = {
+            'host': request.args.get('host'),
+            'since': parse_timestamp(since) if since else None,
+            'until': parse_timestamp(until) if until else None,
+            'ids': [int(i) for i in ids.split(',')] if ids else None,
+        }
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+
+    # the connection is opened inside the stream: the view's own context
+    # is torn down before the first chunk is sent
+    def generate():
+        # the export pages by id, a snapshot would pin the WAL for as long
+        # as the download takes
+        yield from iter_har(get_db(snapshot=False), **filters)
+
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/json',
+        headers={'Content-Disposition': 'attachment; filename=capture.har'},
+    )
+
+
+@app.route('/har', methods=['POST'])
+def import_har_file():
+    if 'partition' in request.args:
+        return jsonify({"error": "Partitions are read-only"}), 400
+    db_conn = sqlite3.connect(config.DB, timeout=30)
+    try:
+        imported, skipped = import_har(db_conn, request.stream)
+    except HarError as e:
+        return jsonify({"error": f"Invalid HAR: {e}"}), 400
+    finally:
+        db_conn.close()
+    return jsonify({'imported': imported, 'skipped': skipped})
 
 
 @app.route('/responses', methods=['GET'])
@@ -43,25 +353,133 @@ def get_responses():
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM response')
     responses = cursor.fetchall()
+    store = header_store(conn)
+    store.preload(row[7] for row in responses)
     result = []
     for response in responses:
-        result.append(Response.from_db(response).to_dict())
+        result.append(Response.from_db(response, store).to_dict())
 
     return jsonify(result)
 
 
 @app.route('/responses/<int:response_id>', methods=['GET'])
 def get_response(response_id):
+    def load():
+        detail = _load_detail(get_db(), 'response', response_id)
+        if detail is None:
+            return None
+        record, size = detail
+        return _with_body_link(
+            record.to_dict(),
+            'get_response_body',
+            size,
+            response_id=response_id,
+        )
+
+    return _cached_json('response', response_id, load)
+
+
+@app.route('/responses/<int:response_id>/body', methods=['GET'])
+def get_response_body(response_id):
+    return _serve_body('response', response_id)
+
+
+def _serve_body(table: str, row_id: int):
+    # streams a stored body without loading it. ?encoding=wire (default)
+    # sends the bytes as captured, with their Content-Encoding, and serves
+    # Range requests by seeking in the blob; ?encoding=decoded undoes the
+    # content coding on the fly and always sends the whole body, since its
+    # decoded length is not known up front
+    encoding = request.args.get('encoding', 'wire')
+    if encoding not in BODY_ENCODINGS:
+        return jsonify({
+            "error": f"Invalid encoding, expected one of {', '.join(BODY_ENCODINGS)}",
+        }), 400
+    detail = _load_detail(get_db(), table, row_id)
+    if detail is None:
+        return jsonify({"error": f"{table.capitalize()} not found"}), 404
+    record, size = detail
+    headers = record.headers
+    content_type = get_header(headers, 'Content-Type', 'application/octet-stream')
+    content_encoding = get_header(headers, CONTENT_ENCODING_HEADER)
+
+    db_conn, release = _take_db()
+    try:
+        body = BodyFile(db_conn, table, row_id, size, on_close=release)
+    except BaseException:
+        release()
+        raise
+    try:
+        if encoding == 'decoded' and parse_content_encoding(content_encoding):
+            decoded = iter_decoded(
+                FileWrapper(body, BODY_CHUNK_SIZE),
+                content_encoding,
+            )
+            try:
+                first = next(decoded, b'')
+            except DecodingError:
+                # bodies of old rows were stored decoded already
+                body.seek(0)
+            else:
+                response = app.response_class(
+                    itertools.chain([first], decoded),
+                    content_type=content_type,
+                )
+                response.call_on_close(body.close)
+                return response
+            content_encoding = None
+
+        response = app.response_class(
+            FileWrapper(body, BODY_CHUNK_SIZE),
+            content_type=content_type,
+            direct_passthrough=True,
+        )
+        response.call_on_close(body.close)
+        if content_encoding and encoding == 'wire':
+            response.headers[CONTENT_ENCODING_HEADER] = content_encoding
+        response.content_length = size
+        response.set_etag(
+            f'{request.args.get("partition", "live")}-{table}-{row_id}-{encoding}',
+        )
+        return response.make_conditional(
+            request,
+            accept_ranges=True,
+            complete_length=size,
+        )
+    except BaseException:
+        body.close()
+        raise
+
+
+@app.route('/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM response WHERE id = ?', (response_id,))
-    response_data = cursor.fetchone()
-    return jsonify(Response.from_db(response_data).to_dict())
+    cursor.execute(
+        'SELECT client, started_at, duration, spans FROM trace '
+        'WHERE trace_id = ?',
+        (trace_id,),
+    )
+    trace_row = cursor.fetchone()
+    if trace_row is None:
+        return jsonify({"error": "Trace not found"}), 404
+
+    client, started_at, duration, spans = trace_row
+    cursor.execute('SELECT id FROM request WHERE trace_id = ?', (trace_id,))
+    return jsonify({
+        'trace_id': trace_id,
+        'client': client,
+        'started_at': started_at,
+        'duration': duration,
+        'spans': json.loads(spans),
+        'request_ids': [row[0] for row in cursor.fetchall()],
+    })
 
 
 @app.route('/repeat/<int:request_id>', methods=['GET'])
 def repeat_request(request_id):
-    conn = get_db()
+    # upstream round trips follow, a snapshot would pin the WAL meanwhile
+    conn = get_db(snapshot=False)
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM request WHERE id = ?', (request_id,))
     request_data = cursor.fetchone()
@@ -69,7 +487,7 @@ def repeat_request(request_id):
         return jsonify({"error": "Request not found"}), 404
 
     is_https = request_data[10]
-    request = Request.from_db(request_data)
+    request = Request.from_db(request_data, header_store(conn))
     response = ProxyRequestHandler.send_request_get_response(request, is_https)
     try:
         return jsonify(response.to_dict())
@@ -79,7 +497,7 @@ def repeat_request(request_id):
 
 @app.route('/scan/<int:request_id>', methods=['GET'])
 def scan_request(request_id):
-    conn = get_db()
+    conn = get_db(snapshot=False)
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM request WHERE id = ?', (request_id,))
     request_data = cursor.fetchone()
@@ -87,7 +505,7 @@ def scan_request(request_id):
         return jsonify({"error": "Request not found"}), 404
 
     is_https = request_data[10]
-    original_request = Request.from_db(request_data)
+    original_request = Request.from_db(request_data, header_store(conn))
     original_response = ProxyRequestHandler.send_request_get_response(
         original_request,
         is_https,
@@ -110,8 +528,41 @@ def scan_request(request_id):
     return jsonify({'vulnerabilities': vulnerabilities})
 
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
 def run_api_server(port: int = config.API_PORT):
-    app.run(host='0.0.0.0', port=port, debug=True)
+    # the proxy may not have created the database yet; WAL has to be on
+    # before read-only connections can read next to the writer
+    db_conn = sqlite3.connect(config.DB)
+    init_db(db_conn)
+    enable_wal(db_conn)
+    db_conn.close()
+
+    if config.API_DEBUG:
+        app.run(host='0.0.0.0', port=port, debug=True)
+        return
+    server = make_server(
+        '0.0.0.0',
+        port,
+        app,
+        server_class=ThreadingWSGIServer,
+        handler_class=QuietWSGIRequestHandler,
+    )
+    print(f'api server is running on port {port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        read_pool.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,6 @@
+import sys
+
+from bench.microbench import main
+
+
+sys.exit(main())
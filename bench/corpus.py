@@ -0,0 +1,148 @@
+import gzip
+import json
+import random
+from urllib.parse import urlencode
+
+from src.consts import NEW_LINE
+
+
+# fixed seed so every run (and every baseline) sees byte-identical inputs
+SEED = 1337
+
+COMMON_HEADERS = [
+    ('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64; rv:123.0) '
+                   'Gecko/20100101 Firefox/123.0'),
+    ('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+               'image/avif,image/webp,*/*;q=0.8'),
+    ('Accept-Language', 'en-US,en;q=0.5'),
+    ('Accept-Encoding', 'gzip, deflate, br'),
+    ('Connection', 'keep-alive'),
+]
+
+
+def _raw_request(
+    method: str,
+    path: str,
+    headers: list[tuple[str, str]],
+    body: bytes = b'',
+) -> bytes:
+    if body:
+        headers = headers + [('Content-Length', str(len(body)))]
+    head = NEW_LINE.join([
+        f'{method} {path} HTTP/1.1',
+        *[f'{name}: {value}' for name, value in headers],
+        '',
+        '',
+    ])
+    return head.encode() + body
+
+
+def _raw_response(
+    code: int,
+    message: str,
+    headers: list[tuple[str, str]],
+    body: bytes,
+) -> bytes:
+    headers = headers + [('Content-Length', str(len(body)))]
+    head = NEW_LINE.join([
+        f'HTTP/1.1 {code} {message}',
+        *[f'{name}: {value}' for name, value in headers],
+        '',
+        '',
+    ])
+    return head.encode() + body
+
+
+def _random_token(rnd: random.Random, length: int) -> str:
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    return ''.join(rnd.choice(alphabet) for _ in range(length))
+
+
+def small_request() -> bytes:
+    return _raw_request(
+        'GET',
+        '/index.html?q=1',
+        [('Host', 'example.com'), *COMMON_HEADERS],
+    )
+
+
+def large_request() -> bytes:
+    rnd = random.Random(SEED)
+    headers = [('Host', 'api.example.com'), *COMMON_HEADERS]
+    headers += [
+        (f'X-Custom-{i}', _random_token(rnd, 64)) for i in range(40)
+    ]
+    headers.append(('Content-Type', 'application/json'))
+    body = json.dumps({
+        'items': [
+            {'id': i, 'name': _random_token(rnd, 32)} for i in range(4000)
+        ],
+    }).encode()
+    return _raw_request('POST', '/v1/items?batch=1', headers, body)
+
+
+def cookie_heavy_request() -> bytes:
+    rnd = random.Random(SEED)
+    cookie = '; '.join(
+        f'c{i}={_random_token(rnd, 24)}' for i in range(80)
+    )
+    return _raw_request(
+        'GET',
+        '/account',
+        [('Host', 'shop.example.com'), *COMMON_HEADERS, ('Cookie', cookie)],
+    )
+
+
+def many_params_request() -> bytes:
+    rnd = random.Random(SEED)
+    query = urlencode({
+        f'p{i}': _random_token(rnd, 12) for i in range(200)
+    })
+    return _raw_request(
+        'GET',
+        f'/search?{query}',
+        [('Host', 'search.example.com'), *COMMON_HEADERS],
+    )
+
+
+def small_response() -> bytes:
+    return _raw_response(
+        200,
+        'OK',
+        [
+            ('Server', 'nginx/1.25.4'),
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Set-Cookie', 'session=abc123; Path=/; HttpOnly'),
+        ],
+        b'<html><body>hello</body></html>',
+    )
+
+
+def large_response() -> bytes:
+    rnd = random.Random(SEED)
+    body = ''.join(
+        f'<p>{_random_token(rnd, 80)}</p>' for i in range(6000)
+    ).encode()
+    return _raw_response(
+        200,
+        'OK',
+        [
+            ('Server', 'nginx/1.25.4'),
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Content-Encoding', 'gzip'),
+        ],
+        gzip.compress(body, compresslevel=6),
+    )
+
+
+REQUESTS = {
+    'small': small_request,
+    'large': large_request,
+    'cookies': cookie_heavy_request,
+    'params': many_params_request,
+}
+
+RESPONSES = {
+    'small': small_response,
+    'large': large_response,
+}
@@ -0,0 +1,318 @@
+import argparse
+from dataclasses import dataclass
+import fnmatch
+import gc
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+from bench.corpus import REQUESTS, RESPONSES
+from src.db import init_db
+from src.header_store import header_store
+from src.request import Request
+from src.response import Response
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# a benchmark is flagged when its median time (or peak allocation) grows by
+# more than this fraction over the stored baseline
+DEFAULT_THRESHOLD = 0.25
+
+WARMUP_SECONDS = 0.05
+SAMPLE_SECONDS = 0.02
+SAMPLES = 15
+
+
+@dataclass
+class Benchmark:
+    name: str
+    func: Callable[[], object]
+
+
+@dataclass
+class Result:
+    name: str
+    loops: int
+    min_ns: float
+    median_ns: float
+    stdev_ns: float
+    peak_bytes: int
+    allocations: int
+
+    def to_baseline(self) -> dict:
+        return {
+            'median_ns': round(self.median_ns, 1),
+            'peak_bytes': self.peak_bytes,
+        }
+
+
+def _memory_db() -> sqlite3.Connection:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    return db_conn
+
+
+def collect_benchmarks() -> list[Benchmark]:
+    benchmarks = []
+    db_conn = _memory_db()
+    store = header_store(db_conn)
+
+    for name, make_raw in REQUESTS.items():
+        raw = make_raw()
+        request = Request.from_raw_request(raw)
+        request_id = request.save_to_db(db_conn)
+        row = db_conn.execute(
+            'SELECT * FROM request WHERE id = ?', (request_id,),
+        ).fetchone()
+
+        benchmarks += [
+            Benchmark(
+                f'request.parse_raw.{name}',
+                lambda raw=raw: Request.from_raw_request(raw),
+            ),
+            Benchmark(
+                f'request.from_db.{name}',
+                lambda row=row: Request.from_db(row, store),
+            ),
+            Benchmark(
+                f'request.to_dict.{name}',
+                lambda request=request: request.to_dict(),
+            ),
+            Benchmark(
+                f'request.save_to_db.{name}',
+                lambda request=request: request.save_to_db(db_conn, store=store),
+            ),
+            Benchmark(
+                f'request.to_db_row.{name}',
+                lambda request=request: request.to_db_row(store),
+            ),
+            Benchmark(
+                f'request.injection_points.{name}',
+                lambda request=request: request._get_injection_points(),
+            ),
+            Benchmark(
+                f'request.iter_injections.{name}',
+                lambda request=request: list(iter(request)),
+            ),
+        ]
+
+    for name, make_raw in RESPONSES.items():
+        raw = make_raw()
+        response = Response.from_raw_response(raw)
+        response.save_to_db(0, db_conn)
+        row = db_conn.execute(
+            'SELECT * FROM response ORDER BY id DESC LIMIT 1',
+        ).fetchone()
+
+        benchmarks += [
+            Benchmark(
+                f'response.parse_raw.{name}',
+                lambda raw=raw: Response.from_raw_response(raw),
+            ),
+            Benchmark(
+                f'response.from_db.{name}',
+                lambda row=row: Response.from_db(row, store),
+            ),
+            Benchmark(
+                f'response.to_dict.{name}',
+                lambda response=response: response.to_dict(),
+            ),
+            Benchmark(
+                f'response.save_to_db.{name}',
+                lambda response=response: response.save_to_db(0, db_conn, store),
+            ),
+        ]
+
+    return benchmarks
+
+
+def _time_loops(func: Callable[[], object], loops: int) -> int:
+    timer = time.perf_counter_ns
+    start = timer()
+    for _ in range(loops):
+        func()
+    return timer() - start
+
+
+def _calibrate(func: Callable[[], object]) -> int:
+    loops = 1
+    while True:
+        elapsed = _time_loops(func, loops)
+        if elapsed >= SAMPLE_SECONDS * 1e9 or loops >= 1 << 20:
+            return loops
+        loops *= 2
+
+
+def _measure_memory(func: Callable[[], object]) -> tuple[int, int]:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    allocations = sum(
+        stat.count_diff
+        for stat in after.compare_to(before, 'filename')
+        if stat.count_diff > 0
+    )
+    return peak - base, allocations
+
+
+def run_benchmark(benchmark: Benchmark, samples: int = SAMPLES) -> Result:
+    func = benchmark.func
+
+    deadline = time.perf_counter() + WARMUP_SECONDS
+    while time.perf_counter() < deadline:
+        func()
+
+    loops = _calibrate(func)
+    timings = []
+    gc_was_enabled = gc.isenabled()
+    try:
+        for _ in range(samples):
+            gc.collect()
+            gc.disable()
+            timings.append(_time_loops(func, loops) / loops)
+            gc.enable()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+        else:
+            gc.disable()
+
+    peak_bytes, allocations = _measure_memory(func)
+    return Result(
+        name=benchmark.name,
+        loops=loops,
+        min_ns=min(timings),
+        median_ns=statistics.median(timings),
+        stdev_ns=statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        peak_bytes=peak_bytes,
+        allocations=allocations,
+    )
+
+
+def load_baseline(path: str = BASELINE_FILE) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline(results: list[Result], path: str = BASELINE_FILE):
+    baseline = load_baseline(path)
+    baseline.update({result.name: result.to_baseline() for result in results})
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def find_regressions(
+    results: list[Result],
+    baseline: dict,
+    threshold: float = DEFAULT_THRESHOLD,
+) -> list[str]:
+    regressions = []
+    for result in results:
+        expected = baseline.get(result.name)
+        if expected is None:
+            continue
+
+        limit = expected['median_ns'] * (1 + threshold)
+        if result.median_ns > limit:
+            regressions.append(
+                f'{result.name}: median {_format_ns(result.median_ns)} '
+                f'> {_format_ns(limit)} '
+                f'(baseline {_format_ns(expected["median_ns"])})'
+            )
+
+        limit = expected['peak_bytes'] * (1 + threshold)
+        if result.peak_bytes > limit:
+            regressions.append(
+                f'{result.name}: peak {result.peak_bytes} B '
+                f'> {int(limit)} B (baseline {expected["peak_bytes"]} B)'
+            )
+    return regressions
+
+
+def _format_ns(ns: float) -> str:
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if ns >= scale:
+            return f'{ns / scale:.2f} {unit}'
+    return f'{ns:.0f} ns'
+
+
+def _print_result(result: Result, baseline: dict):
+    line = (
+        f'{result.name:<36} {_format_ns(result.median_ns):>10} '
+        f'(min {_format_ns(result.min_ns)}, '
+        f'+-{_format_ns(result.stdev_ns)}, {result.loops} loops) '
+        f'peak {result.peak_bytes / 1024:.1f} KiB, '
+        f'{result.allocations} blocks'
+    )
+    expected = baseline.get(result.name)
+    if expected:
+        change = result.median_ns / expected['median_ns'] - 1
+        line += f' [{change:+.1%}]'
+    print(line)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='microbenchmarks for parsing, serialisation and '
+                    'injection generation',
+    )
+    parser.add_argument(
+        '-k', '--filter', default='*',
+        help='glob selecting benchmarks by name',
+    )
+    parser.add_argument('--samples', type=int, default=SAMPLES)
+    parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='allowed relative slowdown before failing',
+    )
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='store the results as the new baseline',
+    )
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    results = []
+    for benchmark in collect_benchmarks():
+        if not fnmatch.fnmatch(benchmark.name, args.filter):
+            continue
+        result = run_benchmark(benchmark, args.samples)
+        _print_result(result, baseline)
+        results.append(result)
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s) over {args.threshold:.0%}:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
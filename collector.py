@@ -0,0 +1,5 @@
+from src.collector import run_collector
+
+
+if __name__ == '__main__':
+    run_collector()
@@ -1,11 +1,155 @@
 import os
+import socket
 
 
 DB_DIR = 'db'
 DB_NAME = 'proxy.db'
 DB = os.path.join(DB_DIR, DB_NAME)
+# captures older than RETENTION_HOT_HOURS, or beyond the row and size
+# limits of the live database, are moved into one file per day here
+ARCHIVE_DIR = os.path.join(DB_DIR, 'archive')
+RETENTION_HOT_HOURS = 24
+RETENTION_MAX_ROWS = 0
+RETENTION_MAX_BYTES = 0
+RETENTION_ARCHIVE_DAYS = 30
+RETENTION_ARCHIVE_MAX_BYTES = 0
+RETENTION_INTERVAL_SECONDS = 5 * 60
+
+# generated host certificates are kept here across restarts and deleted
+# once they expire
+CERT_STORE = os.path.join(DB_DIR, 'certs.db')
+CERT_CACHE_SIZE = 1024
+CERT_RENEW_BEFORE_DAYS = 7
+CERT_GC_INTERVAL_SECONDS = 60 * 60
+# intercepted tunnels speak HTTP/2 when the h2 package is installed and
+# both the client and the upstream host negotiate it through ALPN
+HTTP2_ENABLED = os.environ.get('HTTP2', '1') == '1'
+# CA bundle that upstream certificates are verified against, the system
+# store by default
+UPSTREAM_CA_FILE = os.environ.get('UPSTREAM_CA_FILE')
 
 API_PORT = 8000
 APP_NAME = 'proxy'
+# API_DEBUG=1 runs Flask's debug server instead of the threaded WSGI server
+API_DEBUG = os.environ.get('API_DEBUG', '0') == '1'
+# the API reads through a pool of read-only connections
+API_DB_POOL_SIZE = 8
+API_DB_POOL_TIMEOUT = 10
+API_DB_MMAP_SIZE = 256 * 1024 * 1024
+API_DB_CACHE_SIZE = 16 * 1024 * 1024
+# serialised JSON of /requests/<id> and /responses/<id>
+API_JSON_CACHE_BYTES = 32 * 1024 * 1024
+# GET /stats covers this many seconds unless it is given ?since=
+API_STATS_WINDOW_SECONDS = 3600
 
 PROXY_PORT = 8080
+# more than one worker runs the proxy in pre-fork mode: worker processes
+# share PROXY_PORT through SO_REUSEPORT and a single process writes captures
+PROXY_WORKERS = int(os.environ.get('PROXY_WORKERS', 1))
+SHUTDOWN_GRACE_SECONDS = 10
+# every proxy process serves client connections from a pool of at most
+# PROXY_MAX_WORKERS threads. Accepted connections wait for a free thread in
+# a queue of PROXY_QUEUE_DEPTH, and connections beyond that, or beyond
+# PROXY_MAX_CONNECTIONS_PER_IP from one client (0 disables the limit), are
+# shed by PROXY_SHED_POLICY: '503' answers 503 Service Unavailable,
+# 'refuse' resets the connection
+PROXY_MAX_WORKERS = int(os.environ.get('PROXY_MAX_WORKERS', 256))
+PROXY_QUEUE_DEPTH = int(os.environ.get('PROXY_QUEUE_DEPTH', 256))
+PROXY_ACCEPT_BACKLOG = int(os.environ.get('PROXY_ACCEPT_BACKLOG', 128))
+PROXY_MAX_CONNECTIONS_PER_IP = int(os.environ.get('PROXY_MAX_CONNECTIONS_PER_IP', 0))
+PROXY_SHED_POLICY = os.environ.get('PROXY_SHED_POLICY', '503')
+PROXY_SHED_RETRY_AFTER_SECONDS = 1
+# upstream requests give up after these many seconds per stage and in
+# total; a timeout answers 504 Gateway Timeout
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = 10
+TLS_HANDSHAKE_TIMEOUT_SECONDS = 10
+FIRST_BYTE_TIMEOUT_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 120
+# tunnels and keep-alive client connections without traffic for this long
+# are closed
+TUNNEL_IDLE_TIMEOUT_SECONDS = 300
+CLIENT_IDLE_TIMEOUT_SECONDS = 60
+CAPTURE_QUEUE_SIZE = 10000
+
+# 'sqlite' writes captures into DB, 'remote' ships them to a collector
+# (collector.py) that writes the captures of every node into COLLECTOR_DB.
+# Batches the collector does not take are kept in CAPTURE_SPOOL_DIR, up to
+# CAPTURE_SPOOL_MAX_BYTES, and sent again once it is back
+CAPTURE_SINK = os.environ.get('CAPTURE_SINK', 'sqlite')
+COLLECTOR_HOST = os.environ.get('COLLECTOR_HOST', '127.0.0.1')
+COLLECTOR_PORT = int(os.environ.get('COLLECTOR_PORT', 9400))
+COLLECTOR_DB = os.environ.get('COLLECTOR_DB', DB)
+COLLECTOR_METRICS_PORT = 9190
+NODE_NAME = os.environ.get('NODE_NAME', socket.gethostname())
+CAPTURE_SPOOL_DIR = os.path.join(DB_DIR, 'spool')
+CAPTURE_SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+CAPTURE_FLUSH_INTERVAL_SECONDS = 1
+
+# JSON rules deciding which exchanges are stored, see README; the file is
+# re-read when it changes
+CAPTURE_RULES_FILE = os.environ.get('CAPTURE_RULES_FILE', 'capture_rules.json')
+
+# the system resolver does not report record TTLs, so upstream hostnames
+# are cached for a fixed time; failed lookups are cached briefly too
+DNS_CACHE_TTL = 60
+DNS_NEGATIVE_TTL = 5
+DNS_CACHE_SIZE = 1024
+
+# shared RFC 9111 cache for plain HTTP GETs, off unless HTTP_CACHE=1
+HTTP_CACHE_ENABLED = os.environ.get('HTTP_CACHE', '0') == '1'
+HTTP_CACHE_DIR = 'http_cache'
+HTTP_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+HTTP_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+
+# WebSocket messages are stored up to this many (decompressed) bytes
+WEBSOCKET_MAX_MESSAGE_SIZE = 1024 * 1024
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9090
+
+MAX_DECODED_BODY_SIZE = 64 * 1024 * 1024
+
+# passive analysis of captured exchanges (leaked secrets, SQL error
+# signatures, missing security headers), off unless ANALYSIS=1. Findings
+# go into the finding table; exchanges arriving while ANALYSIS_QUEUE_SIZE
+# are waiting are not analysed, and a batch still running after
+# ANALYSIS_BATCH_TIMEOUT_SECONDS is abandoned
+ANALYSIS_ENABLED = os.environ.get('ANALYSIS', '0') == '1'
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 2))
+ANALYSIS_QUEUE_SIZE = 10000
+ANALYSIS_BATCH_TIMEOUT_SECONDS = 30
+ANALYSIS_MAX_BODY_BYTES = 1024 * 1024
+
+# columnar export of captures for offline analytics, see README; needs
+# pyarrow. EXPORT_FORMAT is parquet or arrow (IPC files), EXPORT_BODIES
+# is none, inline (binary columns) or ref (content-addressed files next
+# to the export)
+EXPORT_DIR = os.environ.get('EXPORT_DIR', os.path.join(DB_DIR, 'export'))
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', 'parquet')
+EXPORT_BODIES = os.environ.get('EXPORT_BODIES', 'none')
+EXPORT_BATCH_SIZE = 1000
+# rows are written in row groups (record batches for arrow) of up to this
+# many rows or bytes, and a file holds up to EXPORT_FILE_ROWS
+EXPORT_ROW_GROUP_ROWS = 100000
+EXPORT_ROW_GROUP_BYTES = 64 * 1024 * 1024
+EXPORT_FILE_ROWS = 1000000
+# day partitions written at once; rows of other days close the least
+# recently written file
+EXPORT_MAX_OPEN_FILES = 4
+# headers that also get a column of their own, by lowercase name
+EXPORT_REQUEST_HEADERS = (
+    'user-agent',
+    'content-type',
+    'content-length',
+    'referer',
+    'origin',
+    'accept-encoding',
+)
+EXPORT_RESPONSE_HEADERS = (
+    'content-type',
+    'content-length',
+    'content-encoding',
+    'cache-control',
+    'server',
+    'location',
+)
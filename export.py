@@ -0,0 +1,5 @@
+from src.columnar import run_export
+
+
+if __name__ == '__main__':
+    run_export()
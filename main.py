@@ -1,9 +1,14 @@
 from src.proxy import ProxyServer
+import config
 
 
 if __name__ == '__main__':
     try:
-        proxy_server = ProxyServer()
+        if config.PROXY_WORKERS > 1:
+            from src.prefork import PreforkProxyServer
+            proxy_server = PreforkProxyServer()
+        else:
+            proxy_server = ProxyServer()
         proxy_server.run()
     except Exception as e:
         print(f'Unexpected error: {e}')
@@ -0,0 +1,489 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import multiprocessing
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import Iterable
+
+from src.encoding import CHUNK_SIZE, DecodingError, get_header, iter_decoded
+from src.metrics import Counter, Histogram
+from src.request import Request
+from src.response import Response
+import config
+
+
+ANALYSIS_BATCH_SIZE = 256
+# findings of one pattern in one exchange beyond this are not reported
+MAX_MATCHES_PER_PATTERN = 20
+MAX_EVIDENCE_SIZE = 200
+# (analyzer, rule, host) keys remembered for once-per-host analyzers; the
+# least recently seen are forgotten and may be reported again
+MAX_REPORTED_KEYS = 10000
+
+HIGH = 'high'
+MEDIUM = 'medium'
+LOW = 'low'
+
+
+ANALYSIS_QUEUE_DROPPED = Counter(
+    'proxy_analysis_dropped_total',
+    'Exchanges not analysed because the analysis queue was full.',
+)
+ANALYSIS_FINDINGS = Counter(
+    'proxy_analysis_findings_total',
+    'Findings stored by the analysis pipeline, by analyzer.',
+    labelnames=('analyzer',),
+)
+ANALYSIS_SKIPPED = Counter(
+    'proxy_analysis_skipped_total',
+    'Exchanges an analyzer skipped because its time budget for the batch '
+    'was used up, or because the whole batch timed out.',
+    labelnames=('analyzer',),
+)
+ANALYSIS_BATCH_SECONDS = Histogram(
+    'proxy_analysis_batch_seconds',
+    'Time to analyse one batch of exchanges in the worker pool.',
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+
+
+@dataclass
+class Exchange:
+    # what the analyzers see of a captured exchange; the body is the
+    # decoded prefix that analyzers scan, so a large wire body is never
+    # copied to the workers
+    request_id: int
+    method: str
+    host: str
+    path: str
+    is_https: bool
+    request_headers: list[tuple[str, str]]
+    code: int | None = None
+    response_headers: list[tuple[str, str]] = field(default_factory=list)
+    body: bytes | None = None
+
+    def __post_init__(self):
+        self._headers = None
+
+    @property
+    def headers(self) -> dict[str, str]:
+        # response headers by lower-cased name
+        if self._headers is None:
+            self._headers = {
+                name.lower(): value for name, value in self.response_headers
+            }
+        return self._headers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_headers'] = None
+        return state
+
+
+@dataclass
+class Finding:
+    request_id: int
+    analyzer: str
+    rule: str
+    severity: str
+    evidence: str
+
+
+class Analyzer:
+    # analyzers are created once per worker process. patterns maps a rule
+    # name to a regular expression over the decoded response body; the
+    # patterns of all analyzers are merged into one matcher, so a body is
+    # scanned once no matter how many analyzers look at it. analyze() gets
+    # the matches of its own patterns.
+    name = ''
+    severity = LOW
+    patterns: dict[str, str] = {}
+    # seconds one batch may spend in this analyzer, the remaining
+    # exchanges of the batch are skipped once it is used up
+    budget = 0.5
+    # repeated findings of a rule for the same host are stored only once
+    once_per_host = False
+
+    def analyze(
+        self,
+        exchange: Exchange,
+        matches: list[tuple[str, bytes]],
+    ) -> Iterable[Finding]:
+        for rule, match in matches:
+            yield self.finding(exchange, rule, match)
+
+    def finding(self, exchange: Exchange, rule: str, evidence) -> Finding:
+        if isinstance(evidence, bytes):
+            evidence = evidence.decode('utf-8', 'replace')
+        return Finding(
+            exchange.request_id,
+            self.name,
+            rule,
+            self.severity,
+            evidence[:MAX_EVIDENCE_SIZE],
+        )
+
+
+def _redact(secret: bytes) -> str:
+    text = secret.decode('ascii', 'replace')
+    if len(text) <= 12:
+        return text[:2] + '...'
+    return f'{text[:6]}...{text[-4:]}'
+
+
+class SecretAnalyzer(Analyzer):
+    name = 'secrets'
+    severity = HIGH
+    patterns = {
+        'aws_access_key': r'\b(?:AKIA|ASIA)[0-9A-Z]{16}\b',
+        'private_key': r'-----BEGIN (?:RSA |EC |DSA |OPENSSH |ENCRYPTED )?PRIVATE KEY-----',
+        'jwt': r'\beyJ[A-Za-z0-9_-]{8,}\.eyJ[A-Za-z0-9_-]{8,}\.[A-Za-z0-9_-]{8,}',
+        'github_token': r'\bgh[pousr]_[A-Za-z0-9]{36}\b',
+        'slack_token': r'\bxox[abprs]-[A-Za-z0-9-]{10,}',
+        'google_api_key': r'\bAIza[0-9A-Za-z_-]{35}\b',
+        'stripe_key': r'\b[rs]k_live_[0-9A-Za-z]{24,}\b',
+    }
+
+    def analyze(self, exchange, matches):
+        seen = set()
+        for rule, match in matches:
+            if match in seen:
+                continue
+            seen.add(match)
+            # only enough of a secret is stored to recognise it
+            evidence = match.decode('ascii', 'replace') if rule == 'private_key' \
+                else _redact(match)
+            yield self.finding(exchange, rule, evidence)
+
+
+class SQLErrorAnalyzer(Analyzer):
+    # database errors in a response hint that input reaches a query
+    # unescaped
+    name = 'sql_errors'
+    severity = MEDIUM
+    patterns = {
+        'mysql': r"(?i:you have an error in your sql syntax|warning: mysql_|MySqlException)",
+        'postgresql': r'(?i:PG::SyntaxError|PSQLException|syntax error at or near|unterminated quoted string at or near)',
+        'mssql': r'(?i:unclosed quotation mark after the character string|Microsoft OLE DB Provider for SQL Server)',
+        'oracle': r'\bORA-\d{5}\b|(?i:quoted string not properly terminated)',
+        'sqlite': r'SQLite3::SQLException|sqlite3\.OperationalError|SQLITE_ERROR',
+        'sqlstate': r'SQLSTATE\[\w+\]',
+    }
+
+    def analyze(self, exchange, matches):
+        # one finding per database
+        reported = set()
+        for rule, match in matches:
+            if rule not in reported:
+                reported.add(rule)
+                yield self.finding(exchange, rule, match)
+
+
+class SecurityHeadersAnalyzer(Analyzer):
+    name = 'security_headers'
+    once_per_host = True
+
+    def analyze(self, exchange, matches):
+        headers = exchange.headers
+        if exchange.code is None or not 200 <= exchange.code < 300:
+            return
+        if 'text/html' not in headers.get('content-type', ''):
+            return
+        csp = headers.get('content-security-policy')
+        if csp is None:
+            yield self.finding(exchange, 'missing_csp', 'Content-Security-Policy')
+        if 'x-content-type-options' not in headers:
+            yield self.finding(exchange, 'missing_content_type_options', 'X-Content-Type-Options')
+        if 'x-frame-options' not in headers and 'frame-ancestors' not in (csp or ''):
+            yield self.finding(exchange, 'missing_frame_options', 'X-Frame-Options')
+        if exchange.is_https and 'strict-transport-security' not in headers:
+            yield self.finding(exchange, 'missing_hsts', 'Strict-Transport-Security')
+
+
+DEFAULT_ANALYZERS = (SecretAnalyzer, SQLErrorAnalyzer, SecurityHeadersAnalyzer)
+
+
+class CombinedMatcher:
+    # one alternation of every analyzer pattern, each in a named group that
+    # tells which analyzer and rule it belongs to. Where patterns overlap
+    # at the same position, the one listed first wins.
+    def __init__(self, analyzers: list[Analyzer]) -> None:
+        self._owners: dict[str, tuple[int, str]] = {}
+        parts = []
+        for index, analyzer in enumerate(analyzers):
+            for rule, pattern in analyzer.patterns.items():
+                group = f'p{len(self._owners)}'
+                self._owners[group] = (index, rule)
+                parts.append(f'(?P<{group}>{pattern})')
+        self._regex = re.compile('|'.join(parts).encode()) if parts else None
+
+    def scan(self, body: bytes | None) -> dict[int, list[tuple[str, bytes]]]:
+        matches: dict[int, list[tuple[str, bytes]]] = {}
+        if not body or self._regex is None:
+            return matches
+        counts: dict[str, int] = {}
+        for match in self._regex.finditer(body):
+            group = match.lastgroup
+            if counts.get(group, 0) >= MAX_MATCHES_PER_PATTERN:
+                continue
+            counts[group] = counts.get(group, 0) + 1
+            index, rule = self._owners[group]
+            matches.setdefault(index, []).append((rule, match.group()))
+        return matches
+
+
+def decoded_prefix(
+    body: bytes | None,
+    content_encoding: str | None,
+    limit: int = config.ANALYSIS_MAX_BODY_BYTES,
+) -> bytes | None:
+    # the first limit bytes of the decoded body, without decoding the rest;
+    # decoders yield bounded chunks, so at most one chunk more is decoded
+    if not body:
+        return body
+    decoded = bytearray()
+    try:
+        for chunk in iter_decoded((body,), content_encoding, limit + CHUNK_SIZE):
+            decoded.extend(chunk)
+            if len(decoded) >= limit:
+                break
+    except DecodingError:
+        return body[:limit]
+    return bytes(decoded[:limit])
+
+
+_worker_analyzers: list[Analyzer] = []
+_worker_matcher: CombinedMatcher | None = None
+
+
+def _init_worker(analyzer_classes: tuple[type[Analyzer], ...]):
+    global _worker_analyzers, _worker_matcher
+    _worker_analyzers = [cls() for cls in analyzer_classes]
+    _worker_matcher = CombinedMatcher(_worker_analyzers)
+
+
+def analyze_batch(
+    exchanges: list[Exchange],
+    analyzers: list[Analyzer] | None = None,
+    matcher: CombinedMatcher | None = None,
+) -> tuple[list[Finding], dict[str, int]]:
+    # runs in a worker process; returns the findings and, per analyzer,
+    # how many exchanges it skipped
+    if analyzers is None:
+        analyzers, matcher = _worker_analyzers, _worker_matcher
+    spent = [0.0] * len(analyzers)
+    skipped: dict[str, int] = {}
+    findings = []
+    for exchange in exchanges:
+        matches = matcher.scan(exchange.body)
+        for index, analyzer in enumerate(analyzers):
+            if spent[index] >= analyzer.budget:
+                skipped[analyzer.name] = skipped.get(analyzer.name, 0) + 1
+                continue
+            start = time.perf_counter()
+            try:
+                findings.extend(analyzer.analyze(exchange, matches.get(index, [])))
+            except Exception as e:
+                print(f'analyzer {analyzer.name} failed on request {exchange.request_id}: {e}')
+            spent[index] += time.perf_counter() - start
+    return findings, skipped
+
+
+def _pool_context():
+    # the capture writer runs threads, which forking would copy mid-flight
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn',
+    )
+
+
+class AnalysisPipeline:
+    # captured exchanges are published to a bounded queue without waiting;
+    # a thread takes them in batches, has them analysed in a process pool
+    # and stores the findings. A batch that takes longer than
+    # batch_timeout is dropped together with the pool, so one
+    # pathological body cannot stall the analysis.
+    def __init__(
+        self,
+        db_path: str = config.DB,
+        analyzers: tuple[type[Analyzer], ...] = DEFAULT_ANALYZERS,
+        workers: int = config.ANALYSIS_WORKERS,
+        batch_size: int = ANALYSIS_BATCH_SIZE,
+        queue_size: int = config.ANALYSIS_QUEUE_SIZE,
+        batch_timeout: float = config.ANALYSIS_BATCH_TIMEOUT_SECONDS,
+        flush_interval: float = config.CAPTURE_FLUSH_INTERVAL_SECONDS,
+    ) -> None:
+        self.db_path = db_path
+        self.analyzers = analyzers
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self._pool = None
+        self._thread: threading.Thread | None = None
+        self._reported: OrderedDict[tuple[str, str, str], None] = OrderedDict()
+        self._once_per_host = {
+            analyzer.name for analyzer in analyzers if analyzer.once_per_host
+        }
+
+    def publish(
+        self,
+        request_id: int,
+        request: Request,
+        response: Response | None,
+        is_https: bool = False,
+    ):
+        exchange = Exchange(
+            request_id,
+            request.method,
+            request.host,
+            request.path,
+            bool(is_https),
+            request.header_fields,
+        )
+        if response is not None:
+            exchange.code = response.code
+            exchange.response_headers = response.header_fields
+            exchange.body = decoded_prefix(
+                response.body,
+                get_header(exchange.headers, 'content-encoding'),
+            )
+        try:
+            self.queue.put_nowait(exchange)
+        except queue.Full:
+            ANALYSIS_QUEUE_DROPPED.inc()
+
+    def _new_pool(self):
+        return _pool_context().Pool(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.analyzers,),
+        )
+
+    def start(self) -> threading.Thread:
+        self._pool = self._new_pool()
+        self._thread = threading.Thread(
+            target=self.run,
+            name='analysis',
+            daemon=True,
+        )
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float | None = None):
+        self.queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _next_batch(self) -> tuple[list[Exchange], bool]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                exchange = self.queue.get(
+                    timeout=max(deadline - time.monotonic(), 0),
+                )
+            except queue.Empty:
+                break
+            if exchange is None:
+                return batch, False
+            batch.append(exchange)
+        return batch, True
+
+    def run(self):
+        db_conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            running = True
+            while running:
+                batch, running = self._next_batch()
+                if batch:
+                    hosts = {exchange.request_id: exchange.host for exchange in batch}
+                    self.save(db_conn, self.analyze(batch), hosts)
+        finally:
+            db_conn.close()
+            self._pool.terminate()
+
+    def analyze(self, batch: list[Exchange]) -> list[Finding]:
+        chunk_size = -(-len(batch) // self.workers)
+        chunks = [
+            batch[start:start + chunk_size]
+            for start in range(0, len(batch), chunk_size)
+        ]
+        start = time.perf_counter()
+        try:
+            results = self._pool.map_async(analyze_batch, chunks).get(
+                self.batch_timeout,
+            )
+        except multiprocessing.TimeoutError:
+            print(f'analysis of {len(batch)} exchanges timed out, restarting the pool')
+            self._pool.terminate()
+            self._pool = self._new_pool()
+            for analyzer in self.analyzers:
+                ANALYSIS_SKIPPED.labels(analyzer.name).inc(len(batch))
+            return []
+        ANALYSIS_BATCH_SECONDS.observe(time.perf_counter() - start)
+
+        findings = []
+        for chunk_findings, skipped in results:
+            findings.extend(chunk_findings)
+            for name, count in skipped.items():
+                ANALYSIS_SKIPPED.labels(name).inc(count)
+        return findings
+
+    def _is_repeat(self, finding: Finding, hosts: dict[int, str]) -> bool:
+        if finding.analyzer not in self._once_per_host:
+            return False
+        key = (finding.analyzer, finding.rule, hosts[finding.request_id])
+        if key in self._reported:
+            self._reported.move_to_end(key)
+            return True
+        self._reported[key] = None
+        if len(self._reported) > MAX_REPORTED_KEYS:
+            self._reported.popitem(last=False)
+        return False
+
+    def save(
+        self,
+        db_conn: sqlite3.Connection,
+        findings: list[Finding],
+        hosts: dict[int, str],
+    ):
+        if not findings:
+            return
+        rows = []
+        now = time.time()
+        for finding in findings:
+            if self._is_repeat(finding, hosts):
+                continue
+            rows.append((
+                finding.request_id,
+                finding.analyzer,
+                finding.rule,
+                finding.severity,
+                finding.evidence,
+                now,
+            ))
+            ANALYSIS_FINDINGS.labels(finding.analyzer).inc()
+        try:
+            db_conn.executemany('''
+                INSERT INTO finding (request_id, analyzer, rule, severity, evidence, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            db_conn.commit()
+        except sqlite3.Error as e:
+            db_conn.rollback()
+            print(f'cannot save {len(rows)} findings: {e}')
+
+
+def start_analysis(capture, db_path: str) -> AnalysisPipeline | None:
+    # hooks the pipeline into a SQLiteCapture when analysis is switched on
+    if not config.ANALYSIS_ENABLED:
+        return None
+    pipeline = AnalysisPipeline(db_path)
+    pipeline.start()
+    capture.analysis = pipeline
+    return pipeline
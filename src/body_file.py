@@ -0,0 +1,114 @@
+import io
+import sqlite3
+from typing import Callable
+
+
+# tables whose body column can be read as a file
+BODY_TABLES = ('request', 'response')
+
+# size in bytes without reading the value: length() of a BLOB only looks
+# at the record header; TEXT bodies of old rows count their UTF-8 bytes
+BODY_SIZE_SQL = (
+    "CASE typeof(body) WHEN 'text' THEN length(CAST(body AS BLOB)) "
+    "ELSE length(body) END"
+)
+
+# SQLite loads the whole value for every substr() call, so without
+# incremental blob I/O the body is read in fewer, larger slices
+FALLBACK_READ_SIZE = 8 * 1024 * 1024
+
+
+class BodyFile(io.RawIOBase):
+    # the stored body of one request or response row as a read-only,
+    # seekable file. Reads go through incremental blob I/O where sqlite3
+    # has it (Python 3.11+) and only touch the pages asked for; older
+    # versions read with substr(). on_close runs once, after the blob is
+    # closed, and typically gives the connection back.
+    def __init__(
+        self,
+        db_conn: sqlite3.Connection,
+        table: str,
+        row_id: int,
+        size: int,
+        on_close: Callable[[], None] | None = None,
+    ) -> None:
+        if table not in BODY_TABLES:
+            raise ValueError(f'no body column in {table!r}')
+        super().__init__()
+        self.db_conn = db_conn
+        self.table = table
+        self.row_id = row_id
+        self.size = size
+        self.on_close = on_close
+        self.position = 0
+        self.blob = None
+        # an empty or missing body has no blob to open
+        if size and hasattr(db_conn, 'blobopen'):
+            self.blob = db_conn.blobopen(table, 'body', row_id, readonly=True)
+        self._slice = b''
+        self._slice_start = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return b''
+        if self.blob is not None:
+            self.blob.seek(self.position)
+            data = self.blob.read(size)
+        else:
+            data = self._read_slice(size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _read_slice(self, size: int) -> bytes:
+        offset = self.position - self._slice_start
+        if not 0 <= offset < len(self._slice):
+            self._slice_start = self.position
+            # substr() counts from 1, and in characters for TEXT values
+            self._slice = self.db_conn.execute(
+                f'SELECT substr(CAST(body AS BLOB), ?, ?) FROM {self.table} '
+                'WHERE id = ?',
+                (self.position + 1, max(size, FALLBACK_READ_SIZE), self.row_id),
+            ).fetchone()[0] or b''
+            offset = 0
+        return self._slice[offset:offset + size]
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.blob is not None:
+                self.blob.close()
+                self.blob = None
+            self._slice = b''
+        finally:
+            super().close()
+            if self.on_close is not None:
+                self.on_close()
+
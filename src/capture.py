@@ -0,0 +1,267 @@
+import queue
+import sqlite3
+from threading import Lock
+import time
+
+from src.analysis import start_analysis
+from src.db import enable_wal, init_db
+from src.header_store import header_store
+from src.metrics import Counter, Histogram
+from src.request import Request
+from src.response import Response
+from src import tracing
+from src.traffic_stats import TrafficStats
+from src.websocket import Message
+import config
+
+
+CAPTURE_BATCH_SIZE = 256
+QUEUE_PUT_TIMEOUT = 1
+
+EXCHANGE = 'exchange'
+TRACE = 'trace'
+MESSAGES = 'messages'
+
+
+DB_LOCK_WAIT_SECONDS = Histogram(
+    'proxy_db_lock_wait_seconds',
+    'Time spent waiting for the global database lock.',
+)
+DB_SAVE_SECONDS = Histogram(
+    'proxy_db_save_seconds',
+    'Time spent in save_to_db while holding the database lock.',
+    labelnames=('table',),
+)
+CAPTURE_DROPPED = Counter(
+    'proxy_capture_dropped_total',
+    'Captures dropped because the capture queue was full.',
+)
+CAPTURE_ERRORS = Counter(
+    'proxy_capture_errors_total',
+    'Captures that could not be written to the database.',
+)
+
+
+class SQLiteCapture:
+    def __init__(self, db_conn: sqlite3.Connection) -> None:
+        self.db_conn = db_conn
+        self.store = header_store(db_conn)
+        self.lock = Lock()
+        # request ids of upgraded connections that are still open; in
+        # pre-fork mode the workers cannot know the ids the writer assigns
+        self.streams: dict[str, int] = {}
+        # AnalysisPipeline that written exchanges are published to, once
+        # the transaction that stored them has committed
+        self.analysis = None
+        self._unpublished: list[tuple] = []
+        self.stats = TrafficStats()
+
+    def _write_exchange(
+        self,
+        request: Request,
+        response: Response | None,
+        is_https: bool,
+        stream_id: str | None = None,
+        created_at: float | None = None,
+    ) -> int:
+        if created_at is None:
+            created_at = time.time()
+        request_id = request.save_to_db(
+            self.db_conn,
+            is_https,
+            store=self.store,
+            commit=False,
+            created_at=created_at,
+        )
+        if response is not None:
+            response.save_to_db(
+                request_id,
+                self.db_conn,
+                self.store,
+                commit=False,
+            )
+        if stream_id is not None:
+            self.streams[stream_id] = request_id
+        self.stats.add_exchange(request, response, created_at)
+        if self.analysis is not None:
+            self._unpublished.append((request_id, request, response, is_https))
+        return request_id
+
+    def _write_messages(
+        self,
+        stream_id: str,
+        messages: list[Message],
+        final: bool,
+    ):
+        request_id = self.streams.pop(stream_id, None) if final \
+            else self.streams.get(stream_id)
+        self.db_conn.executemany('''
+            INSERT INTO websocket_message (request_id, direction, opcode, payload, size, truncated, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (
+                request_id,
+                message.direction,
+                message.opcode,
+                message.payload,
+                message.size,
+                message.truncated,
+                message.created_at,
+            )
+            for message in messages
+        ])
+
+    def _locked(self, table: str, write, *args):
+        with tracing.span('capture'):
+            start = time.perf_counter()
+            with self.lock:
+                DB_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+                with DB_SAVE_SECONDS.labels(table).time():
+                    try:
+                        result = write(*args)
+                        # the aggregates commit with the rows they count
+                        self.stats.flush(self.db_conn)
+                        self.db_conn.commit()
+                    except Exception:
+                        self.stats.discard()
+                        self._unpublished.clear()
+                        self.db_conn.rollback()
+                        self.store.rollback()
+                        raise
+                    self.store.commit()
+                committed, self._unpublished = self._unpublished, []
+            # publishing decodes bodies, which need not hold up other writers
+            for exchange in committed:
+                self.analysis.publish(*exchange)
+            return result
+
+    def save_exchange(
+        self,
+        request: Request,
+        response: Response | None = None,
+        is_https: bool = False,
+        stream_id: str | None = None,
+    ) -> int:
+        return self._locked(
+            'exchange',
+            self._write_exchange,
+            request,
+            response,
+            is_https,
+            stream_id,
+        )
+
+    def save_messages(
+        self,
+        stream_id: str,
+        messages: list[Message],
+        final: bool = False,
+    ):
+        self._locked(
+            'websocket_message',
+            self._write_messages,
+            stream_id,
+            messages,
+            final,
+        )
+
+    def save_trace(self, trace: tracing.Trace):
+        self._locked('trace', trace.save_to_db, self.db_conn, False)
+
+    def _write_record(self, record: tuple):
+        kind, *payload = record
+        if kind == EXCHANGE:
+            self._write_exchange(*payload)
+        elif kind == TRACE:
+            payload[0].save_to_db(self.db_conn, False)
+        elif kind == MESSAGES:
+            self._write_messages(*payload)
+
+    def _write_batch(self, records: list[tuple]) -> int:
+        written = 0
+        for record in records:
+            self.db_conn.execute('SAVEPOINT record')
+            unpublished = len(self._unpublished)
+            fields = self.store.mark()
+            try:
+                self._write_record(record)
+            except (sqlite3.Error, ValueError, AttributeError) as e:
+                self.db_conn.execute('ROLLBACK TO record')
+                del self._unpublished[unpublished:]
+                self.store.rollback(fields)
+                CAPTURE_ERRORS.inc()
+                print(f'cannot save {record[0]} to db: {e}')
+            else:
+                written += 1
+            self.db_conn.execute('RELEASE record')
+        return written
+
+    def write_batch(self, records: list[tuple]) -> int:
+        return self._locked('batch', self._write_batch, records)
+
+
+class QueueCapture:
+    def __init__(self, capture_queue) -> None:
+        self.queue = capture_queue
+
+    def _put(self, record: tuple):
+        with tracing.span('capture'):
+            try:
+                self.queue.put(record, timeout=QUEUE_PUT_TIMEOUT)
+            except queue.Full:
+                CAPTURE_DROPPED.inc()
+
+    def save_exchange(
+        self,
+        request: Request,
+        response: Response | None = None,
+        is_https: bool = False,
+        stream_id: str | None = None,
+    ):
+        # the record may be written much later, so it carries its capture
+        # time
+        self._put((EXCHANGE, request, response, is_https, stream_id, time.time()))
+
+    def save_messages(
+        self,
+        stream_id: str,
+        messages: list[Message],
+        final: bool = False,
+    ):
+        self._put((MESSAGES, stream_id, messages, final))
+
+    def save_trace(self, trace: tracing.Trace):
+        self._put((TRACE, trace))
+
+
+def run_capture_writer(
+    capture_queue,
+    db_path: str,
+    batch_size: int = CAPTURE_BATCH_SIZE,
+):
+    db_conn = sqlite3.connect(db_path)
+    init_db(db_conn)
+    enable_wal(db_conn)
+    capture = SQLiteCapture(db_conn)
+    analysis = start_analysis(capture, db_path)
+
+    running = True
+    while running:
+        record = capture_queue.get()
+        if record is None:
+            break
+        batch = [record]
+        while len(batch) < batch_size:
+            try:
+                record = capture_queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is None:
+                running = False
+                break
+            batch.append(record)
+        capture.write_batch(batch)
+
+    if analysis is not None:
+        analysis.stop(config.SHUTDOWN_GRACE_SECONDS)
+    db_conn.close()
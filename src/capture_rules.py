@@ -0,0 +1,290 @@
+import fnmatch
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from src.encoding import get_header
+from src.metrics import Counter
+from src.request import Request
+from src.response import Response
+import config
+
+
+CAPTURE = 'capture'
+HEADERS = 'headers'
+SKIP = 'skip'
+ACTIONS = (CAPTURE, HEADERS, SKIP)
+
+RELOAD_CHECK_SECONDS = 1.0
+HOST_CACHE_SIZE = 4096
+
+
+CAPTURE_DECISIONS = Counter(
+    'proxy_capture_decisions_total',
+    'Exchanges by capture rule outcome.',
+    labelnames=('action',),
+)
+CAPTURE_RULES_RELOADS = Counter(
+    'proxy_capture_rules_reloads_total',
+    'Capture rule file reloads.',
+    labelnames=('result',),
+)
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _compile_patterns(patterns, ignore_case: bool) -> re.Pattern | None:
+    if patterns is None:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not patterns or not all(isinstance(p, str) for p in patterns):
+        raise RuleError(f'expected a pattern or a list of patterns: {patterns!r}')
+    # every glob of a condition is folded into one alternation, so a
+    # condition costs one regex match however many patterns it lists
+    regex = '|'.join(f'(?:{fnmatch.translate(p)})' for p in patterns)
+    return re.compile(regex, re.IGNORECASE if ignore_case else 0)
+
+
+class Decision:
+    __slots__ = ('action', 'max_body')
+
+    def __init__(self, action: str = CAPTURE, max_body: int | None = None):
+        self.action = action
+        self.max_body = max_body
+
+
+SKIPPED = Decision(SKIP)
+
+
+class Rule:
+    __slots__ = (
+        'host',
+        'path',
+        'method',
+        'content_type',
+        'action',
+        'max_body',
+        'sample',
+        'decision',
+    )
+
+    def __init__(
+        self,
+        host=None,
+        path=None,
+        method=None,
+        content_type=None,
+        action: str = CAPTURE,
+        max_body: int | None = None,
+        sample: float | None = None,
+    ) -> None:
+        if action not in ACTIONS:
+            raise RuleError(f'unknown action {action!r}')
+        if max_body is not None and (
+            not isinstance(max_body, int) or max_body < 0
+        ):
+            raise RuleError(f'max_body must be a positive integer: {max_body!r}')
+        if sample is not None and not 0 <= sample <= 1:
+            raise RuleError(f'sample must be between 0 and 1: {sample!r}')
+
+        self.host = _compile_patterns(host, ignore_case=True)
+        self.path = _compile_patterns(path, ignore_case=False)
+        self.method = _compile_patterns(method, ignore_case=True)
+        self.content_type = _compile_patterns(content_type, ignore_case=True)
+        self.action = action
+        self.max_body = max_body
+        self.sample = sample
+        self.decision = Decision(action, max_body)
+
+    @classmethod
+    def from_dict(cls, rule: dict) -> 'Rule':
+        if not isinstance(rule, dict):
+            raise RuleError(f'a rule must be an object: {rule!r}')
+        try:
+            return cls(**rule)
+        except TypeError as e:
+            raise RuleError(f'invalid rule {rule!r}: {e}') from None
+
+    @property
+    def host_only(self) -> bool:
+        return (
+            self.path is None
+            and self.method is None
+            and self.content_type is None
+            and self.sample is None
+        )
+
+    def matches(self, request: Request, content_type: str | None) -> bool:
+        if self.path is not None and not self.path.match(request.path or ''):
+            return False
+        if self.method is not None and not self.method.match(request.method or ''):
+            return False
+        if self.content_type is not None and (
+            content_type is None or not self.content_type.match(content_type)
+        ):
+            return False
+        return True
+
+
+def _media_type(response: Response | None) -> str | None:
+    if response is None:
+        return None
+    content_type = get_header(response.headers, 'Content-Type')
+    if content_type is None:
+        return None
+    return content_type.split(';', 1)[0].strip()
+
+
+class RuleSet:
+    def __init__(self, rules: list[Rule], default: Decision | None = None):
+        self.rules = rules
+        self.default = default if default is not None else Decision()
+        # rules are ordered and first match wins; the host condition is the
+        # most selective one, so the rules that apply to a host are looked
+        # up once per host and cached
+        self._host_rules: dict[str, tuple[Rule, ...]] = {}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'RuleSet':
+        if not isinstance(data, dict):
+            raise RuleError('capture rules must be an object')
+        rules = [Rule.from_dict(rule) for rule in data.get('rules', [])]
+        default = Rule.from_dict(data.get('default', {}))
+        if not default.host_only or default.host is not None:
+            raise RuleError('the default rule cannot have conditions')
+        return cls(rules, default.decision)
+
+    def rules_for_host(self, host: str) -> tuple[Rule, ...]:
+        host = host or ''
+        rules = self._host_rules.get(host)
+        if rules is None:
+            rules = tuple(
+                rule for rule in self.rules
+                if rule.host is None or rule.host.match(host)
+            )
+            if len(self._host_rules) >= HOST_CACHE_SIZE:
+                self._host_rules.clear()
+            self._host_rules[host] = rules
+        return rules
+
+    def skips_host(self, host: str) -> bool:
+        # true when every exchange with the host is skipped whatever its
+        # path or response, so a tunnel need not buffer it at all
+        for rule in self.rules_for_host(host):
+            if not rule.host_only:
+                return False
+            return rule.action == SKIP
+        return self.default.action == SKIP
+
+    def decide(
+        self,
+        request: Request,
+        response: Response | None = None,
+    ) -> Decision:
+        content_type = None
+        content_type_read = False
+        for rule in self.rules_for_host(request.host):
+            if rule.content_type is not None and not content_type_read:
+                content_type = _media_type(response)
+                content_type_read = True
+            if rule.matches(request, content_type):
+                # a sampled rule keeps that fraction of the exchanges it
+                # matches and skips the rest
+                if rule.sample is not None and random.random() >= rule.sample:
+                    return SKIPPED
+                return rule.decision
+        return self.default
+
+
+def _truncate(body: bytes | None, max_body: int) -> bytes | None:
+    if body is None or len(body) <= max_body:
+        return body
+    return body[:max_body]
+
+
+def apply_decision(
+    decision: Decision,
+    request: Request,
+    response: Response | None,
+) -> bool:
+    CAPTURE_DECISIONS.labels(decision.action).inc()
+    if decision.action == SKIP:
+        return False
+
+    if decision.action == HEADERS:
+        max_body = 0
+    else:
+        max_body = decision.max_body
+        if max_body is not None:
+            # form parameters are derived from the body, keep them whole
+            request.post_params
+
+    if max_body is not None:
+        request.body = _truncate(request.body, max_body) if max_body else None
+        if response is not None:
+            response.body = _truncate(response.body, max_body) \
+                if max_body else b''
+            response._decoded_body = None
+    return True
+
+
+class CaptureRules:
+    def __init__(self, path: str | None = config.CAPTURE_RULES_FILE) -> None:
+        self.path = path
+        self.rule_set = RuleSet([])
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> bool:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns if self.path else None
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._mtime:
+                return False
+
+            if mtime is None:
+                self.rule_set = RuleSet([])
+            else:
+                try:
+                    with open(self.path, 'r') as f:
+                        rule_set = RuleSet.from_dict(json.load(f))
+                except (OSError, ValueError) as e:
+                    # keep the rules that were working until the file is fixed
+                    CAPTURE_RULES_RELOADS.labels('error').inc()
+                    print(f'cannot load capture rules from {self.path}: {e}')
+                    self._mtime = mtime
+                    return False
+                self.rule_set = rule_set
+            self._mtime = mtime
+            CAPTURE_RULES_RELOADS.labels('ok').inc()
+            return True
+
+    def current(self) -> RuleSet:
+        if time.monotonic() - self._checked_at >= RELOAD_CHECK_SECONDS:
+            self.reload()
+        return self.rule_set
+
+    def skips_host(self, host: str) -> bool:
+        return self.current().skips_host(host)
+
+    def should_capture(
+        self,
+        request: Request,
+        response: Response | None = None,
+    ) -> bool:
+        decision = self.current().decide(request, response)
+        return apply_decision(decision, request, response)
+
+
+capture_rules = CaptureRules()
@@ -0,0 +1,246 @@
+from collections import OrderedDict
+import hashlib
+import os
+import secrets
+import sqlite3
+import ssl
+import tempfile
+import threading
+import time
+from typing import Callable
+
+from src.cert_utils import (
+    CA_CERT,
+    CERT_KEY,
+    CERT_VALID_DAYS,
+    CERTS_DIR,
+    generate_host_certificate,
+)
+from src.db import init_cert_db
+from src.metrics import Counter, Histogram
+import config
+
+
+DAY = 24 * 60 * 60
+# serials are random and must fit a positive SQLite integer
+MAX_SERIAL = 2 ** 63 - 1
+
+
+CERT_GENERATION_SECONDS = Histogram(
+    'proxy_cert_generation_seconds',
+    'Time spent generating a host certificate.',
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+CERT_LOOKUPS = Counter(
+    'proxy_cert_lookups_total',
+    'Host certificate lookups by where the certificate was found.',
+    labelnames=('source',),
+)
+CERTS_COLLECTED = Counter(
+    'proxy_certs_collected_total',
+    'Stored host certificates deleted because they expired or their CA changed.',
+)
+
+
+class _Lookup:
+    __slots__ = ('done', 'context', 'error')
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.context = None
+        self.error = None
+
+
+def _fingerprint(*paths: str) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _load_context(cert_path: str, key_path: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+    return context
+
+
+def _context_from_pem(cert: bytes, key_path: str) -> ssl.SSLContext:
+    # load_cert_chain only reads files, so the stored certificate is
+    # written out for as long as it takes to load it
+    fd, cert_path = tempfile.mkstemp(suffix='.crt', dir=CERTS_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cert)
+        return _load_context(cert_path, key_path)
+    finally:
+        os.remove(cert_path)
+
+
+class CertStore:
+    # host certificates are looked up in an LRU of ready server contexts,
+    # then in the certificate table, and only generated when neither has
+    # a valid one. The table is opened on first use, so pre-fork workers
+    # each get their own connection.
+    def __init__(
+        self,
+        path: str = config.CERT_STORE,
+        ca_cert: str = CA_CERT,
+        cert_key: str = CERT_KEY,
+        cache_size: int = config.CERT_CACHE_SIZE,
+        renew_before: float = config.CERT_RENEW_BEFORE_DAYS * DAY,
+        gc_interval: float = config.CERT_GC_INTERVAL_SECONDS,
+        generate: Callable = generate_host_certificate,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.path = path
+        self.ca_cert = ca_cert
+        self.cert_key = cert_key
+        self.cache_size = cache_size
+        self.renew_before = renew_before
+        self.gc_interval = gc_interval
+        self.generate = generate
+        self.clock = clock
+        self._db_conn: sqlite3.Connection | None = None
+        self._fingerprint: str | None = None
+        self._collected_at = 0.0
+        # keyed by host and the ALPN protocols the context offers
+        self._contexts: OrderedDict[tuple, tuple[ssl.SSLContext, float]] = OrderedDict()
+        self._inflight: dict[tuple, _Lookup] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def _connection(self) -> sqlite3.Connection:
+        # callers hold _db_lock
+        if self._db_conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db_conn = sqlite3.connect(
+                self.path,
+                timeout=30,
+                check_same_thread=False,
+            )
+            init_cert_db(db_conn)
+            self._fingerprint = _fingerprint(self.ca_cert, self.cert_key)
+            self._db_conn = db_conn
+        return self._db_conn
+
+    def close(self):
+        with self._db_lock:
+            if self._db_conn is not None:
+                self._db_conn.close()
+                self._db_conn = None
+
+    def _collect(self, now: float) -> int:
+        # callers hold _db_lock
+        db_conn = self._connection()
+        deleted = db_conn.execute(
+            'DELETE FROM certificate WHERE not_after <= ? OR fingerprint != ?',
+            (now, self._fingerprint),
+        ).rowcount
+        db_conn.commit()
+        self._collected_at = now
+        if deleted:
+            CERTS_COLLECTED.inc(deleted)
+        return deleted
+
+    def collect(self) -> int:
+        with self._db_lock:
+            return self._collect(self.clock())
+
+    def _stored(self, host: str, now: float) -> tuple[bytes, str, float] | None:
+        with self._db_lock:
+            db_conn = self._connection()
+            if now - self._collected_at >= self.gc_interval:
+                self._collect(now)
+            return db_conn.execute(
+                'SELECT cert, key_path, not_after FROM certificate '
+                'WHERE host = ? AND fingerprint = ? AND not_after > ?',
+                (host, self._fingerprint, now + self.renew_before),
+            ).fetchone()
+
+    def _store(self, host: str, serial: int, cert: bytes, key_path: str, not_after: float):
+        with self._db_lock:
+            db_conn = self._connection()
+            db_conn.execute(
+                'INSERT OR REPLACE INTO certificate '
+                '(host, serial, cert, key_path, fingerprint, not_after, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (host, serial, cert, key_path, self._fingerprint, not_after, self.clock()),
+            )
+            db_conn.commit()
+
+    def _generate(self, host: str, now: float) -> tuple[ssl.SSLContext, float]:
+        serial = secrets.randbelow(MAX_SERIAL) + 1
+        with CERT_GENERATION_SECONDS.time():
+            cert_path, key_path = self.generate(host, serial)
+        try:
+            with open(cert_path, 'rb') as f:
+                cert = f.read()
+            context = _load_context(cert_path, key_path)
+        finally:
+            os.remove(cert_path)
+        not_after = now + CERT_VALID_DAYS * DAY
+        self._store(host, serial, cert, key_path, not_after)
+        return context, not_after
+
+    def _load_or_generate(self, host: str) -> tuple[ssl.SSLContext, float]:
+        now = self.clock()
+        row = self._stored(host, now)
+        if row is not None:
+            cert, key_path, not_after = row
+            try:
+                context = _context_from_pem(cert, key_path)
+            except (OSError, ssl.SSLError) as e:
+                print(f'stored certificate for {host} cannot be loaded: {e}')
+            else:
+                CERT_LOOKUPS.labels('store').inc()
+                return context, not_after
+        CERT_LOOKUPS.labels('generated').inc()
+        return self._generate(host, now)
+
+    def context_for(self, host: str, alpn: tuple[str, ...] = ()) -> ssl.SSLContext:
+        host = host.lower()
+        key = (host, alpn)
+        with self._lock:
+            cached = self._contexts.get(key)
+            if cached is not None and cached[1] - self.renew_before > self.clock():
+                self._contexts.move_to_end(key)
+                CERT_LOOKUPS.labels('memory').inc()
+                return cached[0]
+
+            # concurrent handshakes for a new host share one generation
+            lookup = self._inflight.get(key)
+            leader = lookup is None
+            if leader:
+                lookup = self._inflight[key] = _Lookup()
+
+        if not leader:
+            lookup.done.wait()
+            if lookup.error is not None:
+                raise lookup.error
+            return lookup.context
+
+        try:
+            context, not_after = self._load_or_generate(host)
+            if alpn:
+                context.set_alpn_protocols(list(alpn))
+        except BaseException as e:
+            lookup.error = e
+            raise
+        finally:
+            with self._lock:
+                if lookup.error is None:
+                    self._contexts[key] = (context, not_after)
+                    self._contexts.move_to_end(key)
+                    while len(self._contexts) > self.cache_size:
+                        self._contexts.popitem(last=False)
+                del self._inflight[key]
+            lookup.context = None if lookup.error else context
+            lookup.done.set()
+        return context
+
+
+cert_store = CertStore()
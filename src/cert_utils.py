@@ -8,6 +8,7 @@ CA_CERT = 'ca.crt'
 CERT_KEY = 'cert.key'
 CA_KEY = 'ca.key'
 SERIAL_NUMBERS_DIR = 'serial_numbers'
+CERT_VALID_DAYS = 3650
 
 
 # lock = Lock()
@@ -20,11 +21,12 @@ if not all(map(os.path.exists, [CA_CERT, CA_KEY, CERTS_DIR])):
     )
 
 
-def generate_host_certificate(host: str):
-    try:
-        serial = get_next_serial_number(host)
-    except ValueError:
-        print(f'{host=}')
+def generate_host_certificate(host: str, serial: int | None = None):
+    if serial is None:
+        try:
+            serial = get_next_serial_number(host)
+        except ValueError:
+            print(f'{host=}')
 
     host_cert_name = f"{host}_{serial}.crt"
     host_csr_name = f"{host}_{serial}.csr"
@@ -43,7 +45,8 @@ def generate_host_certificate(host: str):
 
     subprocess.run(
         [
-            "openssl", "x509", "-req", "-days", "3650", "-in", csr_path,
+            "openssl", "x509", "-req", "-days", str(CERT_VALID_DAYS),
+            "-in", csr_path,
             "-CA", CA_CERT, "-CAkey", CA_KEY, "-set_serial", str(serial),
             "-out", cert_path
         ],
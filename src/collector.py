@@ -0,0 +1,141 @@
+from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+import socket
+import sqlite3
+import time
+
+from src.analysis import start_analysis
+from src.capture import SQLiteCapture
+from src.consts import NEW_LINE
+from src.db import enable_wal, init_collector_db, init_db
+from src.metrics import Counter, start_metrics_server
+from src.remote_capture import (
+    ACCEPTED,
+    ACK,
+    ACK_TIMEOUT,
+    FRAME_HEADER,
+    MAX_FRAME_SIZE,
+    REJECTED,
+    BatchError,
+    decode_batch,
+)
+import config
+
+
+COLLECTOR_BATCHES = Counter(
+    'proxy_collector_batches_total',
+    'Capture batches received from proxy nodes, by outcome.',
+    labelnames=('result',),
+)
+COLLECTOR_RECORDS = Counter(
+    'proxy_collector_records_total',
+    'Capture records written by the collector.',
+)
+
+
+class CollectorStore(SQLiteCapture):
+    # writes each received batch in one transaction together with its
+    # number, so a batch sent again is recognised
+    def _ingest(self, session: str, node: str, seq: int, records: list[tuple]) -> int | None:
+        row = self.db_conn.execute(
+            'SELECT seq FROM collector_batch WHERE session = ?',
+            (session,),
+        ).fetchone()
+        if row is not None and row[0] >= seq:
+            return None
+        written = self._write_batch(records)
+        self.db_conn.execute(
+            'INSERT OR REPLACE INTO collector_batch (session, node, seq, received_at) '
+            'VALUES (?, ?, ?, ?)',
+            (session, node, seq, time.time()),
+        )
+        return written
+
+    def ingest(self, session: str, node: str, seq: int, records: list[tuple]) -> int | None:
+        # None when the batch was ingested before
+        return self._locked('batch', self._ingest, session, node, seq, records)
+
+
+class CollectorRequestHandler(StreamRequestHandler):
+    # a node that stalls mid-frame or goes away without closing its
+    # connection gives its thread back after this long; idle nodes
+    # reconnect before the collector would time them out
+    timeout = ACK_TIMEOUT
+
+    def handle(self):
+        try:
+            self._receive()
+        except socket.timeout:
+            pass
+
+    def _receive(self):
+        while True:
+            header = self.rfile.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            (size,) = FRAME_HEADER.unpack(header)
+            if size > MAX_FRAME_SIZE:
+                print(f'{self.client_address[0]}: frame of {size} bytes is too large')
+                return
+            frame = self.rfile.read(size)
+            if len(frame) < size:
+                return
+
+            try:
+                session, node, seq, records = decode_batch(frame)
+            except BatchError as e:
+                COLLECTOR_BATCHES.labels('rejected').inc()
+                print(f'{self.client_address[0]}: {e}')
+                self.wfile.write(ACK.pack(0, REJECTED))
+                continue
+
+            try:
+                written = self.server.store.ingest(session, node, seq, records)
+            except sqlite3.Error as e:
+                # without an acknowledgement the node keeps the batch and
+                # sends it again
+                COLLECTOR_BATCHES.labels('failed').inc()
+                print(f'cannot ingest batch {seq} from {node}: {e}')
+                return
+            if written is None:
+                COLLECTOR_BATCHES.labels('duplicate').inc()
+            else:
+                COLLECTOR_BATCHES.labels('ingested').inc()
+                COLLECTOR_RECORDS.inc(written)
+            self.wfile.write(ACK.pack(seq, ACCEPTED))
+
+
+class Collector(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        server_address: tuple[str, int] = ('', config.COLLECTOR_PORT),
+        db_path: str = config.COLLECTOR_DB,
+    ) -> None:
+        db_conn = sqlite3.connect(db_path, check_same_thread=False)
+        init_db(db_conn)
+        init_collector_db(db_conn)
+        enable_wal(db_conn)
+        self.store = CollectorStore(db_conn)
+        super().__init__(server_address, CollectorRequestHandler)
+        self.analysis = start_analysis(self.store, db_path)
+
+    def server_close(self):
+        super().server_close()
+        if self.analysis is not None:
+            self.analysis.stop(config.SHUTDOWN_GRACE_SECONDS)
+        self.store.db_conn.close()
+
+
+def run_collector(port: int = config.COLLECTOR_PORT):
+    collector = Collector(('', port))
+    metrics_server = start_metrics_server(port=config.COLLECTOR_METRICS_PORT)
+    print(f'collector is running on port {port}, writing to {config.COLLECTOR_DB}')
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        print(f'{NEW_LINE}collector is stopped')
+    finally:
+        metrics_server.shutdown()
+        collector.server_close()
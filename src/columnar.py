@@ -0,0 +1,360 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+from urllib.parse import urlencode
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+import config
+from src.har import (
+    CREATED_AT_INDEX,
+    HEADER_REFS_INDEX,
+    IS_HTTPS_INDEX,
+    REQUEST_COLUMNS,
+    RESPONSE_COLUMNS,
+    RESPONSE_HEADER_REFS_INDEX,
+    RESPONSE_INDEX,
+)
+from src.header_store import header_store
+from src.request import Request
+from src.response import Response
+
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+BODY_MODES = ('none', 'inline', 'ref')
+
+# hive-style day partitions; names starting with _ or . are skipped by
+# dataset readers, so state, bodies and unfinished files stay out of them
+PARTITION_KEY = 'date'
+STATE_FILE = '_export_state.json'
+BODIES_DIR = '_bodies'
+TEMP_PREFIX = '.part-'
+TEMP_SUFFIX = '.tmp'
+
+
+class ExportError(Exception):
+    pass
+
+
+def _header_column(prefix: str, name: str) -> str:
+    return f'{prefix}_{name.replace("-", "_")}'
+
+
+def export_schema(bodies: str = 'none') -> 'pa.Schema':
+    headers = pa.list_(pa.struct([('name', pa.string()), ('value', pa.string())]))
+    fields = [
+        ('id', pa.int64()),
+        ('created_at', pa.timestamp('us', tz='UTC')),
+        ('is_https', pa.bool_()),
+        ('method', pa.string()),
+        ('host', pa.string()),
+        ('port', pa.int32()),
+        ('path', pa.string()),
+        ('query', pa.string()),
+        ('trace_id', pa.string()),
+        *(
+            (_header_column('request', name), pa.string())
+            for name in config.EXPORT_REQUEST_HEADERS
+        ),
+        ('request_headers', headers),
+        ('request_body_size', pa.int64()),
+        # null when the upstream did not answer
+        ('status', pa.int32()),
+        ('message', pa.string()),
+        ('from_cache', pa.bool_()),
+        ('duration', pa.float64()),
+        *(
+            (_header_column('response', name), pa.string())
+            for name in config.EXPORT_RESPONSE_HEADERS
+        ),
+        ('response_headers', headers),
+        ('response_body_size', pa.int64()),
+    ]
+    if bodies == 'inline':
+        # large_binary: the bodies of one batch may exceed 2 GiB together
+        fields += [
+            ('request_body', pa.large_binary()),
+            ('response_body', pa.large_binary()),
+        ]
+    elif bodies == 'ref':
+        fields += [
+            ('request_body_sha256', pa.string()),
+            ('response_body_sha256', pa.string()),
+        ]
+    return pa.schema(fields)
+
+
+def _as_bytes(body) -> bytes:
+    if body is None:
+        return b''
+    return body.encode() if isinstance(body, str) else body
+
+
+def _first_values(fields: list[tuple[str, str]], names) -> list[str | None]:
+    values = {}
+    for name, value in fields:
+        values.setdefault(name.lower(), value)
+    return [values.get(name) for name in names]
+
+
+def body_path(directory: str, digest: str) -> str:
+    return os.path.join(directory, BODIES_DIR, digest[:2], digest)
+
+
+def _store_body(directory: str, body: bytes) -> str | None:
+    # bodies are stored once per content, however often they were captured
+    if not body:
+        return None
+    digest = hashlib.sha256(body).hexdigest()
+    path = body_path(directory, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}{TEMP_SUFFIX}'
+        with open(temp_path, 'wb') as f:
+            f.write(body)
+        os.replace(temp_path, path)
+    return digest
+
+
+def _day(created_at: float | None) -> str:
+    return datetime.fromtimestamp(created_at or 0, timezone.utc).date().isoformat()
+
+
+class _Columns:
+    # one batch of rows, column by column
+    def __init__(self, schema: 'pa.Schema', bodies: str, directory: str) -> None:
+        self.schema = schema
+        self.bodies = bodies
+        self.directory = directory
+        self.columns: dict[str, list] = {name: [] for name in schema.names}
+
+    def add(self, row: tuple, store):
+        request = Request.from_db(row[:RESPONSE_INDEX], store)
+        response_row = row[RESPONSE_INDEX:]
+        response = None
+        if response_row[0] is not None:
+            response = Response.from_db((None, None) + response_row, store)
+        request_fields = request.header_fields
+        response_fields = response.header_fields if response is not None else []
+        request_body = _as_bytes(request.body)
+        response_body = _as_bytes(response.body if response is not None else None)
+        created_at = row[CREATED_AT_INDEX]
+
+        values = [
+            row[0],
+            None if created_at is None else int(created_at * 1_000_000),
+            bool(row[IS_HTTPS_INDEX]),
+            request.method,
+            request.host,
+            request.port,
+            request.path,
+            urlencode(request.get_params or {}, doseq=True),
+            request.trace_id,
+            *_first_values(request_fields, config.EXPORT_REQUEST_HEADERS),
+            [{'name': name, 'value': value} for name, value in request_fields],
+            len(request_body),
+            response.code if response is not None else None,
+            response.message if response is not None else None,
+            response.from_cache if response is not None else None,
+            response.duration if response is not None else None,
+            *_first_values(response_fields, config.EXPORT_RESPONSE_HEADERS),
+            [{'name': name, 'value': value} for name, value in response_fields],
+            len(response_body),
+        ]
+        if self.bodies == 'inline':
+            values += [request_body, response_body]
+        elif self.bodies == 'ref':
+            values += [
+                _store_body(self.directory, request_body),
+                _store_body(self.directory, response_body),
+            ]
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def to_batch(self) -> 'pa.RecordBatch':
+        return pa.RecordBatch.from_pydict(self.columns, schema=self.schema)
+
+
+class _PartFile:
+    # a file of one day partition, written under a temporary name and
+    # named after the ids it holds once it is finished
+    def __init__(self, directory: str, schema: 'pa.Schema', fmt: str, first_id: int) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.schema = schema
+        self.fmt = fmt
+        self.first_id = first_id
+        self.last_id = first_id
+        self.rows = 0
+        self.pending: list = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.temp_path = os.path.join(
+            directory,
+            f'{TEMP_PREFIX}{first_id:012d}{TEMP_SUFFIX}',
+        )
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(self.temp_path, schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(
+                self.temp_path,
+                schema,
+                options=pa.ipc.IpcWriteOptions(compression='zstd'),
+            )
+
+    def write(self, batch: 'pa.RecordBatch', last_id: int):
+        self.pending.append(batch)
+        self.pending_rows += batch.num_rows
+        self.pending_bytes += batch.nbytes
+        self.rows += batch.num_rows
+        self.last_id = last_id
+        if self.pending_rows >= config.EXPORT_ROW_GROUP_ROWS \
+                or self.pending_bytes >= config.EXPORT_ROW_GROUP_BYTES:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        table = pa.Table.from_batches(self.pending, self.schema)
+        if self.fmt == 'parquet':
+            self.writer.write_table(table, row_group_size=table.num_rows)
+        else:
+            self.writer.write_table(table, max_chunksize=table.num_rows)
+        self.pending = []
+        self.pending_rows = self.pending_bytes = 0
+
+    def close(self) -> str:
+        self._flush()
+        self.writer.close()
+        return self.temp_path
+
+    def final_path(self) -> str:
+        return os.path.join(
+            self.directory,
+            f'part-{self.first_id:012d}-{self.last_id:012d}{FORMATS[self.fmt]}',
+        )
+
+
+def _load_state(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_state(directory: str, state: dict):
+    path = os.path.join(directory, STATE_FILE)
+    with open(f'{path}{TEMP_SUFFIX}', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f'{path}{TEMP_SUFFIX}', path)
+
+
+def export_captures(
+    db_path: str = config.DB,
+    directory: str = config.EXPORT_DIR,
+    fmt: str = config.EXPORT_FORMAT,
+    bodies: str = config.EXPORT_BODIES,
+    full: bool = False,
+    batch_size: int = config.EXPORT_BATCH_SIZE,
+) -> int:
+    # writes the exchanges captured since the previous export of db_path
+    # into directory/date=YYYY-MM-DD/part-<first id>-<last id>.<format>.
+    # Requests are read by id in batches of batch_size, so memory does not
+    # grow with the capture. Files are moved into place and the last
+    # exported id saved once every file is complete; files left over by an
+    # interrupted export are deleted by the next one.
+    if pa is None:
+        raise ExportError('pyarrow is not installed')
+    if fmt not in FORMATS:
+        raise ExportError(f'unknown format {fmt!r}, expected one of {", ".join(FORMATS)}')
+    if bodies not in BODY_MODES:
+        raise ExportError(f'unknown body mode {bodies!r}, expected one of {", ".join(BODY_MODES)}')
+
+    os.makedirs(directory, exist_ok=True)
+    for temp_path in glob.glob(os.path.join(directory, '*', f'{TEMP_PREFIX}*{TEMP_SUFFIX}')):
+        os.remove(temp_path)
+    state = _load_state(directory)
+    source = os.path.abspath(db_path)
+    last_id = 0 if full else state.get(source, 0)
+
+    db_conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=30)
+    schema = export_schema(bodies)
+    store = header_store(db_conn)
+    query = (
+        f'SELECT {REQUEST_COLUMNS}, {RESPONSE_COLUMNS} FROM request '
+        'LEFT JOIN response ON response.request_id = request.id '
+        'WHERE request.id > ? ORDER BY request.id LIMIT ?'
+    )
+    open_files: OrderedDict[str, _PartFile] = OrderedDict()
+    finished: list[_PartFile] = []
+    exported = 0
+    try:
+        while True:
+            rows = db_conn.execute(query, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            store.preload(
+                refs
+                for row in rows
+                for refs in (row[HEADER_REFS_INDEX], row[RESPONSE_HEADER_REFS_INDEX])
+            )
+            days: dict[str, list[tuple]] = {}
+            for row in rows:
+                days.setdefault(_day(row[CREATED_AT_INDEX]), []).append(row)
+            for day, day_rows in days.items():
+                columns = _Columns(schema, bodies, directory)
+                for row in day_rows:
+                    columns.add(row, store)
+                part = open_files.pop(day, None)
+                if part is None:
+                    if len(open_files) >= config.EXPORT_MAX_OPEN_FILES:
+                        _, oldest = open_files.popitem(last=False)
+                        oldest.close()
+                        finished.append(oldest)
+                    part = _PartFile(
+                        os.path.join(directory, f'{PARTITION_KEY}={day}'),
+                        schema,
+                        fmt,
+                        day_rows[0][0],
+                    )
+                part.write(columns.to_batch(), day_rows[-1][0])
+                if part.rows >= config.EXPORT_FILE_ROWS:
+                    part.close()
+                    finished.append(part)
+                else:
+                    open_files[day] = part
+            exported += len(rows)
+        for part in open_files.values():
+            part.close()
+            finished.append(part)
+        open_files.clear()
+    finally:
+        db_conn.close()
+        for part in open_files.values():
+            part.close()
+
+    for part in finished:
+        os.replace(part.temp_path, part.final_path())
+    if exported:
+        state[source] = last_id
+        _save_state(directory, state)
+    return exported
+
+
+def run_export():
+    exported = export_captures(
+        os.environ.get('EXPORT_DB', config.DB),
+        full=os.environ.get('EXPORT_FULL', '0') == '1',
+    )
+    print(f'exported {exported} exchanges to {config.EXPORT_DIR}')
@@ -0,0 +1,195 @@
+import sqlite3
+import time
+
+
+def init_db(db_conn: sqlite3.Connection):
+    db_cursor = db_conn.cursor()
+    # only takes effect while the file has no tables yet; it lets the
+    # retention thread give pages back to the file system in small steps
+    db_cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS request (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            method TEXT,
+            host TEXT,
+            port INTEGER,
+            path TEXT,
+            get_params TEXT,
+            headers TEXT,
+            cookies TEXT,
+            body TEXT,
+            post_params TEXT,
+            is_https BOOLEAN,
+            trace_id TEXT,
+            header_refs BLOB,
+            created_at REAL
+        )
+    ''')
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            code INTEGER,
+            message TEXT,
+            headers TEXT,
+            set_cookie TEXT,
+            body TEXT,
+            header_refs BLOB,
+            from_cache BOOLEAN DEFAULT 0,
+            duration REAL,
+            FOREIGN KEY(request_id) REFERENCES requests(id)
+        )
+    ''')
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trace (
+            trace_id TEXT PRIMARY KEY,
+            client TEXT,
+            started_at REAL,
+            duration REAL,
+            spans TEXT
+        )
+    ''')
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS websocket_message (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            direction TEXT,
+            opcode INTEGER,
+            payload BLOB,
+            size INTEGER,
+            truncated BOOLEAN,
+            created_at REAL,
+            FOREIGN KEY(request_id) REFERENCES request(id)
+        )
+    ''')
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS finding (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            analyzer TEXT,
+            rule TEXT,
+            severity TEXT,
+            evidence TEXT,
+            created_at REAL,
+            FOREIGN KEY(request_id) REFERENCES request(id)
+        )
+    ''')
+    for table in ('traffic_minute', 'traffic_hour'):
+        db_cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                period INTEGER,
+                host TEXT,
+                status_class INTEGER,
+                requests INTEGER,
+                request_bytes INTEGER,
+                response_bytes INTEGER,
+                latency BLOB,
+                PRIMARY KEY (period, host, status_class)
+            ) WITHOUT ROWID
+        ''')
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS header_field (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            UNIQUE (name, value)
+        )
+    ''')
+    added = add_missing_columns(db_conn, 'request', {
+        'trace_id': 'TEXT',
+        'header_refs': 'BLOB',
+        'created_at': 'REAL',
+    })
+    if 'created_at' in added:
+        # the capture time of older rows is unknown, so their retention
+        # period starts now
+        db_cursor.execute(
+            'UPDATE request SET created_at = ? WHERE created_at IS NULL',
+            (time.time(),),
+        )
+    add_missing_columns(db_conn, 'response', {
+        'header_refs': 'BLOB',
+        'from_cache': 'BOOLEAN DEFAULT 0',
+        'duration': 'REAL',
+    })
+    db_cursor.execute('''
+        CREATE INDEX IF NOT EXISTS request_trace_id ON request (trace_id)
+    ''')
+    db_cursor.execute('''
+        CREATE INDEX IF NOT EXISTS request_created_at ON request (created_at)
+    ''')
+    db_cursor.execute('''
+        CREATE INDEX IF NOT EXISTS response_request_id ON response (request_id)
+    ''')
+    db_cursor.execute('''
+        CREATE INDEX IF NOT EXISTS websocket_message_request_id
+        ON websocket_message (request_id)
+    ''')
+    db_cursor.execute('''
+        CREATE INDEX IF NOT EXISTS finding_request_id ON finding (request_id)
+    ''')
+    db_cursor.execute('''
+        CREATE INDEX IF NOT EXISTS trace_started_at ON trace (started_at)
+    ''')
+    db_conn.commit()
+
+
+def enable_wal(db_conn: sqlite3.Connection):
+    # in WAL mode readers work on a snapshot and never block the capture
+    # writer; the journal mode is stored in the file, synchronous is per
+    # connection
+    db_conn.execute('PRAGMA journal_mode = WAL')
+    db_conn.execute('PRAGMA synchronous = NORMAL')
+
+
+def add_missing_columns(
+    db_conn: sqlite3.Connection,
+    table: str,
+    columns: dict[str, str],
+) -> list[str]:
+    existing = {
+        row[1] for row in db_conn.execute(f'PRAGMA table_info({table})')
+    }
+    added = []
+    for name, column_type in columns.items():
+        if name not in existing:
+            db_conn.execute(
+                f'ALTER TABLE {table} ADD COLUMN {name} {column_type}'
+            )
+            added.append(name)
+    return added
+
+
+def init_cert_db(db_conn: sqlite3.Connection):
+    # host certificates outlive restarts; a row is only valid for the CA
+    # and host key matching its fingerprint
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS certificate (
+            host TEXT PRIMARY KEY,
+            serial INTEGER,
+            cert BLOB,
+            key_path TEXT,
+            fingerprint TEXT,
+            not_after REAL,
+            created_at REAL
+        )
+    ''')
+    db_conn.execute('''
+        CREATE INDEX IF NOT EXISTS certificate_not_after
+        ON certificate (not_after)
+    ''')
+    db_conn.commit()
+
+
+def init_collector_db(db_conn: sqlite3.Connection):
+    # the last batch ingested from each sending session, so batches that
+    # are sent again after a lost acknowledgement are not written twice
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS collector_batch (
+            session TEXT PRIMARY KEY,
+            node TEXT,
+            seq INTEGER,
+            received_at REAL
+        )
+    ''')
+    db_conn.commit()
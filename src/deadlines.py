@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.client import HTTPResponse
+import io
+import math
+import socket
+import time
+from typing import Callable
+
+from src.metrics import Counter
+import config
+
+
+TIMEOUTS = Counter(
+    'proxy_timeouts_total',
+    'Operations abandoned because their time budget ran out, by stage.',
+    labelnames=('stage',),
+)
+
+
+@dataclass
+class Timeouts:
+    # seconds each stage may take; a stage of an upstream request is also
+    # cut short by what is left of the whole request
+    connect: float = config.UPSTREAM_CONNECT_TIMEOUT_SECONDS
+    tls_handshake: float = config.TLS_HANDSHAKE_TIMEOUT_SECONDS
+    first_byte: float = config.FIRST_BYTE_TIMEOUT_SECONDS
+    request: float = config.REQUEST_TIMEOUT_SECONDS
+    # seconds without traffic before a tunnel or an idle client connection
+    # is closed
+    tunnel_idle: float = config.TUNNEL_IDLE_TIMEOUT_SECONDS
+    client_idle: float = config.CLIENT_IDLE_TIMEOUT_SECONDS
+
+
+class StageTimeout(TimeoutError):
+    def __init__(self, stage: str) -> None:
+        super().__init__(f'{stage} timed out')
+        self.stage = stage
+
+
+class Deadline:
+    # the time budget of one request, shared by all of its stages
+    def __init__(
+        self,
+        seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.clock = clock
+        self.expires_at = clock() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - self.clock()
+
+    @contextmanager
+    def stage(self, name: str, timeout: float = math.inf):
+        # yields the socket timeout to use for the stage and turns a socket
+        # timeout into StageTimeout, blamed on the request when its deadline
+        # was the tighter limit
+        remaining = self.remaining()
+        if remaining <= 0:
+            TIMEOUTS.labels('request').inc()
+            raise StageTimeout('request')
+        blame = 'request' if remaining < timeout else name
+        try:
+            yield min(timeout, remaining)
+        except StageTimeout:
+            raise
+        except socket.timeout:
+            if self.remaining() <= 0:
+                blame = 'request'
+            TIMEOUTS.labels(blame).inc()
+            raise StageTimeout(blame) from None
+
+
+class _DeadlineSocketIO(socket.SocketIO):
+    # shortens the socket timeout to what is left of the deadline before
+    # every read, so an upstream sending a byte at a time cannot outlast it
+    def __init__(self, sock: socket.socket, deadline: Deadline) -> None:
+        super().__init__(sock, 'rb')
+        self.deadline = deadline
+
+    def readinto(self, buffer) -> int:
+        remaining = self.deadline.remaining()
+        if remaining <= 0:
+            raise socket.timeout('deadline passed')
+        timeout = self._sock.gettimeout()
+        if timeout is None or remaining < timeout:
+            self._sock.settimeout(remaining)
+        return super().readinto(buffer)
+
+
+class DeadlineResponse(HTTPResponse):
+    # an HTTPConnection.response_class whose every read is bounded by the
+    # deadline, from the status line to the end of the body
+    def __init__(
+        self,
+        sock: socket.socket,
+        *args,
+        deadline: Deadline,
+        **kwargs,
+    ) -> None:
+        super().__init__(sock, *args, **kwargs)
+        self.fp.close()
+        self.fp = io.BufferedReader(_DeadlineSocketIO(sock, deadline))
@@ -0,0 +1,277 @@
+from collections import OrderedDict
+import errno
+import ipaddress
+import selectors
+import socket
+import threading
+import time
+from typing import Callable
+
+from src.metrics import Counter, Histogram
+import config
+
+
+# RFC 8305 recommends 250ms between connection attempts
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+DNS_LOOKUPS = Counter(
+    'proxy_dns_lookups_total',
+    'Upstream hostname lookups by cache outcome.',
+    labelnames=('result',),
+)
+DNS_RESOLVE_SECONDS = Histogram(
+    'proxy_dns_resolve_seconds',
+    'Time spent in the system resolver on cache misses.',
+)
+
+
+class _Entry:
+    __slots__ = ('addrinfos', 'error', 'expires_at')
+
+    def __init__(self, addrinfos, error, expires_at: float) -> None:
+        self.addrinfos = addrinfos
+        self.error = error
+        self.expires_at = expires_at
+
+
+class _Lookup:
+    __slots__ = ('done', 'entry')
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.entry = None
+
+
+def _is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _with_port(addrinfos, port: int) -> list[tuple]:
+    return [
+        (family, type_, proto, canonname, (sockaddr[0], port) + sockaddr[2:])
+        for family, type_, proto, canonname, sockaddr in addrinfos
+    ]
+
+
+class DNSCache:
+    def __init__(
+        self,
+        resolver: Callable = socket.getaddrinfo,
+        ttl: float = config.DNS_CACHE_TTL,
+        negative_ttl: float = config.DNS_NEGATIVE_TTL,
+        max_entries: int = config.DNS_CACHE_SIZE,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._inflight: dict[str, _Lookup] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, host: str) -> _Entry:
+        try:
+            with DNS_RESOLVE_SECONDS.time():
+                addrinfos = self.resolver(host, None, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            return _Entry(None, e, self.clock() + self.negative_ttl)
+        return _Entry(addrinfos, None, self.clock() + self.ttl)
+
+    def _store(self, host: str, entry: _Entry):
+        self._entries[host] = entry
+        self._entries.move_to_end(host)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _resolve_entry(self, host: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and entry.expires_at > self.clock():
+                self._entries.move_to_end(host)
+                DNS_LOOKUPS.labels(
+                    'hit' if entry.error is None else 'negative_hit',
+                ).inc()
+                return entry
+
+            # only one thread asks the resolver for a host, the others wait
+            # for its answer
+            lookup = self._inflight.get(host)
+            leader = lookup is None
+            if leader:
+                lookup = self._inflight[host] = _Lookup()
+
+        if not leader:
+            DNS_LOOKUPS.labels('coalesced').inc()
+            lookup.done.wait()
+            return lookup.entry
+
+        DNS_LOOKUPS.labels('miss').inc()
+        try:
+            entry = self._lookup(host)
+        except BaseException as e:
+            entry = _Entry(None, e, self.clock())
+            raise
+        finally:
+            with self._lock:
+                if entry.expires_at > self.clock():
+                    self._store(host, entry)
+                del self._inflight[host]
+            lookup.entry = entry
+            lookup.done.set()
+        return entry
+
+    def resolve(self, host: str, port: int) -> list[tuple]:
+        if _is_ip_address(host):
+            return _with_port(
+                self.resolver(host, None, 0, socket.SOCK_STREAM),
+                port,
+            )
+        entry = self._resolve_entry(host.lower())
+        if entry.error is not None:
+            raise entry.error
+        return _with_port(entry.addrinfos, port)
+
+
+def interleave_families(addrinfos: list[tuple]) -> list[tuple]:
+    # alternate address families starting with the first one returned by
+    # the resolver, as RFC 8305 section 4 describes
+    by_family: dict[int, list[tuple]] = {}
+    for addrinfo in addrinfos:
+        by_family.setdefault(addrinfo[0], []).append(addrinfo)
+    queues = list(by_family.values())
+    result = []
+    while queues:
+        for queue in list(queues):
+            result.append(queue.pop(0))
+            if not queue:
+                queues.remove(queue)
+    return result
+
+
+def _start_attempt(addrinfo, source_address) -> socket.socket:
+    family, type_, proto, _, sockaddr = addrinfo
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        if source_address:
+            sock.bind(source_address)
+        err = sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(err, f'{errno.errorcode.get(err, err)} ({sockaddr[0]})')
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def happy_eyeballs_connect(
+    addrinfos: list[tuple],
+    timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+    source_address=None,
+    delay: float = CONNECTION_ATTEMPT_DELAY,
+) -> socket.socket:
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    addrinfos = interleave_families(addrinfos)
+    if not addrinfos:
+        raise OSError('getaddrinfo returns an empty list')
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    pending: dict[socket.socket, tuple] = {}
+    errors = []
+    winner = None
+    next_index = 0
+    next_attempt_at = time.monotonic()
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out')
+
+            # a new attempt starts when the delay is up or when every
+            # running attempt has failed
+            if next_index < len(addrinfos) and (
+                now >= next_attempt_at or not pending
+            ):
+                addrinfo = addrinfos[next_index]
+                next_index += 1
+                next_attempt_at = now + delay
+                try:
+                    sock = _start_attempt(addrinfo, source_address)
+                except OSError as e:
+                    errors.append(e)
+                    next_attempt_at = now
+                    continue
+                pending[sock] = addrinfo
+                selector.register(sock, selectors.EVENT_WRITE)
+                continue
+
+            if not pending:
+                break
+
+            wait = None
+            if next_index < len(addrinfos):
+                wait = max(next_attempt_at - now, 0)
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                addrinfo = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = sock
+                    break
+                sock.close()
+                errors.append(OSError(
+                    err,
+                    f'{errno.errorcode.get(err, err)} ({addrinfo[4][0]})',
+                ))
+                next_attempt_at = time.monotonic()
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+    if winner is None:
+        raise errors[-1] if errors else OSError('connection failed')
+    winner.setblocking(True)
+    winner.settimeout(timeout)
+    return winner
+
+
+dns_cache = DNSCache()
+
+
+def create_connection(
+    address: tuple[str, int],
+    timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+    source_address=None,
+) -> socket.socket:
+    # drop-in replacement for socket.create_connection that resolves
+    # through dns_cache and races the resolved addresses; the lookup counts
+    # against the timeout
+    host, port = address
+    started = time.monotonic()
+    addrinfos = dns_cache.resolve(host, port)
+    if isinstance(timeout, (int, float)):
+        timeout -= time.monotonic() - started
+        if timeout <= 0:
+            raise socket.timeout(f'resolving {host} timed out')
+    return happy_eyeballs_connect(addrinfos, timeout, source_address)
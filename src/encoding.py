@@ -0,0 +1,243 @@
+from typing import Iterable, Iterator
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import config
+
+
+CONTENT_ENCODING_HEADER = 'Content-Encoding'
+IDENTITY = 'identity'
+
+# about the most a decoder produces per step, whatever the input expands to
+CHUNK_SIZE = 64 * 1024
+
+
+class DecodingError(ValueError):
+    pass
+
+
+class UnsupportedEncodingError(DecodingError):
+    pass
+
+
+class DecompressionBombError(DecodingError):
+    pass
+
+
+def get_header(headers: dict, name: str, default=None):
+    if name in headers:
+        return headers[name]
+    name = name.lower()
+    for header_name, value in headers.items():
+        if header_name.lower() == name:
+            return value
+    return default
+
+
+def parse_content_encoding(value: str | None) -> list[str]:
+    if not value:
+        return []
+    codings = [coding.strip().lower() for coding in value.split(',')]
+    return [coding for coding in codings if coding and coding != IDENTITY]
+
+
+class _ZlibDecoder:
+    def __init__(self, wbits: int) -> None:
+        self._wbits = wbits
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        while data:
+            try:
+                chunk = self._decompressor.decompress(data, CHUNK_SIZE)
+            except zlib.error as e:
+                raise DecodingError(str(e)) from e
+            if chunk:
+                yield chunk
+            if self._decompressor.eof:
+                # gzip bodies may consist of several concatenated members
+                data = self._decompressor.unused_data
+                if data:
+                    self._decompressor = zlib.decompressobj(self._wbits)
+            else:
+                data = self._decompressor.unconsumed_tail
+
+    def flush(self) -> Iterator[bytes]:
+        chunk = self._decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+class GzipDecoder(_ZlibDecoder):
+    def __init__(self) -> None:
+        super().__init__(16 + zlib.MAX_WBITS)
+
+
+class DeflateDecoder:
+    # 'deflate' is meant to be zlib-wrapped, but plenty of servers send a
+    # raw deflate stream; the first two bytes tell which one we got
+    def __init__(self) -> None:
+        self._decoder = None
+        self._head = b''
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        if self._decoder is None:
+            self._head += data
+            if len(self._head) < 2:
+                return
+            data, self._head = self._head, b''
+            is_zlib = (data[0] & 0x0f) == 8 and \
+                ((data[0] << 8) | data[1]) % 31 == 0
+            self._decoder = _ZlibDecoder(
+                zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS,
+            )
+        yield from self._decoder.decompress(data)
+
+    def flush(self) -> Iterator[bytes]:
+        if self._decoder is None:
+            if self._head:
+                raise DecodingError('truncated deflate stream')
+            return
+        yield from self._decoder.flush()
+
+
+class BrotliDecoder:
+    def __init__(self) -> None:
+        if brotli is None:
+            raise UnsupportedEncodingError('br support requires Brotli')
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        # once the output limit is hit, the rest of the output is drained
+        # with empty input before the decompressor takes more
+        while True:
+            try:
+                chunk = self._decompressor.process(
+                    data,
+                    output_buffer_limit=CHUNK_SIZE,
+                )
+            except brotli.error as e:
+                raise DecodingError(str(e)) from e
+            if chunk:
+                yield chunk
+            data = b''
+            if self._decompressor.can_accept_more_data():
+                return
+
+    def flush(self) -> Iterator[bytes]:
+        return iter(())
+
+
+class _ChunkReader:
+    # a file-like view of an iterable of chunks, read by zstandard
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b''
+            self._pending = chunk
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+class ZstdDecoder:
+    # zstandard's push API returns all the output of its input at once, so
+    # this decoder pulls the chunks through a stream reader instead, which
+    # returns at most CHUNK_SIZE bytes per read
+    def __init__(self) -> None:
+        if zstandard is None:
+            raise UnsupportedEncodingError('zstd support requires zstandard')
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        reader = self._decompressor.stream_reader(
+            _ChunkReader(chunks),
+            read_across_frames=True,
+        )
+        with reader:
+            while True:
+                try:
+                    chunk = reader.read(CHUNK_SIZE)
+                except zstandard.ZstdError as e:
+                    raise DecodingError(str(e)) from e
+                if not chunk:
+                    return
+                yield chunk
+
+
+DECODERS = {
+    'gzip': GzipDecoder,
+    'x-gzip': GzipDecoder,
+    'deflate': DeflateDecoder,
+    'br': BrotliDecoder,
+    'zstd': ZstdDecoder,
+}
+
+
+def _decoder_for(coding: str):
+    decoder_class = DECODERS.get(coding)
+    if decoder_class is None:
+        raise UnsupportedEncodingError(f'unsupported content encoding {coding!r}')
+    return decoder_class()
+
+
+def _pipe(decoder, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    if hasattr(decoder, 'stream'):
+        yield from decoder.stream(chunks)
+        return
+    for chunk in chunks:
+        yield from decoder.decompress(chunk)
+    yield from decoder.flush()
+
+
+def iter_decoded(
+    chunks: Iterable[bytes],
+    content_encoding: str | None,
+    max_size: int | None = config.MAX_DECODED_BODY_SIZE,
+) -> Iterator[bytes]:
+    # codings are listed in the order they were applied, so undo them
+    # from last to first
+    stream = iter(chunks)
+    for coding in reversed(parse_content_encoding(content_encoding)):
+        stream = _pipe(_decoder_for(coding), stream)
+
+    total = 0
+    for chunk in stream:
+        total += len(chunk)
+        if max_size is not None and total > max_size:
+            raise DecompressionBombError(
+                f'decoded body exceeds {max_size} bytes'
+            )
+        yield chunk
+
+
+def decode_body(
+    body: bytes | None,
+    content_encoding: str | None,
+    max_size: int | None = config.MAX_DECODED_BODY_SIZE,
+) -> bytes | None:
+    if not body or not parse_content_encoding(content_encoding):
+        return body
+    chunks = (
+        body[start:start + CHUNK_SIZE]
+        for start in range(0, len(body), CHUNK_SIZE)
+    )
+    return b''.join(iter_decoded(chunks, content_encoding, max_size))
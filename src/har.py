@@ -0,0 +1,607 @@
+import base64
+import codecs
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.cookies import CookieError, SimpleCookie
+import json
+import re
+import sqlite3
+import time
+from typing import Iterator
+from urllib.parse import urlencode, urlsplit
+
+import config
+from src.encoding import CONTENT_ENCODING_HEADER, DecodingError, get_header
+from src.header_store import header_store
+from src.request import DEFAULT_PORT, Request
+from src.response import Response
+from src.traffic_stats import TrafficStats
+from src.websocket import CLIENT, SERVER, TEXT
+
+
+HAR_VERSION = '1.2'
+HTTP_VERSION = 'HTTP/1.1'
+
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+READ_CHUNK_SIZE = 64 * 1024
+# a single entry may not grow the import buffer beyond this
+MAX_ENTRY_SIZE = 256 * 1024 * 1024
+
+REQUEST_COLUMNS = (
+    'request.id, request.method, request.host, request.port, request.path, '
+    'request.get_params, request.headers, request.cookies, request.body, '
+    'request.post_params, request.is_https, request.trace_id, '
+    'request.header_refs, request.created_at'
+)
+RESPONSE_COLUMNS = (
+    'response.code, response.message, response.headers, response.set_cookie, '
+    'response.body, response.header_refs, response.from_cache, '
+    'response.duration'
+)
+IS_HTTPS_INDEX = 10
+HEADER_REFS_INDEX = 12
+CREATED_AT_INDEX = 13
+RESPONSE_INDEX = 14
+RESPONSE_HEADER_REFS_INDEX = RESPONSE_INDEX + 5
+
+# Chrome's field for the frames of a WebSocket connection
+WEBSOCKET_MESSAGES = '_webSocketMessages'
+MESSAGE_TYPES = {CLIENT: 'send', SERVER: 'receive'}
+MESSAGE_DIRECTIONS = {value: key for key, value in MESSAGE_TYPES.items()}
+
+
+class HarError(ValueError):
+    pass
+
+
+def parse_timestamp(value: str) -> float:
+    # epoch seconds or an ISO 8601 date; Python 3.10 does not accept 'Z'
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def _format_timestamp(timestamp: float | None) -> str:
+    return datetime.fromtimestamp(
+        timestamp or 0,
+        timezone.utc,
+    ).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def _name_values(fields) -> list[dict]:
+    return [{'name': name, 'value': value} for name, value in fields]
+
+
+def _content(body: bytes | None) -> dict:
+    # text when the bytes are valid UTF-8, base64 otherwise
+    if not body:
+        return {'text': ''}
+    try:
+        return {'text': body.decode()}
+    except UnicodeDecodeError:
+        return {'text': base64.b64encode(body).decode(), 'encoding': 'base64'}
+
+
+def _response_cookies(fields) -> list[dict]:
+    cookies = []
+    for name, value in fields:
+        if name.lower() != 'set-cookie':
+            continue
+        parsed = SimpleCookie()
+        try:
+            parsed.load(value)
+        except CookieError:
+            continue
+        for morsel in parsed.values():
+            cookie = {'name': morsel.key, 'value': morsel.value}
+            for attribute in ('path', 'domain', 'expires'):
+                if morsel[attribute]:
+                    cookie[attribute] = morsel[attribute]
+            if morsel['httponly']:
+                cookie['httpOnly'] = True
+            if morsel['secure']:
+                cookie['secure'] = True
+            cookies.append(cookie)
+    return cookies
+
+
+def _url(request: Request, is_https: bool) -> str:
+    scheme = 'https' if is_https else 'http'
+    netloc = request.host or ''
+    # requests read from a tunnel get the plain HTTP default port when
+    # their Host header has none, like send_request_get_response treat
+    # that as the https default
+    port = request.port
+    if is_https and port == DEFAULT_PORT['http']:
+        port = DEFAULT_PORT['https']
+    if port and port != DEFAULT_PORT[scheme]:
+        netloc = f'{netloc}:{port}'
+    url = f'{scheme}://{netloc}{request.path or "/"}'
+    query = urlencode(request.get_params, doseq=True)
+    return f'{url}?{query}' if query else url
+
+
+def _har_request(request: Request, is_https: bool) -> dict:
+    fields = request.header_fields
+    har_request = {
+        'method': request.method,
+        'url': _url(request, is_https),
+        'httpVersion': HTTP_VERSION,
+        'cookies': [
+            {'name': name, 'value': morsel.value}
+            for name, morsel in request.cookies.items()
+        ],
+        'headers': _name_values(fields),
+        'queryString': _name_values(
+            (name, value)
+            for name, values in request.get_params.items()
+            for value in (values if isinstance(values, list) else [values])
+        ),
+        'headersSize': -1,
+        'bodySize': len(request.body or b''),
+    }
+    if request.body:
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode()
+        har_request['postData'] = {
+            'mimeType': get_header(request.headers, 'Content-Type', ''),
+            'params': [],
+            **_content(body),
+        }
+    return har_request
+
+
+def _har_response(response: Response | None) -> dict:
+    if response is None:
+        # HAR has no way to leave the response out, browsers write a zero
+        # status for requests that never got one
+        return {
+            'status': 0,
+            'statusText': '',
+            'httpVersion': HTTP_VERSION,
+            'cookies': [],
+            'headers': [],
+            'content': {'size': 0, 'mimeType': 'x-unknown', 'text': ''},
+            'redirectURL': '',
+            'headersSize': -1,
+            'bodySize': -1,
+        }
+
+    fields = response.header_fields
+    body = response.body or b''
+    if isinstance(body, str):
+        body = body.encode()
+    content = {'mimeType': get_header(response.headers, 'Content-Type', 'x-unknown')}
+    try:
+        decoded = response.decoded_body or b''
+    except DecodingError as e:
+        decoded = body
+        content['comment'] = f'body could not be decoded: {e}'
+    content['size'] = len(decoded)
+    if len(decoded) != len(body):
+        content['compression'] = len(decoded) - len(body)
+    content.update(_content(decoded))
+    return {
+        'status': response.code,
+        'statusText': response.message or '',
+        'httpVersion': HTTP_VERSION,
+        'cookies': _response_cookies(fields),
+        'headers': _name_values(fields),
+        'content': content,
+        'redirectURL': get_header(response.headers, 'Location', ''),
+        'headersSize': -1,
+        'bodySize': len(body),
+        '_fromCache': response.from_cache,
+    }
+
+
+def _har_messages(messages) -> list[dict]:
+    return [
+        {
+            'type': MESSAGE_TYPES.get(direction, direction),
+            'time': created_at,
+            'opcode': opcode,
+            'data': payload.decode('utf-8', 'replace') if opcode == TEXT
+            else base64.b64encode(payload).decode(),
+        }
+        for direction, opcode, payload, created_at in messages
+    ]
+
+
+def to_har_entry(
+    request: Request,
+    response: Response | None,
+    is_https: bool,
+    created_at: float | None,
+    messages=None,
+) -> dict:
+    # the proxy only measures the wait for the response head
+    wait = 0
+    if response is not None and response.duration is not None:
+        wait = round(response.duration * 1000, 3)
+    entry = {
+        'startedDateTime': _format_timestamp(created_at),
+        'time': wait,
+        'request': _har_request(request, is_https),
+        'response': _har_response(response),
+        'cache': {},
+        'timings': {'send': 0, 'wait': wait, 'receive': 0},
+    }
+    if messages:
+        entry[WEBSOCKET_MESSAGES] = _har_messages(messages)
+    return entry
+
+
+def _filter_sql(
+    host: str | None,
+    since: float | None,
+    until: float | None,
+    ids: list[int] | None,
+) -> tuple[list[str], list]:
+    conditions = []
+    params = []
+    if host is not None:
+        conditions.append('request.host = ?')
+        params.append(host)
+    if since is not None:
+        conditions.append('request.created_at >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('request.created_at < ?')
+        params.append(until)
+    if ids is not None:
+        conditions.append('request.id IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps(ids))
+    return conditions, params
+
+
+def _load_messages(db_conn: sqlite3.Connection, request_ids: list[int]) -> dict:
+    messages = {}
+    rows = db_conn.execute(
+        'SELECT request_id, direction, opcode, payload, created_at '
+        'FROM websocket_message '
+        'WHERE request_id IN (SELECT value FROM json_each(?)) ORDER BY id',
+        (json.dumps(request_ids),),
+    )
+    for request_id, *message in rows:
+        messages.setdefault(request_id, []).append(message)
+    return messages
+
+
+def iter_entries(
+    db_conn: sqlite3.Connection,
+    host: str | None = None,
+    since: float | None = None,
+    until: float | None = None,
+    ids: list[int] | None = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Iterator[dict]:
+    # pages through the requests by id, so only one batch of rows is in
+    # memory and no read transaction stays open between batches
+    conditions, params = _filter_sql(host, since, until, ids)
+    where = ' AND '.join(['request.id > ?'] + conditions)
+    query = (
+        f'SELECT {REQUEST_COLUMNS}, {RESPONSE_COLUMNS} FROM request '
+        'LEFT JOIN response ON response.request_id = request.id '
+        f'WHERE {where} ORDER BY request.id LIMIT ?'
+    )
+    store = header_store(db_conn)
+    last_id = 0
+    while True:
+        rows = db_conn.execute(query, (last_id, *params, batch_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        store.preload(
+            refs
+            for row in rows
+            for refs in (row[HEADER_REFS_INDEX], row[RESPONSE_HEADER_REFS_INDEX])
+        )
+        messages = _load_messages(
+            db_conn,
+            [row[0] for row in rows if row[RESPONSE_INDEX] == 101],
+        )
+        for row in rows:
+            response_row = row[RESPONSE_INDEX:]
+            response = None
+            if response_row[0] is not None:
+                response = Response.from_db((None, None) + response_row, store)
+            yield to_har_entry(
+                Request.from_db(row[:RESPONSE_INDEX], store),
+                response,
+                bool(row[IS_HTTPS_INDEX]),
+                row[CREATED_AT_INDEX],
+                messages.get(row[0]),
+            )
+
+
+def iter_har(db_conn: sqlite3.Connection, **filters) -> Iterator[str]:
+    # the document is written piece by piece so it can be streamed
+    header = json.dumps({
+        'version': HAR_VERSION,
+        'creator': {'name': config.APP_NAME, 'version': HAR_VERSION},
+    })
+    yield '{"log": ' + header[:-1] + ', "entries": [\n'
+    separator = ''
+    for entry in iter_entries(db_conn, **filters):
+        yield separator + json.dumps(entry)
+        separator = ',\n'
+    yield '\n]}}\n'
+
+
+def export_har(db_conn: sqlite3.Connection, fp, **filters) -> None:
+    for chunk in iter_har(db_conn, **filters):
+        fp.write(chunk)
+
+
+class _JSONStream:
+    # walks a JSON document read from a binary file object; values are
+    # decoded one at a time with raw_decode, so only the value being read
+    # has to fit in memory
+    _NON_SPACE = re.compile(r'\S')
+
+    def __init__(self, fp, chunk_size: int = READ_CHUNK_SIZE) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        # read at least as much as is pending, so a large value is parsed
+        # a logarithmic number of times
+        data = self.fp.read(max(self.chunk_size, len(self.buffer) - self.position))
+        if not data:
+            self.eof = True
+        try:
+            text = self.decoder.decode(data, final=self.eof)
+        except UnicodeDecodeError as e:
+            raise HarError(f'invalid UTF-8: {e}') from None
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            match = self._NON_SPACE.search(self.buffer, self.position)
+            if match is not None:
+                self.position = match.start()
+                return self.buffer[self.position]
+            self.position = len(self.buffer)
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise HarError(f'expected {char!r}, found {found or "end of input"!r}')
+        self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError as e:
+                if len(self.buffer) - self.position > MAX_ENTRY_SIZE:
+                    raise HarError('value too large') from None
+                if not self._fill():
+                    raise HarError(f'invalid JSON: {e}') from None
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def keys(self) -> Iterator[str]:
+        # yields the keys of an object; the caller reads each value
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise HarError('object keys must be strings')
+            self.expect(':')
+            yield key
+            separator = self.peek()
+            self.position += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise HarError(f'expected \',\' or \'}}\', found {separator!r}')
+
+    def items(self) -> Iterator:
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.position += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise HarError(f'expected \',\' or \']\', found {separator!r}')
+
+
+def iter_har_entries(fp, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[dict]:
+    stream = _JSONStream(fp, chunk_size)
+    for key in stream.keys():
+        if key != 'log':
+            stream.value()
+            continue
+        for log_key in stream.keys():
+            if log_key == 'entries':
+                yield from stream.items()
+            else:
+                stream.value()
+
+
+def _decode_content(content: dict | None) -> bytes | None:
+    if not content or content.get('text') is None:
+        return None
+    if content.get('encoding') == 'base64':
+        return base64.b64decode(content['text'])
+    return content['text'].encode()
+
+
+def _fields(headers: list[dict]) -> list[tuple[str, str]]:
+    # HTTP/2 exports carry pseudo headers such as :authority
+    return [
+        (header['name'], header['value'])
+        for header in headers
+        if not header['name'].startswith(':')
+    ]
+
+
+def _request_from_entry(entry: dict) -> tuple[Request, bool]:
+    har_request = entry['request']
+    url = urlsplit(har_request['url'])
+    if url.scheme not in DEFAULT_PORT or not url.hostname:
+        raise ValueError(f'unsupported url {har_request["url"]!r}')
+    request = Request(
+        method=har_request['method'],
+        host=url.hostname,
+        port=url.port or DEFAULT_PORT[url.scheme],
+        path=url.path or '/',
+        query=url.query,
+        get_params=None,
+        header_fields=_fields(har_request.get('headers', [])),
+        body=_decode_content(har_request.get('postData')),
+        post_params=None,
+    )
+    return request, url.scheme == 'https'
+
+
+def _response_from_entry(entry: dict) -> Response | None:
+    har_response = entry.get('response') or {}
+    code = har_response.get('status') or 0
+    if code <= 0:
+        return None
+    # HAR content is always decoded, so the stored body no longer has the
+    # Content-Encoding it was sent with
+    fields = [
+        field
+        for field in _fields(har_response.get('headers', []))
+        if field[0].lower() != CONTENT_ENCODING_HEADER.lower()
+    ]
+    message = har_response.get('statusText')
+    if not message:
+        try:
+            message = HTTPStatus(code).phrase
+        except ValueError:
+            message = ''
+    return Response(
+        code=code,
+        message=message,
+        header_fields=fields,
+        set_cookie=None,
+        body=_decode_content(har_response.get('content')) or b'',
+        from_cache=bool(har_response.get('_fromCache')),
+    )
+
+
+def _message_rows(messages: list[dict]) -> list[tuple]:
+    rows = []
+    for message in messages:
+        opcode = message.get('opcode', TEXT)
+        data = message.get('data') or ''
+        payload = data.encode() if opcode == TEXT else base64.b64decode(data)
+        rows.append((
+            MESSAGE_DIRECTIONS.get(message.get('type'), message.get('type')),
+            opcode,
+            payload,
+            len(payload),
+            False,
+            message.get('time'),
+        ))
+    return rows
+
+
+def _save_entry(
+    db_conn: sqlite3.Connection,
+    store,
+    stats: TrafficStats,
+    entry: dict,
+):
+    # everything is mapped before the first insert; import_har undoes
+    # the rows of an entry that fails after that
+    request, is_https = _request_from_entry(entry)
+    response = _response_from_entry(entry)
+    started = entry.get('startedDateTime')
+    created_at = parse_timestamp(started) if started else time.time()
+    messages = _message_rows(entry.get(WEBSOCKET_MESSAGES) or [])
+    wait = (entry.get('timings') or {}).get('wait')
+    if response is not None and isinstance(wait, (int, float)) and wait >= 0:
+        response.duration = wait / 1000
+
+    request_id = request.save_to_db(
+        db_conn,
+        is_https,
+        store=store,
+        commit=False,
+        created_at=created_at,
+    )
+    if response is not None:
+        response.save_to_db(request_id, db_conn, store, commit=False)
+    if messages:
+        db_conn.executemany('''
+            INSERT INTO websocket_message (request_id, direction, opcode, payload, size, truncated, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(request_id, *message) for message in messages])
+    stats.add_exchange(request, response, created_at)
+
+
+def import_har(
+    db_conn: sqlite3.Connection,
+    fp,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> tuple[int, int]:
+    # entries are committed in batches of batch_size; entries that cannot
+    # be mapped to a request are skipped and counted. When the document
+    # turns out to be invalid, the entries read up to that point are kept.
+    store = header_store(db_conn)
+    stats = TrafficStats()
+    imported = skipped = 0
+    try:
+        for entry in iter_har_entries(fp):
+            db_conn.execute('SAVEPOINT entry')
+            fields = store.mark()
+            try:
+                _save_entry(db_conn, store, stats, entry)
+            except BaseException as e:
+                db_conn.execute('ROLLBACK TO entry')
+                db_conn.execute('RELEASE entry')
+                store.rollback(fields)
+                if not isinstance(e, (KeyError, TypeError, ValueError, AttributeError)):
+                    raise
+                skipped += 1
+                continue
+            db_conn.execute('RELEASE entry')
+            imported += 1
+            if imported % batch_size == 0:
+                stats.flush(db_conn)
+                db_conn.commit()
+                store.commit()
+    finally:
+        stats.flush(db_conn)
+        db_conn.commit()
+        store.commit()
+    return imported, skipped
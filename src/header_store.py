@@ -0,0 +1,171 @@
+import sqlite3
+import struct
+from threading import Lock
+
+
+# every distinct (name, value) pair is stored once in header_field; a row
+# references its headers as a packed array of little-endian uint32 ids,
+# which keeps the original order and any repeated headers
+REF_FORMAT = '<{}I'
+REF_SIZE = struct.calcsize('<I')
+
+
+def pack_refs(field_ids: list[int]) -> bytes:
+    return struct.pack(REF_FORMAT.format(len(field_ids)), *field_ids)
+
+
+def unpack_refs(refs: bytes) -> tuple[int, ...]:
+    return struct.unpack(REF_FORMAT.format(len(refs) // REF_SIZE), refs)
+
+
+class FieldCache:
+    def __init__(self) -> None:
+        self.ids: dict[tuple[str, str], int] = {}
+        self.fields: dict[int, tuple[str, str]] = {}
+        self.lock = Lock()
+
+    def remember(self, field_id: int, field: tuple[str, str]):
+        self.ids[field] = field_id
+        self.fields[field_id] = field
+
+
+class HeaderStore:
+    # fields inserted by the open transaction stay pending, visible to this
+    # store only: a rollback hands their ids out again. They join the
+    # shared cache after commit(); rollback() drops them. A transaction
+    # the caller ended on the connection directly is settled against the
+    # table on the next use.
+    def __init__(
+        self,
+        db_conn: sqlite3.Connection,
+        cache: FieldCache | None = None,
+    ) -> None:
+        self.db_conn = db_conn
+        self.cache = cache if cache is not None else FieldCache()
+        self.pending = FieldCache()
+
+    def mark(self) -> int:
+        # the point a later rollback(mark) returns to, e.g. a savepoint
+        return len(self.pending.ids)
+
+    def commit(self):
+        with self.cache.lock:
+            for field, field_id in self.pending.ids.items():
+                self.cache.remember(field_id, field)
+            self.pending = FieldCache()
+
+    def rollback(self, mark: int = 0):
+        with self.cache.lock:
+            for field in list(self.pending.ids)[mark:]:
+                del self.pending.fields[self.pending.ids.pop(field)]
+
+    def _settle(self):
+        # only ids that made it into the table are shared
+        if not self.pending.ids or self.db_conn.in_transaction:
+            return
+        pending, self.pending = self.pending, FieldCache()
+        field_ids = list(pending.fields)
+        for start in range(0, len(field_ids), 500):
+            chunk = field_ids[start:start + 500]
+            rows = self.db_conn.execute(
+                'SELECT id, name, value FROM header_field '
+                f'WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk,
+            )
+            for field_id, name, value in rows:
+                if pending.fields[field_id] == (name, value):
+                    self.cache.remember(field_id, (name, value))
+
+    def _intern(self, field: tuple[str, str]) -> int:
+        cursor = self.db_conn.execute(
+            'INSERT OR IGNORE INTO header_field (name, value) VALUES (?, ?)',
+            field,
+        )
+        if cursor.rowcount:
+            field_id = cursor.lastrowid
+            self.pending.remember(field_id, field)
+        else:
+            field_id = self.db_conn.execute(
+                'SELECT id FROM header_field WHERE name = ? AND value = ?',
+                field,
+            ).fetchone()[0]
+            self.cache.remember(field_id, field)
+        return field_id
+
+    def encode(self, fields: list[tuple[str, str]]) -> bytes:
+        field_ids = []
+        with self.cache.lock:
+            self._settle()
+            ids = self.cache.ids
+            pending = self.pending.ids
+            for field in fields:
+                field_id = ids.get(field)
+                if field_id is None:
+                    field_id = pending.get(field)
+                    if field_id is None:
+                        field_id = self._intern(tuple(field))
+                field_ids.append(field_id)
+        return pack_refs(field_ids)
+
+    def _load(self, field_ids):
+        fields = self.cache.fields
+        pending = self.pending.fields
+        missing = [
+            field_id for field_id in set(field_ids)
+            if field_id not in fields and field_id not in pending
+        ]
+        # stay well below SQLITE_MAX_VARIABLE_NUMBER
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            rows = self.db_conn.execute(
+                'SELECT id, name, value FROM header_field '
+                f'WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk,
+            )
+            for field_id, name, value in rows:
+                self.cache.remember(field_id, (name, value))
+
+    def decode(self, refs: bytes) -> list[tuple[str, str]]:
+        field_ids = unpack_refs(refs)
+        fields = self.cache.fields
+        with self.cache.lock:
+            self._settle()
+            if any(field_id not in fields for field_id in field_ids):
+                self._load(field_ids)
+                pending = self.pending.fields
+                return [
+                    fields.get(field_id) or pending[field_id]
+                    for field_id in field_ids
+                ]
+            return [fields[field_id] for field_id in field_ids]
+
+    def preload(self, refs_list):
+        field_ids = []
+        for refs in refs_list:
+            if refs is not None:
+                field_ids.extend(unpack_refs(refs))
+        with self.cache.lock:
+            self._settle()
+            self._load(field_ids)
+
+
+# header_field is append-only, so the id -> field cache of a database file
+# is shared by every connection to it
+_caches: dict[str, FieldCache] = {}
+_lock = Lock()
+
+
+def _database_path(db_conn: sqlite3.Connection) -> str:
+    for _, name, path in db_conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path
+    return ''
+
+
+def header_store(db_conn: sqlite3.Connection) -> HeaderStore:
+    path = _database_path(db_conn)
+    if not path:
+        return HeaderStore(db_conn)
+    with _lock:
+        cache = _caches.setdefault(path, FieldCache())
+    return HeaderStore(db_conn, cache)
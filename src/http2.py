@@ -0,0 +1,296 @@
+from http import HTTPStatus
+import time
+from typing import Callable
+
+try:
+    import hpack
+    from hyperframe.frame import (
+        ContinuationFrame,
+        DataFrame,
+        Frame,
+        HeadersFrame,
+        PushPromiseFrame,
+        RstStreamFrame,
+    )
+    from hyperframe.exceptions import HyperframeError
+except ImportError:
+    hpack = None
+
+from src.request import Request
+from src.response import Response
+import config
+
+
+# ALPN protocol lists; h2 is offered first so that it wins when both
+# sides support it
+H2 = 'h2'
+HTTP1 = 'http/1.1'
+H2_ALPN = (H2, HTTP1)
+
+CLIENT_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+FRAME_HEADER_SIZE = 9
+# a peer may only grow the HPACK table up to what the other side allowed;
+# the observer does not see which settings were acknowledged, so it
+# accepts any size a conforming peer could use
+MAX_HEADER_TABLE_SIZE = 2 ** 32 - 1
+MAX_HEADER_LIST_SIZE = 1024 * 1024
+
+# pseudo-header fields carry the request line and the status
+PSEUDO_PREFIX = ':'
+
+
+def is_available() -> bool:
+    return hpack is not None and config.HTTP2_ENABLED
+
+
+class Http2Error(ValueError):
+    pass
+
+
+class _Stream:
+    __slots__ = (
+        'request_headers',
+        'request_body',
+        'response_headers',
+        'response_body',
+        'sent_at',
+        'received_at',
+    )
+
+    def __init__(self) -> None:
+        self.request_headers: list[tuple[str, str]] | None = None
+        self.request_body = bytearray()
+        self.response_headers: list[tuple[str, str]] | None = None
+        self.response_body = bytearray()
+        self.sent_at: float | None = None
+        self.received_at: float | None = None
+
+
+class _Direction:
+    # frames of one direction of the connection; header blocks share one
+    # HPACK table per direction and must all be decoded in order
+    def __init__(self, preface: bytes = b'') -> None:
+        self.buffer = bytearray()
+        self.preface = preface
+        self.decoder = hpack.Decoder()
+        self.decoder.max_allowed_table_size = MAX_HEADER_TABLE_SIZE
+        self.decoder.max_header_list_size = MAX_HEADER_LIST_SIZE
+        # (stream id, promised stream id, end stream, fragments) of a
+        # header block waiting for its CONTINUATION frames
+        self.block = None
+
+    def frames(self, data: bytes):
+        self.buffer.extend(data)
+        if self.preface:
+            if len(self.buffer) < len(self.preface):
+                if not self.preface.startswith(bytes(self.buffer)):
+                    raise Http2Error('connection preface expected')
+                return
+            if not self.buffer.startswith(self.preface):
+                raise Http2Error('connection preface expected')
+            del self.buffer[:len(self.preface)]
+            self.preface = b''
+        offset = 0
+        try:
+            while len(self.buffer) - offset >= FRAME_HEADER_SIZE:
+                frame, length = Frame.parse_frame_header(memoryview(
+                    bytes(self.buffer[offset:offset + FRAME_HEADER_SIZE]),
+                ))
+                end = offset + FRAME_HEADER_SIZE + length
+                if end > len(self.buffer):
+                    break
+                frame.parse_body(memoryview(
+                    bytes(self.buffer[offset + FRAME_HEADER_SIZE:end]),
+                ))
+                offset = end
+                yield frame
+        except HyperframeError as e:
+            raise Http2Error(f'invalid frame: {e}') from e
+        finally:
+            del self.buffer[:offset]
+
+    def decode(self, fragments: list[bytes]) -> list[tuple[str, str]]:
+        try:
+            return [
+                (name, value)
+                for name, value in self.decoder.decode(b''.join(fragments))
+            ]
+        except hpack.HPACKError as e:
+            raise Http2Error(f'invalid header block: {e}') from e
+
+
+class Http2Observer:
+    # follows an HTTP/2 connection from the bytes relayed each way without
+    # taking part in it, and calls on_exchange(request, response) once the
+    # server ended a stream or either side reset it. The relay is never
+    # held up: after an error, observing stops and the bytes pass through.
+    def __init__(
+        self,
+        on_exchange: Callable[[Request, Response | None], None],
+        port: int = 443,
+    ) -> None:
+        self.on_exchange = on_exchange
+        self.port = port
+        self.streams: dict[int, _Stream] = {}
+        self.client = _Direction(CLIENT_PREFACE)
+        self.server = _Direction()
+        self.failed = False
+
+    def client_data(self, data: bytes):
+        self._feed(self.client, data, True)
+
+    def server_data(self, data: bytes):
+        self._feed(self.server, data, False)
+
+    def _feed(self, direction: _Direction, data: bytes, from_client: bool):
+        if self.failed:
+            return
+        try:
+            for frame in direction.frames(data):
+                self._on_frame(direction, frame, from_client)
+        except Http2Error as e:
+            print(f'cannot follow http/2 connection: {e}')
+            self.failed = True
+            self.streams.clear()
+
+    def _on_frame(self, direction: _Direction, frame, from_client: bool):
+        if direction.block is not None:
+            if not isinstance(frame, ContinuationFrame) \
+                    or frame.stream_id != direction.block[0]:
+                raise Http2Error('header block interrupted')
+            direction.block[3].append(frame.data)
+            if 'END_HEADERS' in frame.flags:
+                self._on_headers(direction, from_client)
+            return
+
+        if isinstance(frame, (HeadersFrame, PushPromiseFrame)):
+            promised = getattr(frame, 'promised_stream_id', None)
+            end_stream = 'END_STREAM' in frame.flags
+            direction.block = (frame.stream_id, promised, end_stream, [frame.data])
+            if 'END_HEADERS' in frame.flags:
+                self._on_headers(direction, from_client)
+        elif isinstance(frame, DataFrame):
+            stream = self.streams.get(frame.stream_id)
+            if stream is None:
+                return
+            if from_client:
+                stream.request_body.extend(frame.data)
+            else:
+                stream.response_body.extend(frame.data)
+            if 'END_STREAM' in frame.flags and not from_client:
+                self._finish(frame.stream_id)
+        elif isinstance(frame, RstStreamFrame):
+            self._finish(frame.stream_id)
+        elif isinstance(frame, ContinuationFrame):
+            raise Http2Error('CONTINUATION without a header block')
+
+    def _on_headers(self, direction: _Direction, from_client: bool):
+        stream_id, promised, end_stream, fragments = direction.block
+        direction.block = None
+        headers = direction.decode(fragments)
+
+        if promised is not None:
+            # a pushed response answers the request the server promised
+            stream = self.streams[promised] = _Stream()
+            stream.request_headers = headers
+            stream.sent_at = time.perf_counter()
+            return
+        if from_client:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                stream = self.streams[stream_id] = _Stream()
+                stream.request_headers = headers
+                stream.sent_at = time.perf_counter()
+            # otherwise these are request trailers
+            return
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            return
+        status = _pseudo(headers, ':status')
+        if stream.response_headers is None \
+                and status is not None and not status.startswith('1'):
+            stream.response_headers = headers
+            stream.received_at = time.perf_counter()
+        if end_stream:
+            self._finish(stream_id)
+
+    def _finish(self, stream_id: int):
+        stream = self.streams.pop(stream_id, None)
+        if stream is None or stream.request_headers is None:
+            return
+        try:
+            request = to_request(stream.request_headers, stream.request_body, self.port)
+            response = None
+            if stream.response_headers is not None:
+                response = to_response(stream.response_headers, stream.response_body)
+                response.duration = stream.received_at - stream.sent_at
+        except (ValueError, TypeError) as e:
+            print(f'cannot read http/2 stream {stream_id}: {e}')
+            return
+        self.on_exchange(request, response)
+
+
+def _pseudo(headers: list[tuple[str, str]], name: str) -> str | None:
+    for header, value in headers:
+        if header == name:
+            return value
+    return None
+
+
+def _regular(headers: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    return [
+        (name, value)
+        for name, value in headers
+        if not name.startswith(PSEUDO_PREFIX)
+    ]
+
+
+def to_request(
+    headers: list[tuple[str, str]],
+    body: bytes,
+    port: int = 443,
+) -> Request:
+    # the request as HTTP/1.1 would carry it: :authority becomes the Host
+    # header, and the target is split into path and query
+    authority = _pseudo(headers, ':authority')
+    fields = _regular(headers)
+    if authority is None:
+        authority = next(
+            (value for name, value in fields if name == 'host'),
+            None,
+        )
+    else:
+        fields.insert(0, ('host', authority))
+    if authority is None:
+        raise ValueError('request without authority')
+    host, _, authority_port = authority.rpartition(':')
+    if not host or not authority_port.isdigit():
+        host, authority_port = authority, port
+    path, _, query = (_pseudo(headers, ':path') or '/').partition('?')
+    return Request(
+        method=_pseudo(headers, ':method'),
+        host=host,
+        port=int(authority_port),
+        path=path,
+        query=query,
+        get_params=None,
+        header_fields=fields,
+        body=bytes(body) if body else None,
+        post_params=None,
+    )
+
+
+def to_response(headers: list[tuple[str, str]], body: bytes) -> Response:
+    code = int(_pseudo(headers, ':status'))
+    try:
+        message = HTTPStatus(code).phrase
+    except ValueError:
+        message = ''
+    return Response(
+        code=code,
+        message=message,
+        header_fields=_regular(headers),
+        set_cookie=None,
+        body=bytes(body),
+    )
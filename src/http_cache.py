@@ -0,0 +1,616 @@
+from collections import OrderedDict
+import copy
+from email.utils import parsedate_to_datetime
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from typing import Callable
+
+from src.encoding import get_header
+from src.metrics import Counter, Gauge
+from src.request import Request
+from src.response import Response
+import config
+
+
+HIT = 'hit'
+MISS = 'miss'
+REVALIDATED = 'revalidated'
+
+# RFC 9110 section 15.1: responses that may be stored without explicit
+# freshness information. 206 is left out: partial content is never
+# stored, since entries are served whole (RFC 9111 section 3.4)
+HEURISTICALLY_CACHEABLE = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+UNSAFE_METHODS = {'POST', 'PUT', 'DELETE', 'PATCH'}
+
+# RFC 9110 section 7.6.1 plus headers a cache must not store
+HOP_BY_HOP = {
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+}
+# headers of a 304 that must not replace the stored ones (RFC 9111 3.2)
+NOT_UPDATED_BY_304 = {'content-length', 'content-encoding', 'content-type'}
+
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 24 * 60 * 60
+
+# an entry larger than this share of the memory tier goes straight to disk
+MAX_MEMORY_ENTRY_FRACTION = 0.125
+META_LENGTH = struct.Struct('<I')
+
+
+HTTP_CACHE_LOOKUPS = Counter(
+    'proxy_http_cache_lookups_total',
+    'HTTP cache lookups by outcome.',
+    labelnames=('result',),
+)
+HTTP_CACHE_BYTES = Gauge(
+    'proxy_http_cache_bytes',
+    'Bytes held by the HTTP cache.',
+    labelnames=('tier',),
+)
+
+
+def parse_cache_control(value: str | None) -> dict[str, str | None]:
+    directives = {}
+    if not value:
+        return directives
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') if argument else None
+    return directives
+
+
+def _seconds(directives: dict, name: str) -> int | None:
+    value = directives.get(name)
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return None
+
+
+def _http_date(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _cache_key(request: Request) -> str:
+    key = f'{request.host.lower()}:{request.port}{request.path}'
+    if request.query:
+        key += f'?{request.query}'
+    return key
+
+
+def _vary_names(header_fields) -> tuple[str, ...]:
+    names = []
+    for name, value in header_fields:
+        if name.lower() == 'vary':
+            names.extend(
+                part.strip().lower() for part in value.split(',') if part.strip()
+            )
+    return tuple(sorted(set(names)))
+
+
+def _vary_values(request: Request, names: tuple[str, ...]) -> tuple:
+    return tuple(
+        ' '.join((get_header(request.headers, name) or '').split())
+        for name in names
+    )
+
+
+class CacheEntry:
+    __slots__ = (
+        'code',
+        'message',
+        'header_fields',
+        'body',
+        'vary_names',
+        'vary_values',
+        'request_time',
+        'response_time',
+        'corrected_initial_age',
+        'freshness_lifetime',
+        'no_cache',
+    )
+
+    def __init__(
+        self,
+        code: int,
+        message: str,
+        header_fields: list[tuple[str, str]],
+        body: bytes,
+        vary_names: tuple[str, ...],
+        vary_values: tuple,
+        request_time: float,
+        response_time: float,
+    ) -> None:
+        self.code = code
+        self.message = message
+        self.body = body
+        self.vary_names = vary_names
+        self.vary_values = vary_values
+        self.update(header_fields, request_time, response_time)
+
+    def update(self, header_fields, request_time: float, response_time: float):
+        self.header_fields = header_fields
+        self.request_time = request_time
+        self.response_time = response_time
+
+        # RFC 9111 section 4.2.3
+        date = _http_date(self.header('Date'))
+        apparent_age = max(0, response_time - date) if date else 0
+        try:
+            age = int(self.header('Age') or 0)
+        except ValueError:
+            age = 0
+        response_delay = response_time - request_time
+        self.corrected_initial_age = max(apparent_age, age + response_delay)
+
+        directives = parse_cache_control(self.header('Cache-Control'))
+        self.no_cache = 'no-cache' in directives
+        self.freshness_lifetime = self._freshness_lifetime(directives, date)
+
+    def header(self, name: str) -> str | None:
+        name = name.lower()
+        for field_name, value in self.header_fields:
+            if field_name.lower() == name:
+                return value
+        return None
+
+    def _freshness_lifetime(self, directives: dict, date: float | None) -> float:
+        # RFC 9111 section 4.2.1, as a shared cache
+        for name in ('s-maxage', 'max-age'):
+            seconds = _seconds(directives, name)
+            if seconds is not None:
+                return seconds
+
+        expires = self.header('Expires')
+        if expires is not None:
+            expires_at = _http_date(expires)
+            if expires_at is None:
+                return 0
+            return max(expires_at - (date or self.response_time), 0)
+
+        last_modified = _http_date(self.header('Last-Modified'))
+        if last_modified and self.code in HEURISTICALLY_CACHEABLE:
+            since = (date or self.response_time) - last_modified
+            return min(max(since, 0) * HEURISTIC_FRACTION, MAX_HEURISTIC_LIFETIME)
+        return 0
+
+    def current_age(self, now: float) -> float:
+        return self.corrected_initial_age + (now - self.response_time)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(
+            len(name) + len(value) for name, value in self.header_fields
+        ) + 64
+
+    def to_response(self, now: float) -> Response:
+        fields = [
+            field for field in self.header_fields
+            if field[0].lower() != 'age'
+        ]
+        fields.append(('Age', str(int(self.current_age(now)))))
+        return Response(
+            code=self.code,
+            message=self.message,
+            header_fields=fields,
+            body=self.body,
+            from_cache=True,
+        )
+
+    def to_meta(self) -> dict:
+        return {
+            'code': self.code,
+            'message': self.message,
+            'header_fields': self.header_fields,
+            'body_length': len(self.body),
+            'vary_names': self.vary_names,
+            'vary_values': self.vary_values,
+            'request_time': self.request_time,
+            'response_time': self.response_time,
+        }
+
+    @classmethod
+    def from_meta(cls, meta: dict, body: bytes) -> 'CacheEntry':
+        return cls(
+            meta['code'],
+            meta['message'],
+            [tuple(field) for field in meta['header_fields']],
+            body,
+            tuple(meta['vary_names']),
+            tuple(meta['vary_values']),
+            meta['request_time'],
+            meta['response_time'],
+        )
+
+
+def _storable_fields(response: Response) -> list[tuple[str, str]]:
+    fields = []
+    for name, value in response.header_fields:
+        lower = name.lower()
+        if lower in HOP_BY_HOP or lower == 'content-length':
+            continue
+        fields.append((name, value))
+    # the body is stored de-chunked, so hits are framed by length
+    fields.append(('Content-Length', str(len(response.body or b''))))
+    return fields
+
+
+def is_storable(request: Request, response: Response) -> bool:
+    # RFC 9111 section 3, as a shared cache that only stores GET
+    if request.method != 'GET' or response.body is None:
+        return False
+    # a 304 only freshens an entry; stored on its own it would answer
+    # clients that sent no validators with an empty body
+    if response.code == 304:
+        return False
+    # partial content would be served to clients asking for all of it
+    if response.code == 206 \
+            or get_header(request.headers, 'Range') is not None \
+            or get_header(response.headers, 'Content-Range') is not None:
+        return False
+    request_directives = parse_cache_control(
+        get_header(request.headers, 'Cache-Control'),
+    )
+    if 'no-store' in request_directives:
+        return False
+
+    directives = parse_cache_control(
+        get_header(response.headers, 'Cache-Control'),
+    )
+    if 'no-store' in directives or 'private' in directives:
+        return False
+    if '*' in _vary_names(response.header_fields):
+        return False
+    # a session cookie must not be handed to other clients
+    if get_header(response.headers, 'Set-Cookie') is not None \
+            and 'public' not in directives:
+        return False
+    if get_header(request.headers, 'Authorization') is not None and not (
+        'public' in directives
+        or 's-maxage' in directives
+        or 'must-revalidate' in directives
+    ):
+        return False
+
+    return (
+        'public' in directives
+        or 'max-age' in directives
+        or 's-maxage' in directives
+        or get_header(response.headers, 'Expires') is not None
+        or response.code in HEURISTICALLY_CACHEABLE
+    )
+
+
+class DiskStore:
+    # one file per cache key holding every stored variant: a little-endian
+    # uint32 length, the JSON metadata of the variants, then their bodies
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sizes: OrderedDict[str, int] = OrderedDict()
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.sizes[name] = size
+            self.total += size
+        HTTP_CACHE_BYTES.labels('disk').set(self.total)
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def load(self, key: str) -> list[CacheEntry] | None:
+        name = self._name(key)
+        if name not in self.sizes:
+            return None
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                data = f.read()
+            (meta_length,) = META_LENGTH.unpack_from(data)
+            metas = json.loads(data[META_LENGTH.size:META_LENGTH.size + meta_length])
+        except (OSError, ValueError, struct.error):
+            self.discard(key)
+            return None
+
+        self.sizes.move_to_end(name)
+        entries = []
+        offset = META_LENGTH.size + meta_length
+        for meta in metas:
+            body = data[offset:offset + meta['body_length']]
+            offset += meta['body_length']
+            entries.append(CacheEntry.from_meta(meta, body))
+        return entries
+
+    def save(self, key: str, entries: list[CacheEntry]):
+        name = self._name(key)
+        meta = json.dumps([entry.to_meta() for entry in entries]).encode()
+        path = os.path.join(self.directory, name)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(META_LENGTH.pack(len(meta)))
+            f.write(meta)
+            for entry in entries:
+                f.write(entry.body)
+            size = f.tell()
+        # workers of a pre-fork proxy share the directory, so files are
+        # replaced atomically
+        os.replace(tmp_path, path)
+
+        self.total += size - self.sizes.pop(name, 0)
+        self.sizes[name] = size
+        while self.total > self.max_bytes and self.sizes:
+            oldest, oldest_size = self.sizes.popitem(last=False)
+            self.total -= oldest_size
+            try:
+                os.remove(os.path.join(self.directory, oldest))
+            except FileNotFoundError:
+                pass
+        HTTP_CACHE_BYTES.labels('disk').set(self.total)
+
+    def discard(self, key: str):
+        name = self._name(key)
+        size = self.sizes.pop(name, None)
+        if size is None:
+            return
+        self.total -= size
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+        HTTP_CACHE_BYTES.labels('disk').set(self.total)
+
+
+class HTTPCache:
+    def __init__(
+        self,
+        memory_bytes: int = config.HTTP_CACHE_MEMORY_BYTES,
+        disk_dir: str | None = config.HTTP_CACHE_DIR,
+        disk_bytes: int = config.HTTP_CACHE_DISK_BYTES,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.memory_bytes = memory_bytes
+        self.clock = clock
+        self.memory: OrderedDict[str, list[CacheEntry]] = OrderedDict()
+        self.memory_total = 0
+        self.disk = DiskStore(disk_dir, disk_bytes) if disk_dir else None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entries_size(entries: list[CacheEntry]) -> int:
+        return sum(entry.size for entry in entries)
+
+    def _evict_memory(self):
+        # the least recently used keys are demoted to the disk tier
+        while self.memory_total > self.memory_bytes and self.memory:
+            key, entries = self.memory.popitem(last=False)
+            self.memory_total -= self._entries_size(entries)
+            if self.disk is not None:
+                self.disk.save(key, entries)
+        HTTP_CACHE_BYTES.labels('memory').set(self.memory_total)
+
+    def _get(self, key: str) -> list[CacheEntry] | None:
+        entries = self.memory.get(key)
+        if entries is not None:
+            self.memory.move_to_end(key)
+            return entries
+        if self.disk is None:
+            return None
+        entries = self.disk.load(key)
+        if entries is not None:
+            self._put(key, entries)
+        return entries
+
+    def _put(self, key: str, entries: list[CacheEntry]):
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_total -= self._entries_size(old)
+        if not entries:
+            if self.disk is not None:
+                self.disk.discard(key)
+            HTTP_CACHE_BYTES.labels('memory').set(self.memory_total)
+            return
+
+        size = self._entries_size(entries)
+        if size > self.memory_bytes * MAX_MEMORY_ENTRY_FRACTION:
+            if self.disk is not None:
+                self.disk.save(key, entries)
+            HTTP_CACHE_BYTES.labels('memory').set(self.memory_total)
+            return
+        self.memory[key] = entries
+        self.memory_total += size
+        self._evict_memory()
+
+    def lookup(self, request: Request) -> CacheEntry | None:
+        key = _cache_key(request)
+        with self._lock:
+            entries = self._get(key)
+        if not entries:
+            return None
+        for entry in entries:
+            if _vary_values(request, entry.vary_names) == entry.vary_values:
+                return entry
+        return None
+
+    def store(
+        self,
+        request: Request,
+        response: Response,
+        request_time: float,
+        response_time: float,
+    ) -> CacheEntry:
+        vary_names = _vary_names(response.header_fields)
+        entry = CacheEntry(
+            response.code,
+            response.message,
+            _storable_fields(response),
+            response.body,
+            vary_names,
+            _vary_values(request, vary_names),
+            request_time,
+            response_time,
+        )
+        key = _cache_key(request)
+        with self._lock:
+            entries = [
+                old for old in (self._get(key) or [])
+                if old.vary_names != entry.vary_names
+                or old.vary_values != entry.vary_values
+            ]
+            entries.append(entry)
+            self._put(key, entries)
+        return entry
+
+    def invalidate(self, request: Request):
+        with self._lock:
+            self._put(_cache_key(request), [])
+
+    def freshen(
+        self,
+        request: Request,
+        entry: CacheEntry,
+        not_modified: Response,
+        request_time: float,
+        response_time: float,
+    ):
+        updated = {
+            name.lower(): (name, value)
+            for name, value in not_modified.header_fields
+            if name.lower() not in HOP_BY_HOP
+            and name.lower() not in NOT_UPDATED_BY_304
+        }
+        fields = [
+            field for field in entry.header_fields
+            if field[0].lower() not in updated
+        ]
+        fields.extend(updated.values())
+        with self._lock:
+            entry.update(fields, request_time, response_time)
+            key = _cache_key(request)
+            # re-put so the disk copy and the sizes follow the new headers
+            entries = self._get(key)
+            if entries is not None:
+                self._put(key, entries)
+
+    @staticmethod
+    def _is_fresh(request: Request, entry: CacheEntry, now: float) -> bool:
+        if entry.no_cache:
+            return False
+        directives = parse_cache_control(
+            get_header(request.headers, 'Cache-Control'),
+        )
+        if 'no-cache' in directives or (
+            'cache-control' not in (name.lower() for name in request.headers)
+            and (get_header(request.headers, 'Pragma') or '').lower() == 'no-cache'
+        ):
+            return False
+
+        age = entry.current_age(now)
+        lifetime = entry.freshness_lifetime
+        max_age = _seconds(directives, 'max-age')
+        if max_age is not None:
+            lifetime = min(lifetime, max_age)
+        min_fresh = _seconds(directives, 'min-fresh')
+        if min_fresh is not None:
+            age += min_fresh
+        if age < lifetime:
+            return True
+
+        response_directives = parse_cache_control(entry.header('Cache-Control'))
+        if 'must-revalidate' in response_directives \
+                or 'proxy-revalidate' in response_directives \
+                or 's-maxage' in response_directives:
+            return False
+        if 'max-stale' in directives:
+            max_stale = _seconds(directives, 'max-stale')
+            return max_stale is None or age - lifetime <= max_stale
+        return False
+
+    @staticmethod
+    def _conditional(request: Request, entry: CacheEntry) -> Request:
+        headers = dict(request.headers)
+        etag = entry.header('ETag')
+        last_modified = entry.header('Last-Modified')
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        conditional = copy.copy(request)
+        conditional.headers = headers
+        return conditional
+
+    def fetch(
+        self,
+        request: Request,
+        send: Callable[[Request], Response],
+    ) -> Response:
+        if request.method in UNSAFE_METHODS:
+            response = send(request)
+            # RFC 9111 section 4.4
+            if response.code < 400:
+                self.invalidate(request)
+            return response
+        # ranges are not served from whole entries; RFC 9111 section 3.4
+        if request.method != 'GET' \
+                or get_header(request.headers, 'Range') is not None:
+            return send(request)
+
+        entry = self.lookup(request)
+        now = self.clock()
+        if entry is not None and self._is_fresh(request, entry, now):
+            HTTP_CACHE_LOOKUPS.labels(HIT).inc()
+            return entry.to_response(now)
+
+        has_validators = entry is not None and (
+            entry.header('ETag') is not None
+            or entry.header('Last-Modified') is not None
+        )
+        request_time = self.clock()
+        if has_validators:
+            response = send(self._conditional(request, entry))
+        else:
+            response = send(request)
+        response_time = self.clock()
+
+        if has_validators and response.code == 304:
+            HTTP_CACHE_LOOKUPS.labels(REVALIDATED).inc()
+            self.freshen(request, entry, response, request_time, response_time)
+            return entry.to_response(response_time)
+
+        HTTP_CACHE_LOOKUPS.labels(MISS).inc()
+        if is_storable(request, response):
+            self.store(request, response, request_time, response_time)
+        # a 304 to the client's own validators says nothing about the entry
+        elif entry is not None and response.code < 500 and response.code != 304:
+            self.invalidate(request)
+        return response
+
+
+http_cache = HTTPCache() if config.HTTP_CACHE_ENABLED else None
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import hashlib
+import threading
+from typing import Hashable
+
+import config
+
+
+def make_etag(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class JSONCache:
+    # serialised JSON of records that never change once written, kept in
+    # LRU order up to max_bytes together with their ETag
+    def __init__(self, max_bytes: int = config.API_JSON_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._entries: OrderedDict[Hashable, tuple[bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> tuple[bytes, str] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, body: bytes) -> tuple[bytes, str]:
+        entry = (body, make_etag(body))
+        # a single record may not push out most of the cache
+        if len(body) > self.max_bytes // 8:
+            return entry
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total -= len(previous[0])
+            self._entries[key] = entry
+            self.total += len(body)
+            while self.total > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.total -= len(evicted)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total = 0
@@ -0,0 +1,330 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+import time
+from typing import Callable
+
+import config
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+)
+
+INF = float('inf')
+
+
+def _format_value(value: float) -> str:
+    if value == INF:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value: str) -> str:
+    return (
+        value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    )
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{name}="{_escape_label(value)}"'
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+        self._lock = Lock()
+
+    def register(self, metric: 'Metric'):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = REGISTRY,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        if len(values) != len(self.labelnames):
+            raise ValueError(
+                f'{self.name} expects labels {self.labelnames}, '
+                f'got {values}'
+            )
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _unlabeled(self):
+        if self.labelnames:
+            raise ValueError(f'{self.name} requires labels {self.labelnames}')
+        return self._children[()]
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def samples(self) -> list[str]:
+        return [
+            f'{self.name}{_format_labels(self.labelnames, values)} '
+            f'{_format_value(child.get())}'
+            for values, child in self._items()
+        ]
+
+
+class _Value:
+    def __init__(self) -> None:
+        self._value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def get(self) -> float:
+        with self._lock:
+            return self._value
+
+    @contextmanager
+    def track_inprogress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class _CounterValue:
+    # only goes up, whether it is the counter itself or one of its labels
+    def __init__(self) -> None:
+        self._value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        if amount < 0:
+            raise ValueError('counters can only be incremented')
+        with self._lock:
+            self._value += amount
+
+    def get(self) -> float:
+        with self._lock:
+            return self._value
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self._unlabeled().inc(amount)
+
+    def get(self) -> float:
+        return self._unlabeled().get()
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = REGISTRY,
+        function: Callable[[], float] | None = None,
+    ) -> None:
+        self._function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._unlabeled().dec(amount)
+
+    def set(self, value: float):
+        self._unlabeled().set(value)
+
+    def get(self) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._unlabeled().get()
+
+    def track_inprogress(self):
+        return self._unlabeled().track_inprogress()
+
+    def samples(self) -> list[str]:
+        if self._function is not None:
+            return [f'{self.name} {_format_value(self._function())}']
+        return super().samples()
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> tuple[list[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = REGISTRY,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        buckets = tuple(sorted(buckets))
+        if buckets[-1] != INF:
+            buckets += (INF,)
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._unlabeled().observe(value)
+
+    def time(self):
+        return self._unlabeled().time()
+
+    def snapshot(self) -> tuple[list[int], float]:
+        return self._unlabeled().snapshot()
+
+    def samples(self) -> list[str]:
+        lines = []
+        for values, child in self._items():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames + ('le',),
+                    values + (_format_value(bound),),
+                )
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        body = self.registry.render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingMetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(
+    port: int = config.METRICS_PORT,
+    host: str = config.METRICS_HOST,
+    handler_class: type[BaseHTTPRequestHandler] = MetricsRequestHandler,
+) -> ThreadingMetricsServer:
+    server = ThreadingMetricsServer((host, port), handler_class)
+    thread = Thread(
+        target=server.serve_forever,
+        name='metrics-server',
+        daemon=True,
+    )
+    thread.start()
+    return server
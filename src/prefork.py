@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+from src.capture import QueueCapture, run_capture_writer
+from src.consts import NEW_LINE
+from src.db import enable_wal, init_db
+from src.metrics import start_metrics_server
+from src.profiler import ProfilerRequestHandler, install_signal_handlers
+from src.proxy import ProxyRequestHandler, ServerOptions, ThreadingProxy
+from src.remote_capture import RemoteCapture
+from src.retention import start_retention
+import config
+
+
+SUPERVISE_INTERVAL = 0.5
+# a worker that dies sooner than this after starting counts as a crash
+# loop and is restarted with exponential backoff
+MIN_WORKER_UPTIME = 5
+MAX_RESTART_BACKOFF = 30
+
+
+def _run_writer(capture_queue, db_path: str):
+    # the supervisor decides when to stop by sending None, so the writer
+    # keeps draining the queue while workers shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if config.CAPTURE_SINK == 'remote':
+        RemoteCapture(capture_queue).run()
+    else:
+        run_capture_writer(capture_queue, db_path)
+
+
+def _run_worker(
+    index: int,
+    port: int,
+    capture_queue,
+    grace: float,
+    options: ServerOptions | None,
+):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    install_signal_handlers()
+
+    server = ThreadingProxy(
+        ('', port),
+        ProxyRequestHandler,
+        QueueCapture(capture_queue),
+        reuse_port=True,
+        options=options,
+    )
+    metrics_server = start_metrics_server(
+        port=config.METRICS_PORT + 1 + index,
+        handler_class=ProfilerRequestHandler,
+    )
+    threading.Thread(
+        target=server.serve_forever,
+        name='proxy-accept',
+        daemon=True,
+    ).start()
+
+    stop.wait()
+
+    # stop accepting first so the kernel routes new connections to the
+    # remaining workers, then give in-flight tunnels time to finish
+    server.shutdown()
+    closer = threading.Thread(target=server.server_close, daemon=True)
+    closer.start()
+    closer.join(grace)
+    if closer.is_alive():
+        print(f'worker {index}: dropping connections still open after '
+              f'{grace}s')
+    metrics_server.shutdown()
+
+    capture_queue.close()
+    capture_queue.join_thread()
+    # handler threads that outlived the grace period must not keep the
+    # process alive
+    os._exit(0)
+
+
+class _WorkerSlot:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+
+
+class PreforkProxyServer:
+    def __init__(
+        self,
+        port: int = config.PROXY_PORT,
+        workers: int = config.PROXY_WORKERS,
+        grace: float = config.SHUTDOWN_GRACE_SECONDS,
+        options: ServerOptions | None = None,
+    ) -> None:
+        self.port = port
+        self.grace = grace
+        # worker pool and load shedding limits of each worker process
+        self.options = options
+        self.context = multiprocessing.get_context('fork')
+        self.capture_queue = self.context.Queue(config.CAPTURE_QUEUE_SIZE)
+        self.slots = [_WorkerSlot(index) for index in range(workers)]
+        self.writer = None
+        self._stopping = False
+        self.init_db()
+
+    def init_db(self):
+        db_conn = sqlite3.connect(config.DB)
+        init_db(db_conn)
+        enable_wal(db_conn)
+        db_conn.close()
+
+    def _start_writer(self):
+        self.writer = self.context.Process(
+            target=_run_writer,
+            args=(self.capture_queue, config.DB),
+            name='proxy-capture-writer',
+        )
+        self.writer.start()
+
+    def _start_worker(self, slot: _WorkerSlot):
+        slot.process = self.context.Process(
+            target=_run_worker,
+            args=(
+                slot.index,
+                self.port,
+                self.capture_queue,
+                self.grace,
+                self.options,
+            ),
+            name=f'proxy-worker-{slot.index}',
+        )
+        slot.process.start()
+        slot.started_at = time.monotonic()
+
+    def _supervise(self):
+        now = time.monotonic()
+        if not self.writer.is_alive():
+            print(f'capture writer exited with {self.writer.exitcode}, '
+                  'restarting')
+            self._start_writer()
+
+        for slot in self.slots:
+            if slot.process.is_alive():
+                continue
+
+            if slot.restart_at == 0.0:
+                print(f'worker {slot.index} (pid {slot.process.pid}) exited '
+                      f'with {slot.process.exitcode}')
+                if now - slot.started_at < MIN_WORKER_UPTIME:
+                    slot.failures += 1
+                else:
+                    slot.failures = 0
+                backoff = min(
+                    2 ** slot.failures - 1,
+                    MAX_RESTART_BACKOFF,
+                )
+                slot.restart_at = now + backoff
+
+            if now >= slot.restart_at:
+                slot.restart_at = 0.0
+                self._start_worker(slot)
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def shutdown(self):
+        for slot in self.slots:
+            if slot.process is not None and slot.process.is_alive():
+                slot.process.terminate()
+
+        deadline = time.monotonic() + self.grace + 5
+        for slot in self.slots:
+            if slot.process is None:
+                continue
+            slot.process.join(max(deadline - time.monotonic(), 0))
+            if slot.process.is_alive():
+                slot.process.kill()
+                slot.process.join()
+
+        # every worker has flushed its captures, let the writer drain them
+        self.capture_queue.put(None)
+        self.writer.join(self.grace + 5)
+        if self.writer.is_alive():
+            print('capture writer did not finish draining, killing it')
+            self.writer.kill()
+            self.writer.join()
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+
+        self._start_writer()
+        for slot in self.slots:
+            self._start_worker(slot)
+        # started after forking so the workers do not inherit the thread
+        retention_thread = start_retention()
+        print(
+            f'proxy server is running on port {self.port} '
+            f'with {len(self.slots)} workers'
+        )
+
+        try:
+            while not self._stopping:
+                time.sleep(SUPERVISE_INTERVAL)
+                if not self._stopping:
+                    self._supervise()
+        finally:
+            print(f'{NEW_LINE}stopping proxy workers')
+            retention_thread.stop()
+            self.shutdown()
+            print('proxy server is stopped')
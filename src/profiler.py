@@ -0,0 +1,173 @@
+from collections import Counter
+from http import HTTPStatus
+import os
+import signal
+import sys
+import threading
+import time
+
+from src.metrics import MetricsRequestHandler
+
+
+PROFILES_DIR = 'profiles'
+
+DEFAULT_INTERVAL = 0.02
+MAX_DEPTH = 64
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        interval: float = DEFAULT_INTERVAL,
+        max_depth: int = MAX_DEPTH,
+    ) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.sample_count = 0
+        self.started_at = None
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self.started_at = time.time()
+            self._thread = threading.Thread(
+                target=self._run,
+                name='sampling-profiler',
+                daemon=True,
+            )
+            self._thread.start()
+            return True
+
+    def stop(self) -> bool:
+        with self._lock:
+            if not self.running:
+                return False
+            self._stop.set()
+            thread = self._thread
+        thread.join()
+        return True
+
+    def toggle(self) -> bool:
+        if self.running:
+            self.stop()
+            return False
+        self.start()
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+            self.sample_count = 0
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = (
+                f'{code.co_name} '
+                f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            )
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stacks.append(tuple(stack))
+            del frames
+
+            with self._lock:
+                for stack in stacks:
+                    self.samples[stack] += 1
+                self.sample_count += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            samples = list(self.samples.items())
+        lines = []
+        for stack, count in samples:
+            frames = ';'.join(self._label(code) for code in reversed(stack))
+            lines.append(f'{frames} {count}')
+        lines.sort()
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def dump(self, directory: str = PROFILES_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory,
+            f'profile-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.folded',
+        )
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+        return path
+
+
+profiler = SamplingProfiler()
+
+
+def install_signal_handlers(profiler: SamplingProfiler = profiler):
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def toggle(signum, frame):
+        if profiler.toggle():
+            print('sampling profiler started')
+        else:
+            print(f'sampling profiler stopped, dumped to {profiler.dump()}')
+
+    def dump(signum, frame):
+        print(f'sampling profile dumped to {profiler.dump()}')
+
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, dump)
+
+
+class ProfilerRequestHandler(MetricsRequestHandler):
+    profiler = profiler
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] == '/debug/profile':
+            self._send_text(self.profiler.collapsed())
+            return
+        super().do_GET()
+
+    def do_POST(self):
+        action = self.path.split('?', 1)[0]
+        if action == '/debug/profile/start':
+            started = self.profiler.start()
+            self._send_text('started\n' if started else 'already running\n')
+        elif action == '/debug/profile/stop':
+            stopped = self.profiler.stop()
+            self._send_text('stopped\n' if stopped else 'not running\n')
+        elif action == '/debug/profile/reset':
+            self.profiler.reset()
+            self._send_text('reset\n')
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    def _send_text(self, text: str):
+        body = text.encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,13 +1,18 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import functools
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from http.client import HTTPConnection, HTTPSConnection, InvalidURL
-import os
+import queue
 import select
 import socket
-from socketserver import BaseRequestHandler, ThreadingMixIn
+from socketserver import BaseRequestHandler
 import sqlite3
 import ssl
-from threading import Lock
+import struct
+import threading
+import time
 from typing import Any, Callable
 
 import httptools
@@ -16,46 +21,387 @@ import httptools
 from src.response import Response
 from src.request import Request
 from src.consts import COLON, NEW_LINE
-from src.cert_utils import CERTS_DIR, SERIAL_NUMBERS_DIR, generate_host_certificate
+from src.analysis import start_analysis
+from src.cert_store import cert_store
+from src.capture import SQLiteCapture
+from src.capture_rules import capture_rules
+from src.db import enable_wal, init_db
+from src.deadlines import (
+    TIMEOUTS,
+    Deadline,
+    DeadlineResponse,
+    StageTimeout,
+    Timeouts,
+)
+from src.dns_cache import create_connection
+from src.encoding import get_header
+from src.http_cache import http_cache
+from src import http2
+from src.metrics import Counter, Gauge, Histogram, start_metrics_server
+from src.profiler import ProfilerRequestHandler, install_signal_handlers
+from src.remote_capture import RemoteCapture
+from src.retention import start_retention
+from src import tracing
+from src.websocket import (
+    CLIENT,
+    SERVER,
+    WebSocketStream,
+    is_upgrade,
+    is_websocket,
+    new_stream_id,
+)
 import config
 
 BUFSIZE = 4096
+MAX_UPGRADE_HEAD_SIZE = 64 * 1024
+SWITCHING_PROTOCOLS_LINE = b'HTTP/1.1 101'
 
 
-lock = Lock()
+UPSTREAM_CONNECT_SECONDS = Histogram(
+    'proxy_upstream_connect_seconds',
+    'Time spent opening a TCP connection to the upstream host.',
+)
+UPSTREAM_TLS_HANDSHAKE_SECONDS = Histogram(
+    'proxy_upstream_tls_handshake_seconds',
+    'Time spent in the TLS handshake with the upstream host.',
+)
+CLIENT_TLS_HANDSHAKE_SECONDS = Histogram(
+    'proxy_client_tls_handshake_seconds',
+    'Time spent in the intercepting TLS handshake with the client.',
+)
+UPSTREAM_ROUNDTRIP_SECONDS = Histogram(
+    'proxy_upstream_roundtrip_seconds',
+    'Time from sending a request upstream to reading the full response.',
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+TUNNEL_BYTES = Counter(
+    'proxy_tunnel_bytes_total',
+    'Bytes relayed through CONNECT tunnels.',
+    labelnames=('direction',),
+)
+REQUESTS = Counter(
+    'proxy_requests_total',
+    'Requests accepted by the proxy.',
+    labelnames=('kind',),
+)
+ERRORS = Counter(
+    'proxy_errors_total',
+    'Requests that failed, by pipeline stage.',
+    labelnames=('stage',),
+)
+ACTIVE_CONNECTIONS = Gauge(
+    'proxy_active_connections',
+    'Client connections currently being handled.',
+)
+THREADS = Gauge(
+    'proxy_threads',
+    'Threads alive in the proxy process.',
+    function=threading.active_count,
+)
+QUEUED_CONNECTIONS = Gauge(
+    'proxy_queued_connections',
+    'Accepted client connections waiting for a worker thread.',
+)
+BUSY_WORKERS = Gauge(
+    'proxy_busy_workers',
+    'Worker threads currently handling a client connection.',
+)
+SHED_CONNECTIONS = Counter(
+    'proxy_shed_connections_total',
+    'Client connections turned away under load, by reason.',
+    labelnames=('reason',),
+)
 
+TUNNEL_PROTOCOLS = Counter(
+    'proxy_tunnel_protocols_total',
+    'Intercepted tunnels by the protocol spoken inside them.',
+    labelnames=('protocol',),
+)
 
-class ThreadingProxy(ThreadingMixIn, HTTPServer):
+CLIENT_TO_UPSTREAM = TUNNEL_BYTES.labels('client_to_upstream')
+UPSTREAM_TO_CLIENT = TUNNEL_BYTES.labels('upstream_to_client')
+
+
+def _ignore(data: bytes):
+    pass
+
+
+# upstream TLS contexts, by whether they offer h2; loading the CA store
+# makes creating one expensive
+_upstream_contexts: dict[bool, ssl.SSLContext] = {}
+
+
+def upstream_context(offer_h2: bool = False) -> ssl.SSLContext:
+    context = _upstream_contexts.get(offer_h2)
+    if context is None:
+        context = ssl.create_default_context(cafile=config.UPSTREAM_CA_FILE)
+        if offer_h2:
+            context.set_alpn_protocols(list(http2.H2_ALPN))
+        context = _upstream_contexts.setdefault(offer_h2, context)
+    return context
+
+
+# whether an upstream (host, port) chose h2 when it was offered; hosts
+# known to take it get their TLS handshake after the client picked a
+# protocol, so an HTTP/1.1 client costs no second upstream connection
+UPSTREAM_ALPN_CACHE_SIZE = 10000
+_upstream_h2: OrderedDict[tuple[str, int], bool] = OrderedDict()
+_upstream_h2_lock = threading.Lock()
+
+
+def upstream_takes_h2(host: str, port: int) -> bool | None:
+    with _upstream_h2_lock:
+        takes_h2 = _upstream_h2.get((host, port))
+        if takes_h2 is not None:
+            _upstream_h2.move_to_end((host, port))
+        return takes_h2
+
+
+def remember_upstream_h2(host: str, port: int, takes_h2: bool):
+    with _upstream_h2_lock:
+        _upstream_h2[(host, port)] = takes_h2
+        _upstream_h2.move_to_end((host, port))
+        if len(_upstream_h2) > UPSTREAM_ALPN_CACHE_SIZE:
+            _upstream_h2.popitem(last=False)
+
+
+SHED_POLICIES = ('503', 'refuse')
+
+
+@dataclass
+class ServerOptions:
+    # at most max_workers connections are handled at once; accepted
+    # connections wait for a worker in a queue of queue_depth
+    max_workers: int = config.PROXY_MAX_WORKERS
+    queue_depth: int = config.PROXY_QUEUE_DEPTH
+    # connections the kernel completes before they are accepted
+    backlog: int = config.PROXY_ACCEPT_BACKLOG
+    # connections one client IP may have queued or in progress, 0 for no
+    # limit
+    max_connections_per_ip: int = config.PROXY_MAX_CONNECTIONS_PER_IP
+    # what a connection over the limits gets: '503' or 'refuse'
+    shed_policy: str = config.PROXY_SHED_POLICY
+    retry_after: int = config.PROXY_SHED_RETRY_AFTER_SECONDS
+    timeouts: Timeouts = field(default_factory=Timeouts)
+
+    def __post_init__(self):
+        if self.shed_policy not in SHED_POLICIES:
+            raise ValueError(
+                f'unknown shed policy {self.shed_policy!r}, '
+                f'expected one of {", ".join(SHED_POLICIES)}'
+            )
+        if self.max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+
+
+class ThreadingProxy(HTTPServer):
+    # connections are handed to a bounded pool of worker threads, started
+    # on demand. When every worker is busy they wait in a bounded queue,
+    # and what does not fit is shed right in the accept loop, so a flood
+    # of clients costs neither threads nor memory and the connections
+    # already accepted keep their latency.
     def __init__(
             self,
             server_address: tuple[str | bytes | bytearray, int],
             RequestHandlerClass: Callable[[Any, Any, Any], BaseRequestHandler],
-            db_conn,
+            capture,
             bind_and_activate: bool = True,
+            reuse_port: bool = False,
+            options: ServerOptions | None = None,
     ) -> None:
-        self.db_conn = db_conn
+        self.capture = capture
+        self.reuse_port = reuse_port
+        self.options = options if options is not None else ServerOptions()
+        # listen() backlog, read by server_activate
+        self.request_queue_size = self.options.backlog
+        self._accepted_at = {}
+        self._queue = queue.Queue(self.options.queue_depth)
+        self._workers: list[threading.Thread] = []
+        self._idle_workers = 0
+        self._per_ip: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._shed_response = (
+            'HTTP/1.1 503 Service Unavailable\r\n'
+            f'Retry-After: {self.options.retry_after}\r\n'
+            'Content-Length: 0\r\n'
+            'Connection: close\r\n\r\n'
+        ).encode()
         super().__init__(
             server_address,
             RequestHandlerClass,
             bind_and_activate,
         )
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def _admit(self, client_ip: str) -> bool:
+        limit = self.options.max_connections_per_ip
+        with self._lock:
+            count = self._per_ip.get(client_ip, 0)
+            if limit and count >= limit:
+                return False
+            self._per_ip[client_ip] = count + 1
+            return True
+
+    def _release(self, client_ip: str):
+        with self._lock:
+            count = self._per_ip.pop(client_ip) - 1
+            if count:
+                self._per_ip[client_ip] = count
+
+    def _shed(self, request: socket.socket, reason: str):
+        SHED_CONNECTIONS.labels(reason).inc()
+        try:
+            if self.options.shed_policy == 'refuse':
+                # a zero linger timeout makes close() send a reset
+                request.setsockopt(
+                    socket.SOL_SOCKET,
+                    socket.SO_LINGER,
+                    struct.pack('ii', 1, 0),
+                )
+            else:
+                # the accept loop must never block on a slow client
+                request.setblocking(False)
+                request.send(self._shed_response)
+                # closing with unread data would reset the connection and
+                # could discard the response before the client reads it
+                while request.recv(BUFSIZE):
+                    pass
+        except OSError:
+            pass
+        finally:
+            request.close()
+
+    def process_request(self, request, client_address):
+        client_ip = client_address[0]
+        if not self._admit(client_ip):
+            self._shed(request, 'per_ip')
+            return
+
+        self._accepted_at[request] = time.perf_counter()
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            self._accepted_at.pop(request, None)
+            self._release(client_ip)
+            self._shed(request, 'queue_full')
+            return
+        QUEUED_CONNECTIONS.inc()
+
+        with self._lock:
+            if (
+                self._queue.qsize() <= self._idle_workers
+                or len(self._workers) >= self.options.max_workers
+            ):
+                return
+            worker = threading.Thread(
+                target=self._work,
+                name=f'proxy-handler-{len(self._workers)}',
+                daemon=True,
+            )
+            self._workers.append(worker)
+            # counted as idle until it takes its first connection
+            self._idle_workers += 1
+        worker.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            with self._lock:
+                self._idle_workers -= 1
+            QUEUED_CONNECTIONS.dec()
+            request, client_address = item
+            BUSY_WORKERS.inc()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self._release(client_address[0])
+                self.shutdown_request(request)
+                BUSY_WORKERS.dec()
+                with self._lock:
+                    self._idle_workers += 1
+
     def finish_request(self, request, client_address):
-        self.RequestHandlerClass(
-            request,
-            client_address,
-            self,
-            self.db_conn,
-        )
+        accepted_at = self._accepted_at.pop(request, None)
+        trace = tracing.start_trace(client_address, accepted_at)
+        if accepted_at is not None:
+            # includes the time spent waiting for a worker
+            trace.add_span('accept', accepted_at, time.perf_counter())
+        try:
+            self.RequestHandlerClass(
+                request,
+                client_address,
+                self,
+                self.capture,
+            )
+        finally:
+            tracing.end_trace()
+            if len(trace.spans) > 1:
+                try:
+                    self.capture.save_trace(trace)
+                except sqlite3.Error as e:
+                    print(f'cannot save trace {trace.trace_id}: {e}')
+
+    def shutdown_request(self, request):
+        self._accepted_at.pop(request, None)
+        super().shutdown_request(request)
+
+    def server_close(self):
+        # connections still queued are served before the workers stop
+        super().server_close()
+        with self._lock:
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
 
 
 class ProxyRequestHandler(BaseHTTPRequestHandler):
     protocol_version = "HTTP/1.1"
 
-    def __init__(self, request, client_address, server, db_conn):
-        self.db_conn = db_conn
+    def __init__(self, request, client_address, server, capture):
+        self.capture = capture
         super().__init__(request, client_address, server)
 
+    def setup(self):
+        ACTIVE_CONNECTIONS.inc()
+        self.timeouts = self.server.options.timeouts
+        # applies to every read and write on the client connection
+        self.timeout = self.timeouts.client_idle
+        super().setup()
+
+    def handle(self):
+        self.close_connection = True
+        while self._wait_for_request():
+            self.handle_one_request()
+            if self.close_connection:
+                break
+
+    def _wait_for_request(self) -> bool:
+        # a client that keeps its connection open without sending the next
+        # request gives its worker back after client_idle
+        try:
+            return bool(self.rfile.peek(1))
+        except socket.timeout:
+            TIMEOUTS.labels('client_idle').inc()
+        except OSError:
+            pass
+        return False
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            ACTIVE_CONNECTIONS.dec()
+
     def do_GET(self):
         self.handle_request()
 
@@ -73,119 +419,485 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         self.close_connection = True
 
     def handle_connect_request(self):
+        REQUESTS.labels('connect').inc()
         host, port = self.path.split(COLON)
         port = int(port)
 
+        # the client is offered h2 only when the upstream host took it,
+        # since the tunnel relays one protocol end to end
+        offer_h2 = http2.is_available()
+        known_h2 = offer_h2 and upstream_takes_h2(host, port) is True
+        deadline = Deadline(self.timeouts.request)
+        try:
+            # for a host known to take h2 only TCP is connected here, so
+            # unreachable hosts are still reported on the CONNECT
+            target_conn = self._open_upstream(
+                host,
+                port,
+                deadline,
+                offer_h2,
+                handshake=not known_h2,
+            )
+        except (StageTimeout, socket.error):
+            return
+        if known_h2:
+            upstream_h2 = True
+        else:
+            upstream_h2 = target_conn.selected_alpn_protocol() == http2.H2
+            if offer_h2:
+                remember_upstream_h2(host, port, upstream_h2)
+
         try:
-            cert_path, key_path = generate_host_certificate(host)
+            with tracing.span('cert'):
+                client_context = cert_store.context_for(
+                    host,
+                    http2.H2_ALPN if upstream_h2 else (),
+                )
         except Exception as e:
             # print('error:', e)
+            ERRORS.labels('cert_generation').inc()
+            target_conn.close()
             self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
             raise e
 
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+
         try:
-            target_context = ssl.create_default_context()
-            target_conn = target_context.wrap_socket(
-                socket.create_connection((host, port)),
-                server_hostname=host,
+            with tracing.span('handshake'), CLIENT_TLS_HANDSHAKE_SECONDS.time():
+                with deadline.stage(
+                    'client_tls_handshake',
+                    self.timeouts.tls_handshake,
+                ) as timeout:
+                    self.connection.settimeout(timeout)
+                    client_conn = client_context.wrap_socket(
+                        self.connection,
+                        server_side=True,
+                    )
+        except Exception as e:
+            ERRORS.labels('client_tls_handshake').inc()
+            target_conn.close()
+            print(
+                'something went wrong while wrapping client connection: ',
+                e
             )
+            return
+
+        client_h2 = client_conn.selected_alpn_protocol() == http2.H2
+        try:
+            if known_h2:
+                try:
+                    with tracing.span('upstream'):
+                        target_conn = self._upstream_handshake(
+                            target_conn,
+                            host,
+                            deadline,
+                            client_h2,
+                        )
+                except (StageTimeout, socket.error):
+                    ERRORS.labels('upstream_connect').inc()
+                    return
+                if client_h2 and target_conn.selected_alpn_protocol() != http2.H2:
+                    # the host no longer takes h2; the client's next
+                    # tunnel gets HTTP/1.1
+                    remember_upstream_h2(host, port, False)
+                    ERRORS.labels('upstream_connect').inc()
+                    return
+            elif upstream_h2 and not client_h2:
+                # the client only speaks HTTP/1.1, so the upstream
+                # connection is opened again without h2
+                target_conn.close()
+                try:
+                    with tracing.span('upstream'):
+                        target_conn = self._connect_upstream(host, port, deadline)
+                except (StageTimeout, socket.error):
+                    ERRORS.labels('upstream_connect').inc()
+                    return
+            record = not capture_rules.skips_host(host)
+            if client_h2:
+                TUNNEL_PROTOCOLS.labels('h2').inc()
+                self._h2_tunnel(client_conn, target_conn, port, record)
+            else:
+                TUNNEL_PROTOCOLS.labels('http/1.1').inc()
+                self._ssl_tunnel(client_conn, target_conn, record=record)
+        except EOFError:
+            pass
+        finally:
+            client_conn.close()
+            target_conn.close()
+
+    def _open_upstream(
+        self,
+        host: str,
+        port: int,
+        deadline: Deadline,
+        offer_h2: bool,
+        handshake: bool = True,
+    ) -> socket.socket:
+        # answers the CONNECT with an error when the upstream host cannot
+        # be reached
+        try:
+            with tracing.span('upstream'):
+                if not handshake:
+                    return self._connect_tcp(host, port, deadline)
+                return self._connect_upstream(host, port, deadline, offer_h2)
+        except StageTimeout:
+            ERRORS.labels('upstream_connect').inc()
+            err = HTTPStatus.GATEWAY_TIMEOUT
+            self.send_error(
+                err.value,
+                f"Timed out connecting to '{host}:{port}'",
+                err.description,
+            )
+            raise
         except socket.error:
+            ERRORS.labels('upstream_connect').inc()
             err = HTTPStatus.BAD_GATEWAY
             self.send_error(
                 err.value,
                 f"Cannot connect to '{host}:{port}'",
                 err.description,
             )
-            return
+            raise
 
-        self.send_response(200, 'Connection established')
-        self.end_headers()
+    def _connect_upstream(
+        self,
+        host: str,
+        port: int,
+        deadline: Deadline,
+        offer_h2: bool = False,
+    ) -> ssl.SSLSocket:
+        sock = self._connect_tcp(host, port, deadline)
+        return self._upstream_handshake(sock, host, deadline, offer_h2)
+
+    def _connect_tcp(
+        self,
+        host: str,
+        port: int,
+        deadline: Deadline,
+    ) -> socket.socket:
+        with UPSTREAM_CONNECT_SECONDS.time():
+            with deadline.stage('connect', self.timeouts.connect) as timeout:
+                return create_connection((host, port), timeout)
 
+    def _upstream_handshake(
+        self,
+        sock: socket.socket,
+        host: str,
+        deadline: Deadline,
+        offer_h2: bool = False,
+    ) -> ssl.SSLSocket:
+        # closes the socket when the handshake fails
         try:
-            client_context = ssl.create_default_context(
-                ssl.Purpose.CLIENT_AUTH)
-            client_context.load_cert_chain(
-                certfile=cert_path, keyfile=key_path)
-            client_conn = client_context.wrap_socket(
-                self.connection,
-                server_side=True,
-            )
-        except Exception as e:
-            target_conn.close()
-            print(
-                'something went wrong while wrapping client connection: ',
-                e
-            )
+            target_context = upstream_context(offer_h2)
+            with UPSTREAM_TLS_HANDSHAKE_SECONDS.time():
+                with deadline.stage(
+                    'tls_handshake',
+                    self.timeouts.tls_handshake,
+                ) as timeout:
+                    sock.settimeout(timeout)
+                    return target_context.wrap_socket(
+                        sock,
+                        server_hostname=host,
+                    )
+        except BaseException:
+            sock.close()
+            raise
+
+    def _h2_tunnel(
+        self,
+        client_conn: ssl.SSLSocket,
+        target_conn: ssl.SSLSocket,
+        port: int,
+        record: bool = True,
+    ):
+        # both sides spoke h2, so streams stay multiplexed over the one
+        # connection each way and are captured one by one as they end
+        trace_id = tracing.current_trace_id()
+
+        def on_exchange(request: Request, response: Response | None):
+            request.trace_id = trace_id
+            self._capture_exchange(request, response, True)
+
+        if record:
+            observer = http2.Http2Observer(on_exchange, port)
+            on_client_data, on_upstream_data = observer.client_data, observer.server_data
         else:
-            try:
-                self._ssl_tunnel(client_conn, target_conn)
-            except EOFError:
-                pass
-            finally:
-                client_conn.close()
-                target_conn.close()
+            on_client_data = on_upstream_data = _ignore
 
-        try:
-            os.remove(cert_path)
-        except FileNotFoundError:
-            pass
+        relay_start = time.perf_counter()
+        self._relay(client_conn, target_conn, on_client_data, on_upstream_data)
+        trace = tracing.current_trace()
+        if trace is not None:
+            trace.add_span('relay', relay_start, time.perf_counter())
 
     def _ssl_tunnel(
         self,
         client_conn: ssl.SSLSocket,
         target_conn: ssl.SSLSocket,
+        record: bool = True,
     ):
-        inputs = [client_conn, target_conn]
-        keep_running = True
+        # tunnels to hosts that are never captured are relayed without
+        # buffering their traffic
+        raw_request = bytearray()
+        raw_response = bytearray()
+        # set once the tunnelled connection switched protocols
+        checking = True
+        upgraded = False
+        stream = None
+        # the first bytes each way time the wait for the response
+        sent_at = received_at = None
+
+        def on_client_data(data: bytes):
+            nonlocal sent_at
+            if stream is not None:
+                stream.feed(CLIENT, data)
+            elif record and not upgraded:
+                if sent_at is None:
+                    sent_at = time.perf_counter()
+                raw_request.extend(data)
 
-        raw_request = b''
-        raw_response = b''
+        def on_upstream_data(data: bytes):
+            nonlocal checking, upgraded, stream, received_at
+            if stream is not None:
+                stream.feed(SERVER, data)
+            elif record and not upgraded:
+                if received_at is None:
+                    received_at = time.perf_counter()
+                raw_response.extend(data)
+                if checking:
+                    result = self._check_upgrade(raw_request, raw_response)
+                    if result is not None:
+                        checking = False
+                        upgraded, stream = result
 
+        relay_start = time.perf_counter()
+        self._relay(client_conn, target_conn, on_client_data, on_upstream_data)
+        trace = tracing.current_trace()
+        if trace is not None:
+            trace.add_span('relay', relay_start, time.perf_counter())
+
+        if stream is not None:
+            stream.close()
+        if upgraded or not raw_request:
+            return
+
+        try:
+            with tracing.span('parse'):
+                request = Request.from_raw_request(bytes(raw_request))
+            request.trace_id = tracing.current_trace_id()
+        except ValueError:
+            print('invalid http request headers')
+        except AttributeError:
+            print('cannot save request to db')
+        else:
+            try:
+                with tracing.span('parse'):
+                    response = Response.from_raw_response(bytes(raw_response))
+            except (ValueError, httptools.HttpParserError):
+                response = None
+            if response is not None and sent_at is not None and received_at is not None:
+                response.duration = received_at - sent_at
+            self._capture_exchange(request, response, True)
+
+    def _relay(
+        self,
+        client_conn: socket.socket,
+        target_conn: socket.socket,
+        on_client_data: Callable[[bytes], Any],
+        on_upstream_data: Callable[[bytes], Any],
+    ):
+        inputs = [client_conn, target_conn]
+        idle_timeout = self.timeouts.tunnel_idle
+        # also bounds sendall to a peer that stopped reading
+        for sock in inputs:
+            sock.settimeout(idle_timeout)
+        keep_running = True
         while keep_running:
-            readable, _, exceptional = select.select(inputs, [], inputs, 1)
+            readable, _, exceptional = select.select(
+                inputs,
+                [],
+                inputs,
+                idle_timeout,
+            )
             if exceptional:
                 break
+            if not readable:
+                TIMEOUTS.labels('tunnel_idle').inc()
+                break
 
             for sock in readable:
                 other = target_conn if sock is client_conn else client_conn
                 try:
-                    data = sock.recv(BUFSIZE)
-                    if data:
-                        if sock is client_conn:
-                            raw_request += data
-                        elif sock is target_conn:
-                            raw_response += data
-                        other.sendall(data)
-                    else:
+                    data = self._recv_ready(sock)
+                    if data is None:
+                        continue
+                    if not data:
                         keep_running = False
                         break
+                    other.sendall(data)
                 except socket.error:
                     keep_running = False
                     break
+                if sock is client_conn:
+                    CLIENT_TO_UPSTREAM.inc(len(data))
+                    on_client_data(data)
+                else:
+                    UPSTREAM_TO_CLIENT.inc(len(data))
+                    on_upstream_data(data)
+
+    @staticmethod
+    def _recv_ready(sock: socket.socket) -> bytes | None:
+        # None when select woke up for a TLS record without application
+        # data, such as a TLS 1.3 session ticket; a blocking read would
+        # then stall the other direction
+        if not isinstance(sock, ssl.SSLSocket):
+            return sock.recv(BUFSIZE)
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            data = sock.recv(BUFSIZE)
+            # the rest of a TLS record is already decrypted and would not
+            # wake select up
+            while sock.pending():
+                data += sock.recv(sock.pending())
+        except ssl.SSLWantReadError:
+            return None
+        finally:
+            sock.settimeout(timeout)
+        return data
+
+    def _check_upgrade(
+        self,
+        raw_request: bytearray,
+        raw_response: bytearray,
+    ) -> tuple[bool, WebSocketStream | None] | None:
+        # only the first response of a tunnel is looked at: an upgrade
+        # takes over the connection, so it is always its last exchange.
+        # None means the status line has not fully arrived yet.
+        if not raw_response.startswith(SWITCHING_PROTOCOLS_LINE):
+            if SWITCHING_PROTOCOLS_LINE.startswith(raw_response):
+                return None
+            return False, None
+        response_end = raw_response.find(b'\r\n\r\n')
+        if response_end == -1:
+            return None
+        request_end = raw_request.find(b'\r\n\r\n')
+        if request_end == -1:
+            return True, None
+
+        try:
+            with tracing.span('parse'):
+                request = Request.from_raw_request(
+                    bytes(raw_request[:request_end + 4]),
+                )
+                response = Response.from_raw_response(
+                    bytes(raw_response[:response_end + 4]),
+                )
+        except (ValueError, AttributeError, httptools.HttpParserError):
+            return True, None
+        request.trace_id = tracing.current_trace_id()
+
+        stream = self._start_stream(request, response, True)
+        if stream is not None:
+            stream.feed(CLIENT, bytes(raw_request[request_end + 4:]))
+            stream.feed(SERVER, bytes(raw_response[response_end + 4:]))
+        return True, stream
 
-        if raw_request != b'':
+    def _start_stream(
+        self,
+        request: Request,
+        response: Response,
+        is_https: bool = False,
+    ) -> WebSocketStream | None:
+        if not is_websocket(response.headers):
+            self._capture_exchange(request, response, is_https)
+            return None
+        stream_id = new_stream_id()
+        if not self._capture_exchange(request, response, is_https, stream_id):
+            return None
+        return WebSocketStream(
+            self.capture,
+            stream_id,
+            get_header(response.headers, 'Sec-WebSocket-Extensions'),
+        )
+
+    def _relay_upgrade(self, request: Request):
+        # http.client cannot hand over the connection after a 101, so the
+        # handshake is written and read by hand
+        deadline = Deadline(self.timeouts.request)
+        with tracing.span('upstream'):
+            with deadline.stage('connect', self.timeouts.connect) as timeout:
+                target_conn = create_connection(
+                    (request.host, request.port),
+                    timeout,
+                )
+        try:
+            target = request.path
+            if request.query:
+                target += f'?{request.query}'
+            head = f'{request.method} {target} HTTP/1.1{NEW_LINE}'
+            for name, value in request.header_fields:
+                if name.lower() != 'proxy-connection':
+                    head += f'{name}: {value}{NEW_LINE}'
+            raw_response = b''
+            with deadline.stage('first_byte', self.timeouts.first_byte) as timeout:
+                target_conn.settimeout(timeout)
+                target_conn.sendall(
+                    (head + NEW_LINE).encode('latin-1') + (request.body or b''),
+                )
+                while b'\r\n\r\n' not in raw_response:
+                    data = target_conn.recv(BUFSIZE)
+                    if not data:
+                        break
+                    raw_response += data
+                    if len(raw_response) > MAX_UPGRADE_HEAD_SIZE:
+                        break
+            self.wfile.write(raw_response)
+            self.wfile.flush()
+            UPSTREAM_TO_CLIENT.inc(len(raw_response))
+
+            head_end = raw_response.find(b'\r\n\r\n')
             try:
-                request = Request.from_raw_request(raw_request)
-                with lock:
-                    request_id = request.save_to_db(self.db_conn, True)
-            except ValueError:
-                print('invalid http request headers')
-            except httptools.parser.errors.HttpParserUpgrade:
-                print('cannot save request to db')
-            except AttributeError:
-                print('cannot save request to db')
+                with tracing.span('parse'):
+                    response = Response.from_raw_response(
+                        raw_response[:head_end + 4],
+                    )
+            except (ValueError, httptools.HttpParserError):
+                self._capture_exchange(request)
+                return
+
+            stream = None
+            if response.code == HTTPStatus.SWITCHING_PROTOCOLS:
+                stream = self._start_stream(request, response)
             else:
-                try:
-                    response = Response.from_raw_response(raw_response)
-                    with lock:
-                        response.save_to_db(request_id, self.db_conn)
-                except ValueError:
-                    pass
+                self._capture_exchange(request, response)
+            if stream is not None:
+                stream.feed(SERVER, raw_response[head_end + 4:])
+
+            relay_start = time.perf_counter()
+            self._relay(
+                self.connection,
+                target_conn,
+                (lambda data: stream.feed(CLIENT, data)) if stream else _ignore,
+                (lambda data: stream.feed(SERVER, data)) if stream else _ignore,
+            )
+            trace = tracing.current_trace()
+            if trace is not None:
+                trace.add_span('relay', relay_start, time.perf_counter())
+            if stream is not None:
+                stream.close()
+        finally:
+            target_conn.close()
+            self.close_connection = True
 
     def handle_request(self):
+        REQUESTS.labels('http').inc()
         try:
-            request = Request(self)
+            with tracing.span('parse'):
+                request = Request(self)
         except ValueError:
+            ERRORS.labels('parse').inc()
             err = HTTPStatus.BAD_REQUEST
             self.send_error(
                 err.value,
@@ -194,112 +906,205 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
             )
             return
 
-        with lock:
-            request_id = request.save_to_db(self.db_conn)
+        request.trace_id = tracing.current_trace_id()
+
+        if is_upgrade(request.headers):
+            try:
+                self._relay_upgrade(request)
+            except StageTimeout:
+                ERRORS.labels('upstream').inc()
+                self._send_gateway_timeout(request)
+                self._capture_exchange(request)
+            except socket.error:
+                ERRORS.labels('upstream').inc()
+                err = HTTPStatus.BAD_GATEWAY
+                self.send_error(
+                    err.value,
+                    f"Cannot connect to '{request.host}:{request.port}'",
+                    err.description,
+                )
+                self._capture_exchange(request)
+            return
 
         try:
-            response = self.send_request_get_response(request)
+            with tracing.span('upstream'):
+                response = self._fetch(request)
         except InvalidURL:
+            ERRORS.labels('upstream').inc()
             err = HTTPStatus.BAD_REQUEST
             self.send_error(
                 err.value,
                 f"Invalid url: '{self.path}'",
                 err.description,
             )
+            self._capture_exchange(request)
+            return
+        except StageTimeout:
+            ERRORS.labels('upstream').inc()
+            self._send_gateway_timeout(request)
+            self._capture_exchange(request)
             return
         except socket.error:
-            err = HTTPStatus.BAD_REQUEST
+            ERRORS.labels('upstream').inc()
+            err = HTTPStatus.BAD_GATEWAY
             self.send_error(
                 err.value,
                 "Could not send request to host",
                 err.description,
             )
+            self._capture_exchange(request)
             return
         except Exception:
+            ERRORS.labels('upstream').inc()
             err = HTTPStatus.BAD_GATEWAY
             self.send_error(
                 err.value,
                 f"Cannot connect to '{request.host}:{request.port}'",
                 err.description,
             )
+            self._capture_exchange(request)
             return
 
-        self._transmit_response(response, request_id)
+        self._transmit_response(response)
+        self._capture_exchange(request, response)
+
+    def _send_gateway_timeout(self, request: Request):
+        err = HTTPStatus.GATEWAY_TIMEOUT
+        self.send_error(
+            err.value,
+            f"Timed out waiting for '{request.host}:{request.port}'",
+            err.description,
+        )
+
+    def _capture_exchange(
+        self,
+        request: Request,
+        response: Response | None = None,
+        is_https: bool = False,
+        stream_id: str | None = None,
+    ) -> bool:
+        if not capture_rules.should_capture(request, response):
+            return False
+        self.capture.save_exchange(request, response, is_https, stream_id)
+        return True
+
+    def _fetch(self, request: Request) -> Response:
+        deadline = Deadline(self.timeouts.request)
+
+        def send(request: Request) -> Response:
+            return self.send_request_get_response(
+                request,
+                timeouts=self.timeouts,
+                deadline=deadline,
+            )
+
+        if http_cache is None:
+            return send(request)
+        return http_cache.fetch(request, send)
 
     @staticmethod
     def send_request_get_response(
         request: Request,
         is_https=False,
+        timeouts: Timeouts | None = None,
+        deadline: Deadline | None = None,
     ) -> Response:
+        if timeouts is None:
+            timeouts = Timeouts()
+        if deadline is None:
+            deadline = Deadline(timeouts.request)
         if is_https:
             conn = HTTPSConnection(request.host)
         else:
             conn = HTTPConnection(request.host, request.port)
-        conn.request(
-            request.method,
-            request.path,
-            body=request.body,
-            headers=request.headers,
-        )
-        response = Response(conn.getresponse())
-        conn.close()
+        conn._create_connection = create_connection
+        conn.response_class = functools.partial(DeadlineResponse, deadline=deadline)
+        started = time.perf_counter()
+        try:
+            with UPSTREAM_ROUNDTRIP_SECONDS.time():
+                # an HTTPS connect includes the TLS handshake
+                with deadline.stage('connect', timeouts.connect) as timeout:
+                    conn.timeout = timeout
+                    conn.connect()
+                # the response keeps reading from this socket even after
+                # the connection let go of it
+                sock = conn.sock
+                with deadline.stage('first_byte', timeouts.first_byte) as timeout:
+                    sock.settimeout(timeout)
+                    conn.request(
+                        request.method,
+                        request.path,
+                        body=request.body,
+                        headers=request.headers,
+                    )
+                    upstream_response = conn.getresponse()
+                duration = time.perf_counter() - started
+                # the body may take whatever is left of the request
+                with deadline.stage('request') as timeout:
+                    sock.settimeout(timeout)
+                    response = Response(upstream_response)
+        finally:
+            conn.close()
+        response.duration = duration
         return response
 
-    def _transmit_response(self, response: Response, request_id: int):
-        self.send_response(response.code, response.message)
-        for header, value in response.headers.items():
-            self.send_header(header, value)
-        self.end_headers()
+    def _transmit_response(self, response: Response):
+        with tracing.span('relay'):
+            self.send_response(response.code, response.message)
+            for header, value in response.headers.items():
+                self.send_header(header, value)
+            self.end_headers()
 
-        self.wfile.write(response.body)
-        with lock:
-            response.save_to_db(request_id, self.db_conn)
+            self.wfile.write(response.body)
 
 
 class ProxyServer:
-    def __init__(self, port=config.PROXY_PORT) -> None:
+    def __init__(
+        self,
+        port=config.PROXY_PORT,
+        options: ServerOptions | None = None,
+    ) -> None:
         self.port = port
         self.init_db()
+        self.init_capture()
         self.proxy_server = ThreadingProxy(
             ('', port),
             ProxyRequestHandler,
-            self.db_conn,
+            self.capture,
+            options=options,
         )
 
     def init_db(self):
         self.db_conn = sqlite3.connect(config.DB, check_same_thread=False)
-        db_cursor = self.db_conn.cursor()
-        db_cursor.execute('''
-            CREATE TABLE IF NOT EXISTS request (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                method TEXT,
-                host TEXT,
-                port INTEGER,
-                path TEXT,
-                get_params TEXT,
-                headers TEXT,
-                cookies TEXT,
-                body TEXT,
-                post_params TEXT,
-                is_https BOOLEAN
-            )
-        ''')
-        db_cursor.execute('''
-            CREATE TABLE IF NOT EXISTS response (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                request_id INTEGER,
-                code INTEGER,
-                message TEXT,
-                headers TEXT,
-                set_cookie TEXT,
-                body TEXT,
-                FOREIGN KEY(request_id) REFERENCES requests(id)
-            )
-        ''')
-        self.db_conn.commit()
+        init_db(self.db_conn)
+        enable_wal(self.db_conn)
+
+    def init_capture(self):
+        self.remote_capture = None
+        if config.CAPTURE_SINK == 'remote':
+            self.capture = self.remote_capture = RemoteCapture()
+        elif config.CAPTURE_SINK == 'sqlite':
+            self.capture = SQLiteCapture(self.db_conn)
+            # with the remote sink, the collector analyses the exchanges
+        else:
+            raise ValueError(f'unknown capture sink {config.CAPTURE_SINK!r}')
 
     def run(self):
         print(f'proxy server is running on port {self.port}')
+        metrics_server = start_metrics_server(
+            handler_class=ProfilerRequestHandler,
+        )
+        install_signal_handlers()
+        retention_thread = start_retention()
+        if self.remote_capture is not None:
+            self.remote_capture.start()
+            analysis = None
+        else:
+            analysis = start_analysis(self.capture, config.DB)
+        print(
+            'metrics are served on '
+            f'http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics'
+        )
         try:
             self.proxy_server.serve_forever()
         except KeyboardInterrupt:
@@ -307,11 +1112,12 @@ class ProxyServer:
         except Exception as e:
             print(f'unexpected error occured: {e}')
         finally:
+            metrics_server.shutdown()
+            retention_thread.stop()
+            if self.remote_capture is not None:
+                # what the collector does not take in time stays spooled
+                self.remote_capture.stop(config.SHUTDOWN_GRACE_SECONDS)
+            if analysis is not None:
+                analysis.stop(config.SHUTDOWN_GRACE_SECONDS)
             self.db_conn.close()
-            for _, _, files in os.walk(CERTS_DIR):
-                for file in files:
-                    os.remove(os.path.join(CERTS_DIR, file))
-
-            for _, _, files in os.walk(SERIAL_NUMBERS_DIR):
-                for file in files:
-                    os.remove(os.path.join(SERIAL_NUMBERS_DIR, file))
+            cert_store.close()
@@ -0,0 +1,93 @@
+import queue
+import sqlite3
+import threading
+
+import config
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ReadPool:
+    # read-only connections to a WAL database, opened on demand up to size.
+    # With snapshot, a connection is handed out inside a read transaction,
+    # so every query made with it sees the database as of its first read.
+    def __init__(
+        self,
+        path: str = config.DB,
+        size: int = config.API_DB_POOL_SIZE,
+        timeout: float = config.API_DB_POOL_TIMEOUT,
+        mmap_size: int = config.API_DB_MMAP_SIZE,
+        cache_size: int = config.API_DB_CACHE_SIZE,
+    ) -> None:
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        # the most recently used connection has the warmest page cache
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        db_conn = sqlite3.connect(
+            f'file:{self.path}?mode=ro',
+            uri=True,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db_conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        # a negative cache_size is in KiB
+        db_conn.execute(f'PRAGMA cache_size = {-(self.cache_size // 1024)}')
+        return db_conn
+
+    def acquire(self, snapshot: bool = True) -> sqlite3.Connection:
+        try:
+            db_conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    db_conn = self._open()
+                except BaseException:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    db_conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(
+                        f'no database connection free after {self.timeout}s'
+                    ) from None
+        if snapshot:
+            db_conn.execute('BEGIN')
+        return db_conn
+
+    def release(self, db_conn: sqlite3.Connection):
+        try:
+            if db_conn.in_transaction:
+                db_conn.execute('ROLLBACK')
+        except sqlite3.Error:
+            # a broken connection is replaced by a new one on demand
+            db_conn.close()
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put(db_conn)
+
+    def close(self):
+        while True:
+            try:
+                db_conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            db_conn.close()
+            with self._lock:
+                self._opened -= 1
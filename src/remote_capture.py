@@ -0,0 +1,437 @@
+import base64
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from src.capture import EXCHANGE, MESSAGES, TRACE, CAPTURE_BATCH_SIZE, QueueCapture
+from src.metrics import Counter, Gauge
+from src.request import Request
+from src.response import Response
+from src import tracing
+from src.websocket import Message
+import config
+
+
+PROTOCOL_VERSION = 1
+# a frame is the length of a zlib compressed JSON batch followed by the
+# batch; the collector answers every frame with the batch number and
+# whether it took it
+FRAME_HEADER = struct.Struct('!I')
+ACK = struct.Struct('!QB')
+ACCEPTED = 0
+REJECTED = 1
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+ACK_TIMEOUT = 30
+# the collector drops connections without traffic for ACK_TIMEOUT, so an
+# idle connection is replaced before it would be dropped mid-send
+IDLE_RECONNECT_SECONDS = ACK_TIMEOUT / 2
+MIN_RETRY_SECONDS = 1
+MAX_RETRY_SECONDS = 30
+SPOOL_SUFFIX = '.batch'
+
+
+SHIPPED_BATCHES = Counter(
+    'proxy_capture_shipped_batches_total',
+    'Capture batches acknowledged by the collector.',
+)
+SHIP_ERRORS = Counter(
+    'proxy_capture_ship_errors_total',
+    'Failed attempts to send a capture batch to the collector.',
+)
+SPOOLED_BATCHES = Gauge(
+    'proxy_capture_spooled_batches',
+    'Capture batches waiting on disk for the collector.',
+)
+SPOOL_DROPPED = Counter(
+    'proxy_capture_spool_dropped_total',
+    'Spooled capture batches deleted because the spool was full, or '
+    'because the collector rejected them.',
+)
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _b64(value: bytes | str | None) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.encode()
+    return base64.b64encode(value).decode('ascii')
+
+
+def _unb64(value: str | None) -> bytes | None:
+    return None if value is None else base64.b64decode(value)
+
+
+def _encode_request(request: Request) -> dict:
+    # params and cookies are derived again from the query, body and
+    # headers on the collector
+    return {
+        'method': request.method,
+        'host': request.host,
+        'port': request.port,
+        'path': request.path,
+        'query': request.query,
+        'headers': request.header_fields,
+        'body': _b64(request.body),
+        'trace_id': request.trace_id,
+    }
+
+
+def _decode_request(data: dict) -> Request:
+    return Request(
+        method=data['method'],
+        host=data['host'],
+        port=data['port'],
+        path=data['path'],
+        query=data['query'],
+        get_params=None,
+        header_fields=[tuple(field) for field in data['headers']],
+        body=_unb64(data['body']),
+        post_params=None,
+        trace_id=data['trace_id'],
+    )
+
+
+def _encode_response(response: Response) -> dict:
+    return {
+        'code': response.code,
+        'message': response.message,
+        'headers': response.header_fields,
+        'body': _b64(response.body),
+        'from_cache': response.from_cache,
+        'duration': response.duration,
+    }
+
+
+def _decode_response(data: dict) -> Response:
+    return Response(
+        code=data['code'],
+        message=data['message'],
+        header_fields=[tuple(field) for field in data['headers']],
+        set_cookie=None,
+        body=_unb64(data['body']),
+        from_cache=data['from_cache'],
+        duration=data.get('duration'),
+    )
+
+
+def _encode_trace(trace: tracing.Trace) -> dict:
+    return trace.to_dict()
+
+
+def _decode_trace(data: dict) -> tracing.Trace:
+    trace = tracing.Trace()
+    trace.trace_id = data['trace_id']
+    trace.client = data['client']
+    trace.started_at = data['started_at']
+    trace.duration = data['duration']
+    # span offsets are already relative to the start of the trace
+    trace.origin = 0.0
+    trace.spans = [
+        tracing.Span(span['name'], span['offset'], span['duration'])
+        for span in data['spans']
+    ]
+    return trace
+
+
+def encode_record(record: tuple) -> list:
+    kind, *payload = record
+    if kind == EXCHANGE:
+        request, response, is_https, stream_id, *rest = payload
+        return [
+            EXCHANGE,
+            _encode_request(request),
+            None if response is None else _encode_response(response),
+            bool(is_https),
+            stream_id,
+            rest[0] if rest else time.time(),
+        ]
+    if kind == MESSAGES:
+        stream_id, messages, final = payload
+        return [
+            MESSAGES,
+            stream_id,
+            [
+                [
+                    message.direction,
+                    message.opcode,
+                    _b64(message.payload),
+                    message.size,
+                    message.truncated,
+                    message.created_at,
+                ]
+                for message in messages
+            ],
+            final,
+        ]
+    if kind == TRACE:
+        return [TRACE, _encode_trace(payload[0])]
+    raise BatchError(f'unknown capture record {kind!r}')
+
+
+def decode_record(data: list) -> tuple:
+    kind, *payload = data
+    if kind == EXCHANGE:
+        request, response, is_https, stream_id, created_at = payload
+        return (
+            EXCHANGE,
+            _decode_request(request),
+            None if response is None else _decode_response(response),
+            is_https,
+            stream_id,
+            created_at,
+        )
+    if kind == MESSAGES:
+        stream_id, messages, final = payload
+        return (
+            MESSAGES,
+            stream_id,
+            [
+                Message(direction, opcode, _unb64(body), size, truncated, created_at)
+                for direction, opcode, body, size, truncated, created_at in messages
+            ],
+            final,
+        )
+    if kind == TRACE:
+        return (TRACE, _decode_trace(payload[0]))
+    raise BatchError(f'unknown capture record {kind!r}')
+
+
+def encode_batch(session: str, node: str, seq: int, records: list[tuple]) -> bytes:
+    encoded = []
+    for record in records:
+        try:
+            encoded.append(encode_record(record))
+        except (BatchError, AttributeError, TypeError, ValueError) as e:
+            print(f'cannot ship {record[0]} capture: {e}')
+    return zlib.compress(json.dumps({
+        'version': PROTOCOL_VERSION,
+        'session': session,
+        'node': node,
+        'seq': seq,
+        'records': encoded,
+    }, separators=(',', ':')).encode())
+
+
+def decode_batch(frame: bytes) -> tuple[str, str, int, list[tuple]]:
+    # a record that cannot be decoded is dropped, a batch that cannot be
+    # read at all raises BatchError
+    try:
+        batch = json.loads(zlib.decompress(frame))
+        if batch['version'] != PROTOCOL_VERSION:
+            raise BatchError(f'unsupported batch version {batch["version"]}')
+        session, node, seq = batch['session'], batch['node'], batch['seq']
+        encoded = batch['records']
+    except (zlib.error, ValueError, KeyError, TypeError) as e:
+        raise BatchError(f'invalid capture batch: {e}') from None
+    records = []
+    for data in encoded:
+        try:
+            records.append(decode_record(data))
+        except (BatchError, KeyError, TypeError, ValueError) as e:
+            print(f'dropping undecodable capture record: {e}')
+    return session, node, seq, records
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed by peer')
+        data.extend(chunk)
+    return bytes(data)
+
+
+class Spool:
+    # encoded batches the collector has not taken yet, one file each, sent
+    # oldest first. The file name keeps the batch number for matching the
+    # acknowledgement.
+    def __init__(
+        self,
+        directory: str = config.CAPTURE_SPOOL_DIR,
+        max_bytes: int = config.CAPTURE_SPOOL_MAX_BYTES,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._files: list[tuple[str, int]] = []
+        self.total = 0
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith(SPOOL_SUFFIX):
+                self._files.append((path, os.path.getsize(path)))
+                self.total += self._files[-1][1]
+            elif name.endswith('.tmp'):
+                os.remove(path)
+        SPOOLED_BATCHES.set(len(self._files))
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def append(self, seq: int, frame: bytes):
+        name = f'{time.time_ns():020d}-{seq:012d}{SPOOL_SUFFIX}'
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(frame)
+        os.replace(path + '.tmp', path)
+        self._files.append((path, len(frame)))
+        self.total += len(frame)
+        while self.total > self.max_bytes and len(self._files) > 1:
+            self.remove_oldest()
+            SPOOL_DROPPED.inc()
+        SPOOLED_BATCHES.set(len(self._files))
+
+    def oldest(self) -> tuple[int, bytes]:
+        path, _ = self._files[0]
+        seq = int(os.path.basename(path)[21:-len(SPOOL_SUFFIX)])
+        with open(path, 'rb') as f:
+            return seq, f.read()
+
+    def remove_oldest(self):
+        path, size = self._files.pop(0)
+        self.total -= size
+        os.remove(path)
+        SPOOLED_BATCHES.set(len(self._files))
+
+
+class RemoteCapture(QueueCapture):
+    # collects captures like QueueCapture and ships them in compressed
+    # batches over one persistent connection to the collector. In pre-fork
+    # mode run() drains the queue the workers feed; otherwise start() runs
+    # it on a thread. Every batch is numbered within this session, so the
+    # collector can skip batches it already has.
+    def __init__(
+        self,
+        capture_queue=None,
+        address: tuple[str, int] = (config.COLLECTOR_HOST, config.COLLECTOR_PORT),
+        node: str = config.NODE_NAME,
+        spool: Spool | None = None,
+        batch_size: int = CAPTURE_BATCH_SIZE,
+        flush_interval: float = config.CAPTURE_FLUSH_INTERVAL_SECONDS,
+        min_retry: float = MIN_RETRY_SECONDS,
+    ) -> None:
+        if capture_queue is None:
+            capture_queue = queue.Queue(config.CAPTURE_QUEUE_SIZE)
+        super().__init__(capture_queue)
+        self.address = address
+        self.node = node
+        self.spool = spool if spool is not None else Spool()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_retry = min_retry
+        self.session = os.urandom(8).hex()
+        self.seq = 0
+        self._sock: socket.socket | None = None
+        self._used_at = 0.0
+        self._retry_at = 0.0
+        self._retry = min_retry
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(
+            target=self.run,
+            name='capture-shipper',
+            daemon=True,
+        )
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float | None = None):
+        self.queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _next_batch(self) -> tuple[list[tuple], bool]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                record = self.queue.get(
+                    timeout=max(deadline - time.monotonic(), 0),
+                )
+            except queue.Empty:
+                break
+            if record is None:
+                return batch, False
+            batch.append(record)
+        return batch, True
+
+    def run(self):
+        running = True
+        while running:
+            batch, running = self._next_batch()
+            if batch:
+                self.seq += 1
+                frame = encode_batch(self.session, self.node, self.seq, batch)
+                # batches are delivered in order, so nothing overtakes
+                # the spool
+                if self.spool or not self._send(self.seq, frame):
+                    self.spool.append(self.seq, frame)
+            self.flush()
+        # one last try on the way out, whatever the backoff
+        self._retry_at = 0.0
+        self.flush()
+        self._disconnect()
+
+    def flush(self) -> bool:
+        # sends spooled batches until the spool is empty or the collector
+        # fails; True when nothing is left
+        while self.spool:
+            seq, frame = self.spool.oldest()
+            if not self._send(seq, frame):
+                return False
+            self.spool.remove_oldest()
+        return True
+
+    def _connect(self) -> socket.socket:
+        if self._sock is not None \
+                and time.monotonic() - self._used_at > IDLE_RECONNECT_SECONDS:
+            self._disconnect()
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address, ACK_TIMEOUT)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self._sock
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _send(self, seq: int, frame: bytes) -> bool:
+        # True once the collector has answered for the batch
+        now = time.monotonic()
+        if now < self._retry_at:
+            return False
+        try:
+            sock = self._connect()
+            sock.sendall(FRAME_HEADER.pack(len(frame)) + frame)
+            acked, status = ACK.unpack(recv_exactly(sock, ACK.size))
+            if status == ACCEPTED and acked != seq:
+                raise ConnectionError(f'batch {seq} acknowledged as {acked}')
+        except OSError as e:
+            SHIP_ERRORS.inc()
+            self._disconnect()
+            if self._retry == self.min_retry:
+                print(f'cannot ship captures to {self.address}: {e}')
+            self._retry_at = now + self._retry
+            self._retry = min(self._retry * 2, MAX_RETRY_SECONDS)
+            return False
+        self._used_at = time.monotonic()
+        self._retry = self.min_retry
+        if status == REJECTED:
+            # sending it again would not help, so it is given up
+            SPOOL_DROPPED.inc()
+            print(f'collector rejected capture batch {seq}')
+        else:
+            SHIPPED_BATCHES.inc()
+        return True
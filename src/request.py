@@ -3,11 +3,13 @@ from http.cookies import SimpleCookie
 from http.server import BaseHTTPRequestHandler
 import json
 import sqlite3
+import time
 from urllib.parse import parse_qs, urlparse
 
 import httptools
 
 from src.consts import COLON, DOUBLE_QUOTES, NEW_LINE, SINGLE_QUOTES
+from src.header_store import HeaderStore, header_store
 
 
 COOKIE_HEADER = 'Cookie'
@@ -17,16 +19,60 @@ DEFAULT_PORT = {
     'https': 443,
 }
 
+EMPTY_JSON_OBJECT = '{}'
+
+
+def _dumps(value) -> str:
+    # lazily decoded fields still hold the JSON text they were loaded
+    # from, which can be written back as is
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
 
 class Request:
+    # headers, params and cookies are parsed on first access: each of the
+    # underscored slots holds either the parsed value, the JSON text read
+    # from the database, or None when it has to be derived from the
+    # query string, body or headers.
+    # _header_fields is the ordered list of (name, value) pairs as received,
+    # duplicates included, and is what gets stored; headers is a dict view
+    # of it. Rows from the header store keep their packed references in
+    # _header_refs until the headers are first read.
+    __slots__ = (
+        'method',
+        'host',
+        'port',
+        'path',
+        'body',
+        'trace_id',
+        'injection_points',
+        'current_injection_index',
+        '_query',
+        '_headers',
+        '_header_fields',
+        '_header_refs',
+        '_header_store',
+        '_get_params',
+        '_post_params',
+        '_cookies',
+    )
+
     def __init__(
         self,
         request_handler: BaseHTTPRequestHandler = None,
         **kwargs,
     ) -> None:
+        self._query = ''
+        self._headers = None
+        self._header_fields = None
+        self._header_refs = None
+        self._header_store = None
+        self._get_params = None
+        self._post_params = None
+        self._cookies = None
         if request_handler:
-            self.request_handler = request_handler
-            self._parse_request()
+            self._parse_request(request_handler)
         elif 'raw' in kwargs:
             self._parse_raw(kwargs['raw'])
         else:
@@ -34,14 +80,22 @@ class Request:
             self.host = kwargs.get('host')
             self.port = kwargs.get('port', 80)
             self.path = kwargs.get('path')
-            self.get_params = kwargs.get('get_params', {})
-            self.headers = kwargs.get('headers', {})
-            self.cookies = kwargs.get('cookies', SimpleCookie())
+            self._query = kwargs.get('query', '')
+            self._get_params = kwargs.get('get_params', {})
+            self._header_fields = kwargs.get('header_fields')
+            self._headers = kwargs.get(
+                'headers',
+                {} if self._header_fields is None else None,
+            )
+            self._header_refs = kwargs.get('header_refs')
+            self._header_store = kwargs.get('header_store')
+            self._cookies = kwargs.get('cookies')
             self.body = kwargs.get('body')
-            self.post_params = kwargs.get('post_params', {})
+            self._post_params = kwargs.get('post_params', {})
+        self.trace_id = kwargs.get('trace_id')
 
     @classmethod
-    def from_db(cls, db_row):
+    def from_db(cls, db_row, header_store: HeaderStore | None = None):
         (
             method,
             host,
@@ -54,36 +108,118 @@ class Request:
             post_params,
         ) = db_row[
             1:10]
+        trace_id = db_row[11] if len(db_row) > 11 else None
+        header_refs = db_row[12] if len(db_row) > 12 else None
         return cls(
             method=method,
             host=host,
             port=port,
             path=path,
-            get_params=json.loads(get_params),
-            headers=json.loads(headers),
-            cookies=SimpleCookie(json.loads(cookies)),
+            get_params=get_params,
+            headers=headers,
+            cookies=cookies,
             body=body,
-            post_params=json.loads(post_params)
+            post_params=post_params,
+            trace_id=trace_id,
+            header_refs=header_refs,
+            header_store=header_store,
         )
 
     @classmethod
     def from_raw_request(cls, raw_request: bytes):
         return cls(raw=raw_request)
 
+    @property
+    def header_fields(self) -> list[tuple[str, str]]:
+        if self._header_fields is None:
+            if self._header_refs is not None:
+                self._header_fields = self._header_store.decode(
+                    self._header_refs,
+                )
+            else:
+                self._header_fields = list(self.headers.items())
+        return self._header_fields
+
+    @property
+    def headers(self) -> dict:
+        if self._headers is None:
+            self._headers = dict(self.header_fields)
+        elif isinstance(self._headers, str):
+            self._headers = json.loads(self._headers)
+        return self._headers
+
+    @headers.setter
+    def headers(self, value: dict):
+        self._headers = value
+        self._header_fields = None
+        self._header_refs = None
+
+    def _set_header(self, name: str, value: str):
+        fields = [field for field in self.header_fields if field[0] != name]
+        fields.append((name, value))
+        self._header_fields = fields
+        self.headers[name] = value
+
+    @property
+    def query(self) -> str:
+        return self._query
+
+    @property
+    def get_params(self) -> dict:
+        if self._get_params is None:
+            self._get_params = self._parse_get_params()
+        elif isinstance(self._get_params, str):
+            self._get_params = json.loads(self._get_params)
+        return self._get_params
+
+    @get_params.setter
+    def get_params(self, value: dict):
+        self._get_params = value
+
+    @property
+    def post_params(self) -> dict:
+        if self._post_params is None:
+            self._post_params = self._parse_post_params()
+        elif isinstance(self._post_params, str):
+            self._post_params = json.loads(self._post_params)
+        return self._post_params
+
+    @post_params.setter
+    def post_params(self, value: dict):
+        self._post_params = value
+
+    @property
+    def cookies(self) -> SimpleCookie:
+        if self._cookies is None:
+            self._cookies = self._parse_cookies()
+        elif not isinstance(self._cookies, SimpleCookie):
+            cookies = self._cookies
+            if isinstance(cookies, str):
+                cookies = json.loads(cookies)
+            self._cookies = SimpleCookie(cookies)
+        return self._cookies
+
+    @cookies.setter
+    def cookies(self, value: SimpleCookie):
+        self._cookies = value
+
     def _parse_raw(self, raw_request):
-        self.headers = {}
+        self._header_fields = []
         self.body = None
         p = httptools.HttpRequestParser(self)
-        p.feed_data(raw_request)
+        try:
+            p.feed_data(raw_request)
+        except httptools.HttpParserUpgrade:
+            # the head of an Upgrade request is complete, what follows
+            # belongs to the new protocol
+            pass
 
         self.method = p.get_method().decode()
-        self._parse_get_params()
-        self._parse_post_params()
-        self._parse_cookies()
+        self._query = urlparse(self.path).query
         self._parse_host_port_path(self.path)
 
     def on_header(self, name: bytes, value: bytes):
-        self.headers[name.decode()] = value.decode()
+        self._header_fields.append((name.decode(), value.decode()))
 
     def on_body(self, body: bytes):
         if self.body is None:
@@ -93,21 +229,15 @@ class Request:
     def on_url(self, url: bytes):
         self.path = url.decode()
 
-    def _parse_request(self):
-        self._parse_headers()
-        self._parse_body()
-        self._parse_cookies()
-        self._parse_method()
-        self._parse_post_params()
+    def _parse_request(self, request_handler: BaseHTTPRequestHandler):
+        self._parse_headers(request_handler)
+        self._parse_body(request_handler)
+        self._parse_method(request_handler)
+        self._query = urlparse(request_handler.path).query
         try:
-            self._parse_host_port_path(self.request_handler.path)
+            self._parse_host_port_path(request_handler.path)
         except ValueError as e:
             raise ValueError from e
-        self._parse_get_params()
-
-    def _parse_path(self) -> None:
-        url = urlparse(self.request_handler.path)
-        self.path = url.path if url.path else '/'
 
     @staticmethod
     def parse_host_port(netloc: str) -> tuple[str, int]:
@@ -128,9 +258,9 @@ class Request:
                 self.port = parsed_url.port \
                     if parsed_url.port \
                     else 80
-                self.headers['Host'] = parsed_url.netloc
+                self._set_header('Host', parsed_url.netloc)
                 self.path = parsed_url.path
-            elif self.headers['Host']:
+            elif self.headers.get('Host'):
                 self.host, self.port = self.parse_host_port(
                     self.headers['Host'],
                 )
@@ -138,66 +268,114 @@ class Request:
             else:
                 raise ValueError("invalid request")
 
-    def _parse_body(self) -> None:
-        content_length = self.request_handler.headers['Content-Length']
+    def _parse_body(self, request_handler: BaseHTTPRequestHandler) -> None:
+        content_length = request_handler.headers['Content-Length']
         if content_length:
             content_length = int(content_length)
-            self.body = self.request_handler.rfile.read(content_length)
+            self.body = request_handler.rfile.read(content_length)
         else:
             self.body = None
 
-    def _parse_headers(self) -> None:
-        self.headers = {
-            header_name: header_value
+    def _parse_headers(
+        self,
+        request_handler: BaseHTTPRequestHandler,
+    ) -> None:
+        self._header_fields = [
+            (header_name, header_value)
             for header_name, header_value
-            in self.request_handler.headers.items()
+            in request_handler.headers.items()
             if header_name not in ['Proxy-Connection']
-        }
+        ]
 
-    def _parse_cookies(self) -> None:
-        self.cookies = SimpleCookie()
-        self.cookies.load(self.headers.get(COOKIE_HEADER, ''))
+    def _parse_cookies(self) -> SimpleCookie:
+        cookies = SimpleCookie()
+        cookies.load(self.headers.get(COOKIE_HEADER, ''))
+        return cookies
 
-    def _parse_method(self):
-        self.method = self.request_handler.command
+    def _parse_method(self, request_handler: BaseHTTPRequestHandler):
+        self.method = request_handler.command
 
-    def _parse_get_params(self) -> None:
-        self.get_params = parse_qs(urlparse(self.path).query)
-        self.get_params = {
+    def _parse_get_params(self) -> dict:
+        if not self._query:
+            return {}
+        return {
             k: v[0] if len(v) == 1 else v
-            for k, v in self.get_params.items()
+            for k, v in parse_qs(self._query).items()
         }
 
-    def _parse_post_params(self) -> None:
+    def _parse_post_params(self) -> dict:
         content_type = self.headers.get('Content-Type', '')
-        self.post_params = parse_qs(self.body.decode()) \
+        return parse_qs(self.body.decode()) \
             if 'application/x-www-form-urlencoded' in content_type \
             and self.body else {}
 
+    def _dump_cookies(self) -> str:
+        if self._cookies is None:
+            if COOKIE_HEADER not in self.headers:
+                return EMPTY_JSON_OBJECT
+        elif not isinstance(self._cookies, SimpleCookie):
+            return _dumps(self._cookies)
+        return json.dumps({k: v.value for k, v in self.cookies.items()})
+
+    def _header_refs_for(self, store: HeaderStore) -> bytes:
+        if self._header_refs is not None and self._header_store is store:
+            return self._header_refs
+        return store.encode(self.header_fields)
+
+    def to_db_row(self, store: HeaderStore, is_https=False) -> tuple:
+        return (
+            self.method,
+            self.host,
+            self.port,
+            self.path,
+            _dumps(self.get_params),
+            None,
+            self._dump_cookies(),
+            self.body,
+            _dumps(self.post_params),
+            is_https,
+            self.trace_id,
+            self._header_refs_for(store),
+        )
+
     def save_to_db(
         self,
         db_conn: sqlite3.Connection,
         is_https=False,
+        trace_id: str | None = None,
+        store: HeaderStore | None = None,
+        commit: bool = True,
+        created_at: float | None = None,
     ) -> int:
+        if trace_id is not None:
+            self.trace_id = trace_id
+        if store is None:
+            store = header_store(db_conn)
         db_cursor = db_conn.cursor()
         db_cursor.execute('''
-            INSERT INTO request (method, host, port, path, get_params, headers, cookies, body, post_params, is_https)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            self.method,
-            self.host,
-            self.port,
-            self.path,
-            json.dumps(self.get_params),
-            json.dumps(self.headers),
-            json.dumps({k: v.value for k, v in self.cookies.items()}),
-            self.body,
-            json.dumps(self.post_params),
-            is_https,
+            INSERT INTO request (method, host, port, path, get_params, headers, cookies, body, post_params, is_https, trace_id, header_refs, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', self.to_db_row(store, is_https) + (
+            time.time() if created_at is None else created_at,
         ))
-        db_conn.commit()
+        if commit:
+            db_conn.commit()
         return db_cursor.lastrowid
 
+    def __getstate__(self):
+        # the header store holds a database connection, so copies and
+        # pickles carry the decoded header fields instead
+        if self._header_refs is not None:
+            self.header_fields
+        state = {
+            slot: getattr(self, slot)
+            for slot in self.__slots__
+            if hasattr(self, slot)
+        }
+        state['_header_refs'] = None
+        state['_header_store'] = None
+        return None, state
+
     def __iter__(self):
         self.injection_points = self._get_injection_points()
         self.current_injection_index = 0
@@ -285,4 +463,5 @@ class Request:
             'headers': self.headers,
             'cookie': self.cookies,
             'body': body,
+            'trace_id': self.trace_id,
         }
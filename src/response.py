@@ -1,4 +1,3 @@
-import gzip
 from http import HTTPStatus
 from http.client import HTTPResponse
 from http.cookies import SimpleCookie
@@ -8,51 +7,147 @@ import sqlite3
 import httptools
 
 from src.consts import NEW_LINE
+from src.encoding import (
+    CONTENT_ENCODING_HEADER,
+    DecodingError,
+    decode_body,
+    get_header,
+)
+from src.header_store import HeaderStore, header_store
 
 
 COOKIE_HEADER = 'Set-Cookie'
 
+EMPTY_JSON_OBJECT = '{}'
+
+
+def _dumps(value) -> str:
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
 
 class Response:
+    # headers and cookies read from the database stay JSON text (or packed
+    # header store references) until they are first accessed; set_cookie
+    # is None until it is parsed. _header_fields keeps the headers in
+    # their original order with duplicates and is what gets stored.
+    # from_cache is set when the proxy answered from its HTTP cache.
+    # duration is the time from starting the upstream request to the
+    # response head, None when the proxy did not measure it.
+    __slots__ = (
+        'code',
+        'message',
+        'body',
+        'from_cache',
+        'duration',
+        '_headers',
+        '_header_fields',
+        '_header_refs',
+        '_header_store',
+        '_set_cookie',
+        '_decoded_body',
+    )
+
     def __init__(
         self,
         response: HTTPResponse = None,
         **kwargs
     ) -> None:
+        self._set_cookie = None
+        self._headers = None
+        self._header_fields = None
+        self._header_refs = None
+        self._header_store = None
+        self.from_cache = kwargs.get('from_cache', False)
+        self.duration = kwargs.get('duration')
         if response:
             self.code = response.status
             self.message = response.reason
-            self.headers = dict(response.getheaders())
+            self._header_fields = response.getheaders()
             self.body = response.read()
-
-            self._parse_cookies()
         elif 'raw' in kwargs:
             self._parse_raw(kwargs['raw'])
         else:
             self.code = kwargs['code']
             self.message = kwargs['message']
-            self.headers = kwargs['headers']
-            self.set_cookie = kwargs.get('set_cookie', SimpleCookie())
+            self._headers = kwargs.get('headers')
+            self._header_fields = kwargs.get('header_fields')
+            self._header_refs = kwargs.get('header_refs')
+            self._header_store = kwargs.get('header_store')
+            self._set_cookie = kwargs.get('set_cookie', SimpleCookie())
             self.body = kwargs['body']
+        self._decoded_body = None
 
-        try:
-            self._handle_content_encoding()
-        except gzip.BadGzipFile:
-            pass
+    @property
+    def header_fields(self) -> list[tuple[str, str]]:
+        if self._header_fields is None:
+            if self._header_refs is not None:
+                self._header_fields = self._header_store.decode(
+                    self._header_refs,
+                )
+            else:
+                self._header_fields = list(self.headers.items())
+        return self._header_fields
+
+    @property
+    def headers(self) -> dict:
+        if self._headers is None:
+            self._headers = dict(self.header_fields)
+        elif isinstance(self._headers, str):
+            self._headers = json.loads(self._headers)
+        return self._headers
 
-    def _handle_content_encoding(self):
-        if 'Content-Encoding' in self.headers:
-            self.body = gzip.decompress(self.body)
+    @headers.setter
+    def headers(self, value: dict):
+        self._headers = value
+        self._header_fields = None
+        self._header_refs = None
+
+    @property
+    def set_cookie(self) -> SimpleCookie:
+        if self._set_cookie is None:
+            self._set_cookie = self._parse_cookies()
+        elif not isinstance(self._set_cookie, SimpleCookie):
+            set_cookie = self._set_cookie
+            if isinstance(set_cookie, str):
+                set_cookie = json.loads(set_cookie)
+            self._set_cookie = SimpleCookie(set_cookie)
+        return self._set_cookie
+
+    @set_cookie.setter
+    def set_cookie(self, value: SimpleCookie):
+        self._set_cookie = value
+
+    @property
+    def content_encoding(self) -> str | None:
+        return get_header(self.headers, CONTENT_ENCODING_HEADER)
+
+    @property
+    def decoded_body(self) -> bytes | None:
+        if self._decoded_body is None:
+            self._decoded_body = decode_body(
+                self.body,
+                self.content_encoding,
+            )
+        return self._decoded_body
 
     @classmethod
-    def from_db(cls, db_row):
-        code, message, headers, set_cookie, body = db_row[2:]
+    def from_db(cls, db_row, header_store: HeaderStore | None = None):
+        code, message, headers, set_cookie, body = db_row[2:7]
+        header_refs = db_row[7] if len(db_row) > 7 else None
+        from_cache = bool(db_row[8]) if len(db_row) > 8 else False
+        duration = db_row[9] if len(db_row) > 9 else None
         return cls(
             code=code,
             message=message,
             headers=headers,
-            set_cookie=SimpleCookie(json.loads(set_cookie)),
+            set_cookie=set_cookie,
             body=body,
+            header_refs=header_refs,
+            header_store=header_store,
+            from_cache=from_cache,
+            duration=duration,
         )
 
     @classmethod
@@ -60,10 +155,13 @@ class Response:
         return cls(raw=raw_request)
 
     def _parse_raw(self, raw_response: bytes):
-        self.headers = {}
+        self._header_fields = []
         self.body = b''
         p = httptools.HttpResponseParser(self)
-        p.feed_data(raw_response)
+        try:
+            p.feed_data(raw_response)
+        except httptools.HttpParserUpgrade:
+            pass
 
         self.code = p.get_status_code()
         try:
@@ -71,42 +169,78 @@ class Response:
         except ValueError as e:
             raise e
 
-        self._parse_cookies()
-
     def on_header(self, name: bytes, value: bytes):
-        self.headers[name.decode()] = value.decode()
+        self._header_fields.append((name.decode(), value.decode()))
 
     def on_body(self, body: bytes):
         if self.body is None:
             self.body = b''
         self.body += body
 
-    def _parse_cookies(self):
-        self.set_cookie = SimpleCookie()
-        self.set_cookie.load(self.headers.get(COOKIE_HEADER, ''))
+    def _parse_cookies(self) -> SimpleCookie:
+        set_cookie = SimpleCookie()
+        set_cookie.load(self.headers.get(COOKIE_HEADER, ''))
+        return set_cookie
+
+    def _dump_cookies(self) -> str:
+        if self._set_cookie is None:
+            if COOKIE_HEADER not in self.headers:
+                return EMPTY_JSON_OBJECT
+        elif not isinstance(self._set_cookie, SimpleCookie):
+            return _dumps(self._set_cookie)
+        return json.dumps(self.set_cookie)
+
+    def _header_refs_for(self, store: HeaderStore) -> bytes:
+        if self._header_refs is not None and self._header_store is store:
+            return self._header_refs
+        return store.encode(self.header_fields)
+
+    def to_db_row(self, request_id: int, store: HeaderStore) -> tuple:
+        return (
+            request_id,
+            self.code,
+            self.message,
+            None,
+            self._dump_cookies(),
+            self.body,
+            self._header_refs_for(store),
+            self.from_cache,
+            self.duration,
+        )
+
+    def __getstate__(self):
+        if self._header_refs is not None:
+            self.header_fields
+        state = {
+            slot: getattr(self, slot)
+            for slot in self.__slots__
+            if hasattr(self, slot)
+        }
+        state['_header_refs'] = None
+        state['_header_store'] = None
+        return None, state
 
     def save_to_db(
         self,
         request_id: int,
         db_conn: sqlite3.Connection,
+        store: HeaderStore | None = None,
+        commit: bool = True,
     ):
+        if store is None:
+            store = header_store(db_conn)
         db_cursor = db_conn.cursor()
         db_cursor.execute('''
-            INSERT INTO response (request_id, code, message, headers, set_cookie, body)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            request_id,
-            self.code,
-            self.message,
-            json.dumps(self.headers),
-            json.dumps(self.set_cookie),
-            self.body,
-        ))
-        db_conn.commit()
+            INSERT INTO response (request_id, code, message, headers, set_cookie, body, header_refs, from_cache, duration)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', self.to_db_row(request_id, store))
+        if commit:
+            db_conn.commit()
 
     def to_dict(self) -> dict:
         try:
-            body = self.body.decode()
+            body = self._decoded_or_wire_body().decode() \
+                if self.body is not None else None
         except UnicodeDecodeError:
             body = 'unsupported content encoding'
         return {
@@ -115,12 +249,22 @@ class Response:
             'headers': self.headers,
             'set_cookies': dict(self.set_cookie),
             'body': body,
+            'from_cache': self.from_cache,
+            'duration': self.duration,
         }
 
+    def _decoded_or_wire_body(self) -> bytes:
+        # rows captured before bodies were kept in wire encoding hold
+        # already decoded bodies, so fall back to the stored bytes
+        try:
+            return self.decoded_body or b''
+        except DecodingError:
+            return self.body or b''
+
     def __eq__(self, __value: object) -> bool:
         return (
             self.code == __value.code and
-            len(self.body) == len(__value.body)
+            len(self._decoded_or_wire_body()) == len(__value._decoded_or_wire_body())
         )
 
     def __str__(self) -> str:
@@ -131,5 +275,6 @@ class Response:
                 for header, field_value in self.headers.items()
             ],
             '',
-            self.body.decode()[:10] + '...' if self.body else '',
+            self._decoded_or_wire_body()[:10].decode(errors='replace') + '...'
+            if self.body else '',
         ])
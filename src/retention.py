@@ -0,0 +1,436 @@
+from dataclasses import dataclass
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from src.db import init_db
+from src.metrics import Counter, Gauge, Histogram
+import config
+
+
+PARTITION_PREFIX = 'proxy-'
+PARTITION_SUFFIX = '.db'
+PARTITION_PATTERN = re.compile(r'^proxy-(\d{4}-\d{2}-\d{2})\.db$')
+
+# rows are moved in short transactions so the capture writer never waits
+# on the retention thread for more than a few milliseconds
+ROTATE_BATCH_SIZE = 500
+VACUUM_STEP_PAGES = 256
+STEP_PAUSE_SECONDS = 0.01
+BUSY_TIMEOUT_SECONDS = 30
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+ROWS_ROTATED = Counter(
+    'proxy_retention_rows_rotated_total',
+    'Rows moved from the live database into day partitions.',
+    labelnames=('table',),
+)
+PARTITIONS_DELETED = Counter(
+    'proxy_retention_partitions_deleted_total',
+    'Day partitions deleted by the retention policy.',
+)
+PAGES_VACUUMED = Counter(
+    'proxy_retention_pages_vacuumed_total',
+    'Free pages returned to the file system by incremental vacuum.',
+)
+PARTITIONS = Gauge(
+    'proxy_retention_partitions',
+    'Day partitions kept in the archive directory.',
+)
+LIVE_DATABASE_BYTES = Gauge(
+    'proxy_retention_live_database_bytes',
+    'Bytes used by rows in the live capture database.',
+)
+RETENTION_RUN_SECONDS = Histogram(
+    'proxy_retention_run_seconds',
+    'Duration of a full retention pass.',
+    buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300),
+)
+
+
+@dataclass
+class RetentionPolicy:
+    # rows older than this leave the live database for their day partition
+    hot_seconds: float = config.RETENTION_HOT_HOURS * 60 * 60
+    # the live database is also rotated down to this many requests or
+    # this many bytes, oldest first; 0 disables the limit
+    max_rows: int = config.RETENTION_MAX_ROWS
+    max_bytes: int = config.RETENTION_MAX_BYTES
+    # partitions are deleted once they are older than this many days or,
+    # oldest first, while all of them together exceed archive_max_bytes
+    archive_days: int = config.RETENTION_ARCHIVE_DAYS
+    archive_max_bytes: int = config.RETENTION_ARCHIVE_MAX_BYTES
+
+
+def partition_day(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(
+        timestamp,
+        datetime.timezone.utc,
+    ).strftime('%Y-%m-%d')
+
+
+def _day_start(day: str) -> float:
+    return datetime.datetime.strptime(day, '%Y-%m-%d').replace(
+        tzinfo=datetime.timezone.utc,
+    ).timestamp()
+
+
+def _day_end(day: str) -> float:
+    return _day_start(day) + DAY_SECONDS
+
+
+def partition_path(day: str, archive_dir: str = config.ARCHIVE_DIR) -> str:
+    return os.path.join(archive_dir, f'{PARTITION_PREFIX}{day}{PARTITION_SUFFIX}')
+
+
+def list_partitions(archive_dir: str = config.ARCHIVE_DIR) -> list[str]:
+    if not os.path.isdir(archive_dir):
+        return []
+    days = []
+    for name in os.listdir(archive_dir):
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            days.append(match.group(1))
+    return sorted(days)
+
+
+def open_partition(
+    day: str,
+    archive_dir: str = config.ARCHIVE_DIR,
+) -> sqlite3.Connection | None:
+    if not PARTITION_PATTERN.match(f'{PARTITION_PREFIX}{day}{PARTITION_SUFFIX}'):
+        return None
+    path = partition_path(day, archive_dir)
+    if not os.path.exists(path):
+        return None
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def database_size(db_conn: sqlite3.Connection, schema: str = 'main') -> int:
+    page_size = db_conn.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+    page_count = db_conn.execute(f'PRAGMA {schema}.page_count').fetchone()[0]
+    free_pages = db_conn.execute(
+        f'PRAGMA {schema}.freelist_count',
+    ).fetchone()[0]
+    return (page_count - free_pages) * page_size
+
+
+def _columns(db_conn: sqlite3.Connection, table: str) -> str:
+    return ', '.join(
+        row[1] for row in db_conn.execute(f'PRAGMA main.table_info({table})')
+    )
+
+
+class Retention:
+    def __init__(
+        self,
+        db_path: str = config.DB,
+        archive_dir: str = config.ARCHIVE_DIR,
+        policy: RetentionPolicy | None = None,
+    ) -> None:
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.policy = policy if policy is not None else RetentionPolicy()
+        self.db_conn = sqlite3.connect(
+            db_path,
+            timeout=BUSY_TIMEOUT_SECONDS,
+            isolation_level=None,
+        )
+        init_db(self.db_conn)
+        self.db_conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS rotated (id INTEGER PRIMARY KEY)
+        ''')
+        self.columns = {
+            table: _columns(self.db_conn, table)
+            for table in (
+                'request',
+                'response',
+                'trace',
+                'header_field',
+                'websocket_message',
+                'finding',
+            )
+        }
+
+    def close(self):
+        self.db_conn.close()
+
+    def _attach(self, day: str):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = partition_path(day, self.archive_dir)
+        partition_conn = sqlite3.connect(path)
+        init_db(partition_conn)
+        partition_conn.close()
+        self.db_conn.execute('ATTACH DATABASE ? AS partition', (path,))
+
+    def _detach(self):
+        self.db_conn.execute('DETACH DATABASE partition')
+
+    def _copy_header_fields(self):
+        # header ids are global, so a partition carries the dictionary as
+        # of the time its rows were moved and their refs stay valid
+        columns = self.columns['header_field']
+        self.db_conn.execute(f'''
+            INSERT OR IGNORE INTO partition.header_field ({columns})
+            SELECT {columns} FROM main.header_field
+            WHERE id > (SELECT coalesce(max(id), 0) FROM partition.header_field)
+        ''')
+
+    def _move_requests(self, cutoff: float, limit: int) -> int:
+        # ids do not follow capture time (HAR imports keep their original
+        # timestamps), so each batch takes the oldest rows of one day
+        oldest = self.db_conn.execute('''
+            SELECT created_at FROM request
+            WHERE created_at < ? ORDER BY created_at LIMIT 1
+        ''', (cutoff,)).fetchone()
+        if oldest is None:
+            return 0
+
+        day = partition_day(oldest[0])
+        day_start = _day_start(day)
+        cutoff = min(cutoff, _day_end(day))
+        request_columns = self.columns['request']
+        response_columns = self.columns['response']
+        message_columns = self.columns['websocket_message']
+        finding_columns = self.columns['finding']
+        self._attach(day)
+        try:
+            self.db_conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.db_conn.execute('DELETE FROM temp.rotated')
+                self.db_conn.execute('''
+                    INSERT INTO temp.rotated
+                    SELECT id FROM main.request
+                    WHERE created_at >= ? AND created_at < ?
+                    ORDER BY created_at LIMIT ?
+                ''', (day_start, cutoff, limit))
+                self._copy_header_fields()
+                moved = self.db_conn.execute(f'''
+                    INSERT OR REPLACE INTO partition.request ({request_columns})
+                    SELECT {request_columns} FROM main.request
+                    WHERE id IN (SELECT id FROM temp.rotated)
+                ''').rowcount
+                responses = self.db_conn.execute(f'''
+                    INSERT OR REPLACE INTO partition.response ({response_columns})
+                    SELECT {response_columns} FROM main.response
+                    WHERE request_id IN (SELECT id FROM temp.rotated)
+                ''').rowcount
+                self.db_conn.execute(f'''
+                    INSERT OR REPLACE INTO partition.websocket_message ({message_columns})
+                    SELECT {message_columns} FROM main.websocket_message
+                    WHERE request_id IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute(f'''
+                    INSERT OR REPLACE INTO partition.finding ({finding_columns})
+                    SELECT {finding_columns} FROM main.finding
+                    WHERE request_id IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute('''
+                    DELETE FROM main.response
+                    WHERE request_id IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute('''
+                    DELETE FROM main.websocket_message
+                    WHERE request_id IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute('''
+                    DELETE FROM main.finding
+                    WHERE request_id IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute('''
+                    DELETE FROM main.request
+                    WHERE id IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute('COMMIT')
+            except BaseException:
+                self.db_conn.execute('ROLLBACK')
+                raise
+        finally:
+            self._detach()
+
+        ROWS_ROTATED.labels('request').inc(moved)
+        ROWS_ROTATED.labels('response').inc(responses)
+        return moved
+
+    def _move_traces(self, cutoff: float) -> int:
+        oldest = self.db_conn.execute('''
+            SELECT started_at FROM trace
+            WHERE started_at < ? ORDER BY started_at LIMIT 1
+        ''', (cutoff,)).fetchone()
+        if oldest is None:
+            return 0
+
+        day = partition_day(oldest[0])
+        cutoff = min(cutoff, _day_end(day))
+        columns = self.columns['trace']
+        self._attach(day)
+        try:
+            self.db_conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.db_conn.execute('DELETE FROM temp.rotated')
+                self.db_conn.execute('''
+                    INSERT INTO temp.rotated
+                    SELECT rowid FROM main.trace
+                    WHERE started_at < ? ORDER BY started_at LIMIT ?
+                ''', (cutoff, ROTATE_BATCH_SIZE))
+                moved = self.db_conn.execute(f'''
+                    INSERT OR REPLACE INTO partition.trace ({columns})
+                    SELECT {columns} FROM main.trace
+                    WHERE rowid IN (SELECT id FROM temp.rotated)
+                ''').rowcount
+                self.db_conn.execute('''
+                    DELETE FROM main.trace
+                    WHERE rowid IN (SELECT id FROM temp.rotated)
+                ''')
+                self.db_conn.execute('COMMIT')
+            except BaseException:
+                self.db_conn.execute('ROLLBACK')
+                raise
+        finally:
+            self._detach()
+
+        ROWS_ROTATED.labels('trace').inc(moved)
+        return moved
+
+    def _over_limits(self) -> int:
+        excess = 0
+        if self.policy.max_rows:
+            count = self.db_conn.execute(
+                'SELECT count(*) FROM request',
+            ).fetchone()[0]
+            excess = max(count - self.policy.max_rows, 0)
+        if not excess and self.policy.max_bytes:
+            if database_size(self.db_conn) > self.policy.max_bytes:
+                excess = ROTATE_BATCH_SIZE
+        return excess
+
+    def rotate(self, now: float | None = None, stop=None) -> int:
+        now = time.time() if now is None else now
+        cutoff = now - self.policy.hot_seconds
+        total = 0
+
+        while not (stop and stop.is_set()):
+            moved = self._move_requests(cutoff, ROTATE_BATCH_SIZE)
+            if not moved:
+                break
+            total += moved
+            time.sleep(STEP_PAUSE_SECONDS)
+
+        while not (stop and stop.is_set()):
+            if not self._move_traces(cutoff):
+                break
+            time.sleep(STEP_PAUSE_SECONDS)
+
+        while not (stop and stop.is_set()):
+            excess = self._over_limits()
+            if not excess:
+                break
+            moved = self._move_requests(
+                float('inf'),
+                min(excess, ROTATE_BATCH_SIZE),
+            )
+            if not moved:
+                break
+            total += moved
+            # deleted pages only count as free once they are vacuumed
+            self.vacuum(stop)
+        return total
+
+    def vacuum(self, stop=None) -> int:
+        auto_vacuum = self.db_conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if auto_vacuum != 2:
+            # databases created before incremental vacuum was enabled
+            # still reuse their free pages, the file just does not shrink
+            return 0
+
+        vacuumed = 0
+        while not (stop and stop.is_set()):
+            free_pages = self.db_conn.execute(
+                'PRAGMA freelist_count',
+            ).fetchone()[0]
+            if not free_pages:
+                break
+            step = min(free_pages, VACUUM_STEP_PAGES)
+            self.db_conn.execute(f'PRAGMA incremental_vacuum({step})')
+            vacuumed += step
+            PAGES_VACUUMED.inc(step)
+            time.sleep(STEP_PAUSE_SECONDS)
+        return vacuumed
+
+    def expire_partitions(self, now: float | None = None) -> list[str]:
+        now = time.time() if now is None else now
+        days = list_partitions(self.archive_dir)
+        expired = []
+        if self.policy.archive_days:
+            oldest_kept = partition_day(now - self.policy.archive_days * DAY_SECONDS)
+            expired = [day for day in days if day < oldest_kept]
+            days = days[len(expired):]
+
+        if self.policy.archive_max_bytes:
+            sizes = {
+                day: os.path.getsize(partition_path(day, self.archive_dir))
+                for day in days
+            }
+            total = sum(sizes.values())
+            # the newest partition may still be written to, keep it
+            for day in days[:-1]:
+                if total <= self.policy.archive_max_bytes:
+                    break
+                expired.append(day)
+                total -= sizes[day]
+
+        for day in expired:
+            os.remove(partition_path(day, self.archive_dir))
+            PARTITIONS_DELETED.inc()
+        return expired
+
+    def run_once(self, now: float | None = None, stop=None):
+        with RETENTION_RUN_SECONDS.time():
+            self.rotate(now, stop)
+            self.vacuum(stop)
+            self.expire_partitions(now)
+        PARTITIONS.set(len(list_partitions(self.archive_dir)))
+        LIVE_DATABASE_BYTES.set(database_size(self.db_conn))
+
+
+class RetentionThread(threading.Thread):
+    def __init__(
+        self,
+        db_path: str = config.DB,
+        archive_dir: str = config.ARCHIVE_DIR,
+        policy: RetentionPolicy | None = None,
+        interval: float = config.RETENTION_INTERVAL_SECONDS,
+    ) -> None:
+        super().__init__(name='retention', daemon=True)
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.policy = policy
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        retention = Retention(self.db_path, self.archive_dir, self.policy)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    retention.run_once(stop=self.stopping)
+                except (sqlite3.Error, OSError) as e:
+                    print(f'retention pass failed: {e}')
+                self.stopping.wait(self.interval)
+        finally:
+            retention.close()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+
+def start_retention() -> RetentionThread:
+    retention_thread = RetentionThread()
+    retention_thread.start()
+    return retention_thread
@@ -0,0 +1,13 @@
+import subprocess
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def openssl(*args):
+    subprocess.run(['openssl', *args], check=True, capture_output=True)
@@ -0,0 +1,121 @@
+import socket
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.proxy import ServerOptions, ThreadingProxy
+
+
+class BlockingHandler:
+    # holds its worker until released, then answers with a single line
+    release = None
+    started = None
+
+    def __init__(self, request, client_address, server, capture):
+        type(self).started.release()
+        type(self).release.wait(5)
+        request.sendall(b'done')
+
+
+@pytest.fixture
+def handler():
+    BlockingHandler.release = threading.Event()
+    BlockingHandler.started = threading.Semaphore(0)
+    yield BlockingHandler
+    BlockingHandler.release.set()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(handler, **options):
+        server = ThreadingProxy(
+            ('127.0.0.1', 0),
+            handler,
+            MagicMock(),
+            options=ServerOptions(**options),
+        )
+        threading.Thread(
+            target=server.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            daemon=True,
+        ).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _connect(server) -> socket.socket:
+    client = socket.create_connection(server.server_address, timeout=5)
+    client.sendall(b'GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n')
+    return client
+
+
+def _read_all(client: socket.socket) -> bytes:
+    data = b''
+    while chunk := client.recv(4096):
+        data += chunk
+    return data
+
+
+def test_full_queue_is_shed_with_503(serve, handler):
+    server = serve(handler, max_workers=2, queue_depth=1, backlog=16)
+    busy = [_connect(server) for _ in range(2)]
+    for _ in busy:
+        assert handler.started.acquire(timeout=5)
+    queued = _connect(server)
+
+    shed = _connect(server)
+    response = _read_all(shed)
+    assert response.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+    assert b'Retry-After: 1\r\n' in response
+
+    # the connections that were let in are all served once workers free up
+    handler.release.set()
+    for client in busy + [queued]:
+        assert _read_all(client) == b'done'
+    assert len(server._workers) == 2
+
+
+def test_per_ip_limit_refuses_connections(serve, handler):
+    server = serve(
+        handler,
+        max_workers=4,
+        max_connections_per_ip=1,
+        shed_policy='refuse',
+    )
+    first = _connect(server)
+    assert handler.started.acquire(timeout=5)
+
+    with pytest.raises(ConnectionResetError):
+        _read_all(_connect(server))
+
+    handler.release.set()
+    assert _read_all(first) == b'done'
+    # the slot is given back when the connection ends
+    handler.release.clear()
+    second = _connect(server)
+    assert handler.started.acquire(timeout=5)
+    handler.release.set()
+    assert _read_all(second) == b'done'
+
+
+def test_workers_stop_on_close(handler):
+    handler.release.set()
+    server = ThreadingProxy(('127.0.0.1', 0), handler, MagicMock())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    assert _read_all(_connect(server)) == b'done'
+    server.shutdown()
+    server.server_close()
+    assert not any(worker.is_alive() for worker in server._workers)
+
+
+def test_unknown_shed_policy_is_rejected():
+    with pytest.raises(ValueError):
+        ServerOptions(shed_policy='drop')
@@ -0,0 +1,73 @@
+import io
+import os
+import sqlite3
+
+import pytest
+
+from src import body_file
+from src.body_file import BODY_SIZE_SQL, BodyFile
+from src.db import init_db
+
+
+class NoBlobConnection:
+    # a connection as Python 3.10 has it, without incremental blob I/O
+    def __init__(self, db_conn: sqlite3.Connection) -> None:
+        self.db_conn = db_conn
+
+    def execute(self, *args):
+        return self.db_conn.execute(*args)
+
+
+def _db(body) -> sqlite3.Connection:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    db_conn.execute('INSERT INTO response (id, body) VALUES (1, ?)', (body,))
+    return db_conn
+
+
+def _open(db_conn, blob_io: bool, **kwargs) -> BodyFile:
+    size = db_conn.execute(
+        f'SELECT {BODY_SIZE_SQL} FROM response WHERE id = 1',
+    ).fetchone()[0] or 0
+    conn = db_conn if blob_io else NoBlobConnection(db_conn)
+    return BodyFile(conn, 'response', 1, size, **kwargs)
+
+
+@pytest.mark.parametrize('blob_io', [True, False])
+def test_reads_and_seeks_like_a_file(blob_io, monkeypatch):
+    monkeypatch.setattr(body_file, 'FALLBACK_READ_SIZE', 1000)
+    data = os.urandom(5000)
+    body = _open(_db(data), blob_io)
+
+    assert body.size == len(data)
+    assert body.read(10) == data[:10]
+    body.seek(4990)
+    assert body.read(100) == data[4990:]
+    assert body.read(1) == b''
+    body.seek(-3000, io.SEEK_END)
+    assert body.read(2500) == data[2000:4500]
+    body.seek(0)
+    assert io.BufferedReader(body, 64).read() == data
+
+
+@pytest.mark.parametrize('blob_io', [True, False])
+def test_text_bodies_are_read_as_utf8(blob_io):
+    text = 'zürich ' * 100
+    body = _open(_db(text), blob_io)
+
+    assert body.size == len(text.encode())
+    body.seek(1)
+    assert body.read(6) == 'ürich'.encode()
+
+
+def test_close_gives_the_connection_back_once():
+    released = []
+    body = _open(_db(b'abc'), True, on_close=lambda: released.append(True))
+    body.close()
+    body.close()
+    assert released == [True]
+    with pytest.raises(ValueError):
+        body.read()
+
+    empty = _open(_db(None), True)
+    assert (empty.size, empty.read()) == (0, b'')
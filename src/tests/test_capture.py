@@ -0,0 +1,88 @@
+import queue
+import sqlite3
+
+from src.capture import EXCHANGE, QueueCapture, SQLiteCapture, run_capture_writer
+from src.db import init_db
+from src.request import Request
+from src.response import Response
+from src import tracing
+
+
+RAW_REQUEST = b'GET /?a=1 HTTP/1.1\r\nHost: example.com\r\n\r\n'
+RAW_RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+
+def _capture() -> SQLiteCapture:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    return SQLiteCapture(db_conn)
+
+
+def test_save_exchange_links_response_to_request():
+    capture = _capture()
+    request_id = capture.save_exchange(
+        Request.from_raw_request(RAW_REQUEST),
+        Response.from_raw_response(RAW_RESPONSE),
+        True,
+    )
+
+    assert capture.db_conn.execute(
+        'SELECT is_https FROM request WHERE id = ?', (request_id,),
+    ).fetchone() == (1,)
+    assert capture.db_conn.execute(
+        'SELECT request_id, code FROM response',
+    ).fetchall() == [(request_id, 200)]
+
+
+def test_save_exchange_without_response():
+    capture = _capture()
+    capture.save_exchange(Request.from_raw_request(RAW_REQUEST))
+    assert capture.db_conn.execute(
+        'SELECT COUNT(*) FROM response',
+    ).fetchone() == (0,)
+
+
+def test_write_batch_skips_broken_records():
+    capture = _capture()
+    trace = tracing.Trace(('127.0.0.1', 1))
+    trace.finish()
+    records = [
+        (EXCHANGE, Request.from_raw_request(RAW_REQUEST), None, False),
+        (EXCHANGE, None, None, False),
+        ('trace', trace),
+    ]
+
+    assert capture.write_batch(records) == 2
+    assert capture.db_conn.execute(
+        'SELECT COUNT(*) FROM request',
+    ).fetchone() == (1,)
+    assert capture.db_conn.execute(
+        'SELECT trace_id FROM trace',
+    ).fetchone() == (trace.trace_id,)
+
+
+def test_queue_capture_feeds_writer(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    capture_queue = queue.Queue()
+    capture = QueueCapture(capture_queue)
+    for _ in range(3):
+        capture.save_exchange(
+            Request.from_raw_request(RAW_REQUEST),
+            Response.from_raw_response(RAW_RESPONSE),
+        )
+    capture_queue.put(None)
+
+    run_capture_writer(capture_queue, db_path)
+
+    db_conn = sqlite3.connect(db_path)
+    assert db_conn.execute(
+        'SELECT COUNT(*) FROM response r JOIN request q ON r.request_id = q.id',
+    ).fetchone() == (3,)
+
+
+def test_queue_capture_drops_when_full():
+    capture_queue = queue.Queue(maxsize=1)
+    capture = QueueCapture(capture_queue)
+    capture.save_exchange(Request.from_raw_request(RAW_REQUEST))
+    capture.save_exchange(Request.from_raw_request(RAW_REQUEST))
+    assert capture_queue.qsize() == 1
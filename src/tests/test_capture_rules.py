@@ -0,0 +1,139 @@
+import json
+import os
+
+import pytest
+
+from src.capture_rules import (
+    CAPTURE,
+    HEADERS,
+    SKIP,
+    CaptureRules,
+    RuleError,
+    RuleSet,
+    apply_decision,
+)
+from src.request import Request
+from src.response import Response
+
+
+def _request(host: str = 'example.com', path: str = '/', body: bytes = b''):
+    return Request.from_raw_request(
+        f'POST {path} HTTP/1.1\r\nHost: {host}\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+    )
+
+
+def _response(content_type: str = 'text/html', body: bytes = b'ok'):
+    return Response.from_raw_response(
+        f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+    )
+
+
+def test_first_matching_rule_wins():
+    rule_set = RuleSet.from_dict({
+        'rules': [
+            {'host': '*.cdn.example.com', 'action': SKIP},
+            {'host': 'api.example.com', 'path': '/static/*', 'action': SKIP},
+            {'host': ['api.example.com', 'www.example.com'], 'action': CAPTURE},
+        ],
+        'default': {'action': SKIP},
+    })
+
+    assert rule_set.decide(_request('img.cdn.example.com')).action == SKIP
+    assert rule_set.decide(_request('api.example.com', '/static/a.js')).action == SKIP
+    assert rule_set.decide(_request('API.example.com', '/users')).action == CAPTURE
+    assert rule_set.decide(_request('other.org')).action == SKIP
+
+
+def test_content_type_rule_needs_a_response():
+    rule_set = RuleSet.from_dict({
+        'rules': [{'content_type': ['video/*', 'image/*'], 'action': HEADERS}],
+    })
+
+    assert rule_set.decide(_request(), _response('video/mp4')).action == HEADERS
+    assert rule_set.decide(
+        _request(), _response('image/png; charset=binary'),
+    ).action == HEADERS
+    assert rule_set.decide(_request(), _response('text/html')).action == CAPTURE
+    assert rule_set.decide(_request()).action == CAPTURE
+
+
+def test_sampled_rule_skips_the_rest(monkeypatch):
+    rule_set = RuleSet.from_dict({
+        'rules': [{'host': 'busy.example.com', 'sample': 0.25}],
+    })
+
+    monkeypatch.setattr('random.random', lambda: 0.1)
+    assert rule_set.decide(_request('busy.example.com')).action == CAPTURE
+    monkeypatch.setattr('random.random', lambda: 0.5)
+    assert rule_set.decide(_request('busy.example.com')).action == SKIP
+    assert not rule_set.skips_host('busy.example.com')
+
+
+def test_skips_host_only_for_unconditional_rules():
+    rule_set = RuleSet.from_dict({
+        'rules': [
+            {'host': 'a.example.com', 'path': '/keep', 'action': CAPTURE},
+            {'host': '*.example.com', 'action': SKIP},
+        ],
+    })
+
+    assert rule_set.skips_host('b.example.com')
+    assert not rule_set.skips_host('a.example.com')
+    assert not rule_set.skips_host('example.org')
+
+
+def test_apply_decision_limits_stored_bodies():
+    rule_set = RuleSet.from_dict({
+        'rules': [
+            {'path': '/upload', 'max_body': 4},
+            {'path': '/headers', 'action': HEADERS},
+        ],
+    })
+
+    request = _request(path='/upload', body=b'a=123456')
+    response = _response(body=b'0123456789')
+    assert apply_decision(rule_set.decide(request, response), request, response)
+    assert request.body == b'a=12'
+    assert response.body == b'0123'
+
+    request = _request(path='/headers', body=b'payload')
+    response = _response(body=b'0123456789')
+    assert apply_decision(rule_set.decide(request, response), request, response)
+    assert request.body is None
+    assert response.body == b''
+    assert response.headers['Content-Type'] == 'text/html'
+
+
+@pytest.mark.parametrize('rules', [
+    {'rules': [{'action': 'drop'}]},
+    {'rules': [{'max_body': -1}]},
+    {'rules': [{'sample': 2}]},
+    {'rules': [{'hostname': 'example.com'}]},
+    {'default': {'host': 'example.com'}},
+])
+def test_invalid_rules_are_rejected(rules):
+    with pytest.raises(RuleError):
+        RuleSet.from_dict(rules)
+
+
+def test_rules_are_reloaded_when_the_file_changes(tmp_path):
+    path = tmp_path / 'rules.json'
+    capture_rules = CaptureRules(str(path))
+    assert capture_rules.should_capture(_request())
+
+    path.write_text(json.dumps({'default': {'action': SKIP}}))
+    assert capture_rules.reload()
+    assert not capture_rules.should_capture(_request())
+
+    # a broken file keeps the previous rules
+    path.write_text('{')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert not capture_rules.reload()
+    assert not capture_rules.should_capture(_request())
+
+    path.unlink()
+    assert capture_rules.reload()
+    assert capture_rules.should_capture(_request())
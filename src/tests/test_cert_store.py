@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import FakeClock, openssl
+from src.cert_store import DAY, CertStore
+from src.cert_utils import CERT_VALID_DAYS
+
+
+NOW = 1_700_000_000.0
+
+
+@pytest.fixture
+def ca(tmp_path):
+    ca_key = str(tmp_path / 'ca.key')
+    ca_cert = str(tmp_path / 'ca.crt')
+    cert_key = str(tmp_path / 'cert.key')
+    openssl('genrsa', '-out', ca_key, '2048')
+    openssl(
+        'req', '-new', '-x509', '-days', '1', '-key', ca_key,
+        '-out', ca_cert, '-subj', '/CN=test CA',
+    )
+    openssl('genrsa', '-out', cert_key, '2048')
+    return tmp_path, ca_key, ca_cert, cert_key
+
+
+class Generator:
+    def __init__(self, ca) -> None:
+        self.directory, self.ca_key, self.ca_cert, self.cert_key = ca
+        self.hosts = []
+
+    def __call__(self, host: str, serial: int):
+        self.hosts.append(host)
+        csr = str(self.directory / f'{host}.csr')
+        cert = str(self.directory / f'{host}_{serial}.crt')
+        openssl('req', '-new', '-key', self.cert_key, '-out', csr, '-subj', f'/CN={host}')
+        openssl(
+            'x509', '-req', '-days', '1', '-in', csr, '-CA', self.ca_cert,
+            '-CAkey', self.ca_key, '-set_serial', str(serial), '-out', cert,
+        )
+        return cert, self.cert_key
+
+
+def _store(ca, generator, clock=None, **kwargs) -> CertStore:
+    directory, _, ca_cert, cert_key = ca
+    return CertStore(
+        path=str(directory / 'certs.db'),
+        ca_cert=ca_cert,
+        cert_key=cert_key,
+        renew_before=DAY,
+        generate=generator,
+        clock=clock or FakeClock(NOW),
+        **kwargs,
+    )
+
+
+def test_certificates_survive_restarts(ca):
+    generator = Generator(ca)
+    store = _store(ca, generator)
+    context = store.context_for('Example.com')
+    assert store.context_for('example.com') is context
+    store.close()
+
+    restarted = _store(ca, generator)
+    assert restarted.context_for('example.com') is not None
+    assert generator.hosts == ['example.com']
+    # the generated file is only kept in the store
+    assert not list(ca[0].glob('example.com_*.crt'))
+
+
+def test_expiring_certificates_are_renewed_and_collected(ca):
+    generator = Generator(ca)
+    clock = FakeClock(NOW)
+    store = _store(ca, generator, clock, gc_interval=0)
+    store.context_for('a.example')
+    store.context_for('b.example')
+
+    clock.now += (CERT_VALID_DAYS - 1) * DAY + 1
+    store.context_for('a.example')
+    assert generator.hosts == ['a.example', 'b.example', 'a.example']
+
+    clock.now += 2 * DAY
+    store.collect()
+    db_conn = sqlite3.connect(store.path)
+    assert db_conn.execute('SELECT host FROM certificate').fetchall() == [
+        ('a.example',),
+    ]
+
+
+def test_changed_ca_invalidates_stored_certificates(ca):
+    generator = Generator(ca)
+    store = _store(ca, generator)
+    store.context_for('example.com')
+    store.close()
+
+    directory, ca_key, ca_cert, _ = ca
+    os.remove(ca_cert)
+    openssl(
+        'req', '-new', '-x509', '-days', '1', '-key', ca_key,
+        '-out', ca_cert, '-subj', '/CN=new test CA',
+    )
+    _store(ca, generator).context_for('example.com')
+    assert generator.hosts == ['example.com', 'example.com']
+
+
+def test_concurrent_handshakes_share_one_generation(ca):
+    generator = Generator(ca)
+    store = _store(ca, generator, cache_size=1)
+    contexts = []
+    threads = [
+        threading.Thread(
+            target=lambda: contexts.append(store.context_for('example.com')),
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert generator.hosts == ['example.com']
+    assert len({id(context) for context in contexts}) == 1
+
+    store.context_for('other.example')
+    assert len(store) == 1
@@ -0,0 +1,155 @@
+import socket
+import sqlite3
+import threading
+
+from src.capture import EXCHANGE, MESSAGES, TRACE
+from src.collector import Collector, CollectorRequestHandler
+from src.remote_capture import (
+    ACK,
+    ACK_TIMEOUT,
+    FRAME_HEADER,
+    RemoteCapture,
+    Spool,
+    decode_batch,
+    encode_batch,
+    recv_exactly,
+)
+from src.request import Request
+from src.response import Response
+from src import tracing
+from src.websocket import CLIENT, TEXT, Message
+
+
+RAW_REQUEST = (
+    b'POST /form?a=1 HTTP/1.1\r\nHost: example.com\r\nCookie: id=7\r\n'
+    b'Content-Type: application/x-www-form-urlencoded\r\n'
+    b'Content-Length: 3\r\n\r\nb=2'
+)
+RAW_RESPONSE = b'HTTP/1.1 200 OK\r\nSet-Cookie: s=1\r\nContent-Length: 2\r\n\r\n\xff\x00'
+
+
+def _records() -> list[tuple]:
+    request = Request.from_raw_request(RAW_REQUEST)
+    request.trace_id = 'trace-1'
+    trace = tracing.Trace(('10.0.0.1', 1))
+    trace.add_span('upstream', trace.origin + 0.5, trace.origin + 1.5)
+    trace.finish()
+    return [
+        (EXCHANGE, request, Response.from_raw_response(RAW_RESPONSE), True, 's', 1234.5),
+        (MESSAGES, 's', [Message(CLIENT, TEXT, b'hi', 2, False, 1235.0)], True),
+        (TRACE, trace),
+    ]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_collector(port: int, db_path: str) -> Collector:
+    collector = Collector(('127.0.0.1', port), db_path)
+    threading.Thread(
+        target=collector.serve_forever,
+        kwargs={'poll_interval': 0.05},
+        daemon=True,
+    ).start()
+    return collector
+
+
+def test_batch_round_trip_keeps_what_is_stored():
+    records = _records()
+    session, node, seq, decoded = decode_batch(encode_batch('abc', 'node-1', 3, records))
+    assert (session, node, seq) == ('abc', 'node-1', 3)
+
+    (_, request, response, is_https, stream_id, created_at), messages, trace = decoded
+    assert (request.method, request.host, request.path, request.query) == (
+        'POST', 'example.com', '/form', 'a=1',
+    )
+    original = records[0][1]
+    assert request.get_params == original.get_params
+    assert request.post_params == original.post_params
+    assert request.cookies['id'].value == '7'
+    assert request.trace_id == 'trace-1'
+    assert (response.code, response.body) == (200, b'\xff\x00')
+    assert response.set_cookie['s'].value == '1'
+    assert (is_https, stream_id, created_at) == (True, 's', 1234.5)
+    assert messages[2][0].payload == b'hi'
+    assert trace[1].to_dict()['spans'] == records[2][1].to_dict()['spans']
+
+
+def test_captures_are_spooled_until_the_collector_is_up(tmp_path):
+    port = _free_port()
+    capture = RemoteCapture(
+        address=('127.0.0.1', port),
+        node='node-1',
+        spool=Spool(str(tmp_path / 'spool')),
+        flush_interval=0.05,
+        min_retry=0.05,
+    )
+    capture.start()
+    for record in _records():
+        capture._put(record)
+    # nothing listens yet, so the batch ends up on disk
+    while not capture.spool:
+        threading.Event().wait(0.01)
+
+    db_path = str(tmp_path / 'central.db')
+    collector = _start_collector(port, db_path)
+    try:
+        capture.stop(5)
+    finally:
+        collector.shutdown()
+        collector.server_close()
+
+    assert not capture.spool
+    db_conn = sqlite3.connect(db_path)
+    assert db_conn.execute(
+        'SELECT q.host, q.is_https, q.created_at, r.code FROM request q '
+        'JOIN response r ON r.request_id = q.id',
+    ).fetchall() == [('example.com', 1, 1234.5, 200)]
+    assert db_conn.execute(
+        'SELECT request_id, payload FROM websocket_message',
+    ).fetchall() == [(1, b'hi')]
+    assert db_conn.execute('SELECT COUNT(*) FROM trace').fetchone() == (1,)
+
+
+def test_collector_skips_batches_it_already_has(tmp_path):
+    port = _free_port()
+    collector = _start_collector(port, str(tmp_path / 'central.db'))
+    frame = encode_batch('session', 'node-1', 1, _records()[:1])
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            for _ in range(2):
+                sock.sendall(FRAME_HEADER.pack(len(frame)) + frame)
+                assert ACK.unpack(recv_exactly(sock, ACK.size)) == (1, 0)
+            sock.sendall(FRAME_HEADER.pack(3) + b'bad')
+            assert ACK.unpack(recv_exactly(sock, ACK.size)) == (0, 1)
+        assert collector.store.db_conn.execute(
+            'SELECT COUNT(*) FROM request',
+        ).fetchone() == (1,)
+    finally:
+        collector.shutdown()
+        collector.server_close()
+
+
+def test_stalled_node_is_disconnected(tmp_path, monkeypatch):
+    assert CollectorRequestHandler.timeout == ACK_TIMEOUT
+    monkeypatch.setattr(CollectorRequestHandler, 'timeout', 0.2)
+    errors = []
+    monkeypatch.setattr(
+        Collector,
+        'handle_error',
+        lambda self, request, address: errors.append(address),
+    )
+    port = _free_port()
+    collector = _start_collector(port, str(tmp_path / 'central.db'))
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            # the frame never arrives in full
+            sock.sendall(FRAME_HEADER.pack(100) + b'partial')
+            assert sock.recv(1) == b''
+        assert errors == []
+    finally:
+        collector.shutdown()
+        collector.server_close()
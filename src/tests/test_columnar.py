@@ -0,0 +1,117 @@
+import gzip
+import os
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import config
+from src.capture import EXCHANGE, SQLiteCapture
+from src.columnar import STATE_FILE, body_path, export_captures
+from src.db import init_db
+from src.request import Request
+from src.response import Response
+
+
+DAY = 24 * 60 * 60
+FIRST_DAY = 1_700_006_400  # 2023-11-15 00:00 UTC
+BODY = gzip.compress(b'hello world ' * 20)
+
+
+def _db(tmp_path) -> tuple[str, sqlite3.Connection]:
+    db_path = str(tmp_path / 'proxy.db')
+    db_conn = sqlite3.connect(db_path)
+    init_db(db_conn)
+    return db_path, db_conn
+
+
+def _write(db_conn: sqlite3.Connection, created_at: list[float], answered: bool = True):
+    records = []
+    for i, timestamp in enumerate(created_at):
+        request = Request.from_raw_request(
+            f'GET /items/{i}?q=a+b&q=c HTTP/1.1\r\nHost: example.com\r\n'
+            'User-Agent: test/1.0\r\nX-Other: 1\r\n\r\n'.encode(),
+        )
+        response = None
+        if answered:
+            response = Response.from_raw_response(
+                b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+                b'Content-Encoding: gzip\r\n'
+                b'Content-Length: %d\r\n\r\n' % len(BODY) + BODY,
+            )
+            response.duration = 0.25
+        records.append((EXCHANGE, request, response, True, None, timestamp))
+    SQLiteCapture(db_conn).write_batch(records)
+
+
+def _read(directory, fmt: str = 'parquet') -> pa.Table:
+    return ds.dataset(
+        directory,
+        format='ipc' if fmt == 'arrow' else fmt,
+        partitioning='hive',
+    ).to_table().sort_by('id')
+
+
+def test_export_writes_typed_day_partitions(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'EXPORT_ROW_GROUP_ROWS', 2)
+    db_path, db_conn = _db(tmp_path)
+    _write(db_conn, [FIRST_DAY + 10, FIRST_DAY + 20, FIRST_DAY + DAY + 5])
+    _write(db_conn, [FIRST_DAY + 30], answered=False)
+    out = tmp_path / 'export'
+
+    assert export_captures(db_path, str(out), batch_size=2) == 4
+    assert sorted(os.listdir(out / 'date=2023-11-15')) == [
+        'part-000000000001-000000000004.parquet',
+    ]
+    table = _read(out)
+    assert table.schema.field('created_at').type == pa.timestamp('us', tz='UTC')
+    assert table.schema.field('status').type == pa.int32()
+    rows = table.to_pylist()
+    assert [row['id'] for row in rows] == [1, 2, 3, 4]
+    first = rows[0]
+    assert first['created_at'].timestamp() == FIRST_DAY + 10
+    assert (first['method'], first['host'], first['path'], first['query']) == (
+        'GET', 'example.com', '/items/0', 'q=a+b&q=c',
+    )
+    assert first['request_user_agent'] == 'test/1.0'
+    assert {'name': 'X-Other', 'value': '1'} in first['request_headers']
+    assert (first['status'], first['duration'], first['response_content_encoding']) == (
+        200, 0.25, 'gzip',
+    )
+    assert first['response_body_size'] == len(BODY)
+    assert (rows[3]['status'], rows[3]['response_headers']) == (None, [])
+
+
+def test_export_resumes_after_the_last_exported_id(tmp_path):
+    db_path, db_conn = _db(tmp_path)
+    out = str(tmp_path / 'export')
+    _write(db_conn, [FIRST_DAY, FIRST_DAY + 1])
+    assert export_captures(db_path, out, fmt='arrow') == 2
+    assert export_captures(db_path, out, fmt='arrow') == 0
+
+    # an interrupted export leaves only a temporary file behind
+    stray = tmp_path / 'export' / 'date=2023-11-15' / '.part-000000000009.tmp'
+    stray.write_bytes(b'partial')
+    _write(db_conn, [FIRST_DAY + 2, FIRST_DAY + DAY])
+    assert export_captures(db_path, out, fmt='arrow') == 2
+
+    assert not stray.exists()
+    assert _read(out, 'arrow').column('id').to_pylist() == [1, 2, 3, 4]
+    assert os.path.exists(os.path.join(out, STATE_FILE))
+
+
+def test_bodies_are_stored_by_reference_once(tmp_path):
+    db_path, db_conn = _db(tmp_path)
+    _write(db_conn, [FIRST_DAY, FIRST_DAY + 1])
+    out = str(tmp_path / 'export')
+
+    export_captures(db_path, out, bodies='ref')
+    rows = _read(out).to_pylist()
+    digests = {row['response_body_sha256'] for row in rows}
+    assert len(digests) == 1 and rows[0]['request_body_sha256'] is None
+    with open(body_path(out, digests.pop()), 'rb') as f:
+        assert f.read() == BODY
+
+    inline = str(tmp_path / 'inline')
+    export_captures(db_path, inline, bodies='inline')
+    assert _read(inline).column('response_body').to_pylist() == [BODY, BODY]
@@ -0,0 +1,175 @@
+import socket
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from conftest import FakeClock
+from src.deadlines import TIMEOUTS, Deadline, StageTimeout, Timeouts
+from src.proxy import ProxyRequestHandler, ServerOptions, ThreadingProxy
+
+
+def test_stage_timeout_is_blamed_on_the_tighter_limit():
+    clock = FakeClock(100.0)
+    deadline = Deadline(10, clock)
+
+    with pytest.raises(StageTimeout) as info:
+        with deadline.stage('connect', 3) as timeout:
+            assert timeout == 3
+            raise socket.timeout()
+    assert info.value.stage == 'connect'
+
+    clock.now += 8
+    with pytest.raises(StageTimeout) as info:
+        with deadline.stage('first_byte', 30) as timeout:
+            assert timeout == 2
+            raise socket.timeout()
+    assert info.value.stage == 'request'
+
+    clock.now += 2
+    with pytest.raises(StageTimeout):
+        with deadline.stage('connect', 3):
+            pytest.fail('an expired deadline starts no stage')
+
+
+class Upstream:
+    # accepts connections and answers them with a fixed reply, or not at all
+    def __init__(self, reply: bytes | None) -> None:
+        self.reply = reply
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.connections = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            conn.recv(4096)
+            if self.reply is not None:
+                conn.sendall(self.reply)
+
+    def close(self):
+        self.listener.close()
+        for conn in self.connections:
+            conn.close()
+
+
+@pytest.fixture
+def proxy():
+    servers = []
+
+    def start(**timeouts):
+        server = ThreadingProxy(
+            ('127.0.0.1', 0),
+            ProxyRequestHandler,
+            MagicMock(),
+            options=ServerOptions(timeouts=Timeouts(**timeouts)),
+        )
+        threading.Thread(
+            target=server.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            daemon=True,
+        ).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _read_all(client: socket.socket) -> bytes:
+    data = b''
+    while chunk := client.recv(4096):
+        data += chunk
+    return data
+
+
+def _count(stage: str) -> float:
+    return TIMEOUTS.labels(stage).get()
+
+
+def test_silent_upstream_gets_gateway_timeout(proxy):
+    upstream = Upstream(None)
+    server = proxy(first_byte=0.2)
+    before = _count('first_byte')
+    try:
+        client = socket.create_connection(server.server_address, timeout=5)
+        client.sendall(
+            f'GET http://127.0.0.1:{upstream.port}/ HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{upstream.port}\r\nConnection: close\r\n\r\n'.encode()
+        )
+        started = time.monotonic()
+        response = _read_all(client)
+    finally:
+        upstream.close()
+    assert response.startswith(b'HTTP/1.1 504 ')
+    assert time.monotonic() - started < 2
+    assert _count('first_byte') == before + 1
+
+
+def test_drip_feeding_upstream_is_cut_off_at_the_deadline(proxy):
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def drip():
+        conn, _ = listener.accept()
+        conn.recv(4096)
+        try:
+            conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n')
+            # every byte arrives well within the first byte timeout
+            for _ in range(100):
+                time.sleep(0.05)
+                conn.sendall(b'x')
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    threading.Thread(target=drip, daemon=True).start()
+    server = proxy(request=0.5, first_byte=1)
+    before = _count('request')
+    try:
+        client = socket.create_connection(server.server_address, timeout=5)
+        client.sendall(
+            f'GET http://127.0.0.1:{port}/ HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{port}\r\nConnection: close\r\n\r\n'.encode()
+        )
+        started = time.monotonic()
+        response = _read_all(client)
+    finally:
+        listener.close()
+    assert response.startswith(b'HTTP/1.1 504 ')
+    assert time.monotonic() - started < 2
+    assert _count('request') == before + 1
+
+
+def test_idle_tunnel_and_idle_client_are_closed(proxy):
+    upstream = Upstream(
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Connection: Upgrade\r\nUpgrade: echo\r\n\r\n'
+    )
+    server = proxy(tunnel_idle=0.2, client_idle=0.2)
+    tunnel_before = _count('tunnel_idle')
+    client_before = _count('client_idle')
+    try:
+        client = socket.create_connection(server.server_address, timeout=5)
+        client.sendall(
+            f'GET http://127.0.0.1:{upstream.port}/ HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{upstream.port}\r\n'
+            'Connection: Upgrade\r\nUpgrade: echo\r\n\r\n'.encode()
+        )
+        assert _read_all(client).startswith(b'HTTP/1.1 101 ')
+
+        idle = socket.create_connection(server.server_address, timeout=5)
+        assert _read_all(idle) == b''
+    finally:
+        upstream.close()
+    assert _count('tunnel_idle') == tunnel_before + 1
+    assert _count('client_idle') == client_before + 1
@@ -0,0 +1,168 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from conftest import FakeClock
+from src.dns_cache import (
+    DNSCache,
+    create_connection,
+    dns_cache,
+    happy_eyeballs_connect,
+    interleave_families,
+)
+
+
+def _addrinfo(ip: str, family=socket.AF_INET) -> tuple:
+    sockaddr = (ip, 0) if family == socket.AF_INET else (ip, 0, 0, 0)
+    return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr)
+
+
+class StubResolver:
+    def __init__(self, answers: dict) -> None:
+        self.answers = answers
+        self.calls = []
+
+    def __call__(self, host, port, family=0, type=0, proto=0, flags=0):
+        self.calls.append(host)
+        answer = self.answers.get(host)
+        if answer is None:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return answer
+
+
+def test_answers_are_cached_until_ttl_expires():
+    resolver = StubResolver({'example.com': [_addrinfo('192.0.2.1')]})
+    clock = FakeClock()
+    cache = DNSCache(resolver, ttl=60, clock=clock)
+
+    assert cache.resolve('example.com', 443)[0][4] == ('192.0.2.1', 443)
+    assert cache.resolve('EXAMPLE.com', 80)[0][4] == ('192.0.2.1', 80)
+    assert resolver.calls == ['example.com']
+
+    clock.now = 61
+    cache.resolve('example.com', 80)
+    assert resolver.calls == ['example.com', 'example.com']
+
+
+def test_failures_are_cached_for_negative_ttl():
+    resolver = StubResolver({})
+    clock = FakeClock()
+    cache = DNSCache(resolver, negative_ttl=5, clock=clock)
+
+    for _ in range(3):
+        with pytest.raises(socket.gaierror):
+            cache.resolve('missing.example', 80)
+    assert len(resolver.calls) == 1
+
+    clock.now = 6
+    with pytest.raises(socket.gaierror):
+        cache.resolve('missing.example', 80)
+    assert len(resolver.calls) == 2
+
+
+def test_ip_addresses_bypass_the_cache():
+    resolver = StubResolver({'127.0.0.1': [_addrinfo('127.0.0.1')]})
+    cache = DNSCache(resolver)
+    cache.resolve('127.0.0.1', 80)
+    assert len(cache) == 0
+
+
+def test_oldest_entries_are_evicted():
+    resolver = StubResolver({
+        f'host{i}.example': [_addrinfo(f'192.0.2.{i}')] for i in range(4)
+    })
+    cache = DNSCache(resolver, max_entries=2)
+    for i in range(3):
+        cache.resolve(f'host{i}.example', 80)
+    assert len(cache) == 2
+
+    cache.resolve('host0.example', 80)
+    assert resolver.calls.count('host0.example') == 2
+
+
+def test_concurrent_lookups_are_coalesced():
+    release = threading.Event()
+    calls = []
+
+    def slow_resolver(host, port, family=0, type=0, proto=0, flags=0):
+        calls.append(host)
+        release.wait(5)
+        return [_addrinfo('192.0.2.7')]
+
+    cache = DNSCache(slow_resolver)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.resolve('slow.example', 80)),
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    while not calls:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ['slow.example']
+    assert len(results) == 8
+
+
+def test_interleave_families_alternates():
+    v6 = [_addrinfo(f'2001:db8::{i}', socket.AF_INET6) for i in range(1, 3)]
+    v4 = [_addrinfo(f'192.0.2.{i}') for i in range(1, 4)]
+    ordered = interleave_families(v6 + v4)
+    assert [a[4][0] for a in ordered] == [
+        '2001:db8::1', '192.0.2.1', '2001:db8::2', '192.0.2.2', '192.0.2.3',
+    ]
+
+
+def _listener() -> socket.socket:
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    return server
+
+
+def _closed_port() -> int:
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_happy_eyeballs_moves_on_from_refused_addresses():
+    server = _listener()
+    refused = _addrinfo('127.0.0.1')
+    refused = refused[:4] + (('127.0.0.1', _closed_port()),)
+    good = _addrinfo('127.0.0.1')
+    good = good[:4] + (server.getsockname(),)
+
+    sock = happy_eyeballs_connect([refused, good], timeout=5, delay=1)
+    try:
+        assert sock.getpeername() == server.getsockname()
+        assert sock.gettimeout() == 5
+    finally:
+        sock.close()
+        server.close()
+
+
+def test_happy_eyeballs_raises_last_error():
+    refused = _addrinfo('127.0.0.1')
+    refused = refused[:4] + (('127.0.0.1', _closed_port()),)
+    with pytest.raises(ConnectionRefusedError):
+        happy_eyeballs_connect([refused], timeout=5)
+
+
+def test_slow_lookup_counts_against_the_connect_timeout(monkeypatch):
+    def slow_resolve(host, port):
+        time.sleep(0.2)
+        return [_addrinfo('127.0.0.1')]
+
+    monkeypatch.setattr(dns_cache, 'resolve', slow_resolve)
+    with pytest.raises(socket.timeout):
+        create_connection(('example.com', 80), 0.1)
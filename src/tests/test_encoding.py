@@ -0,0 +1,113 @@
+import gzip
+import zlib
+
+import brotli
+import pytest
+import zstandard
+
+from src.encoding import (
+    CHUNK_SIZE,
+    DecodingError,
+    DecompressionBombError,
+    UnsupportedEncodingError,
+    decode_body,
+    iter_decoded,
+    parse_content_encoding,
+)
+from src.response import Response
+
+
+BODY = b'<html>' + b'hello world ' * 5000 + b'</html>'
+
+
+def _raw_deflate(data: bytes) -> bytes:
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize('encoding, encoded', [
+    ('gzip', gzip.compress(BODY)),
+    ('x-gzip', gzip.compress(BODY)),
+    ('deflate', zlib.compress(BODY)),
+    ('deflate', _raw_deflate(BODY)),
+    ('br', brotli.compress(BODY)),
+    ('zstd', zstandard.ZstdCompressor().compress(BODY)),
+    ('identity', BODY),
+    (None, BODY),
+])
+def test_decode_body(encoding, encoded):
+    assert decode_body(encoded, encoding) == BODY
+
+
+def test_decode_chained_encodings():
+    encoded = brotli.compress(gzip.compress(BODY))
+    assert decode_body(encoded, 'gzip, br') == BODY
+
+
+def test_decode_concatenated_gzip_members():
+    encoded = gzip.compress(BODY[:100]) + gzip.compress(BODY[100:])
+    assert decode_body(encoded, 'gzip') == BODY
+
+
+def test_iter_decoded_is_incremental():
+    encoded = gzip.compress(BODY)
+    chunks = [encoded[i:i + 7] for i in range(0, len(encoded), 7)]
+    assert b''.join(iter_decoded(chunks, 'gzip')) == BODY
+
+
+def test_decompression_bomb_is_rejected():
+    encoded = gzip.compress(b'\0' * (10 * 1024 * 1024))
+    with pytest.raises(DecompressionBombError):
+        decode_body(encoded, 'gzip', max_size=1024 * 1024)
+
+
+@pytest.mark.parametrize('encoding, compress', [
+    ('br', lambda data: brotli.compress(data, quality=1)),
+    ('zstd', zstandard.ZstdCompressor().compress),
+])
+def test_decoded_chunks_are_bounded(encoding, compress):
+    encoded = compress(b'\0' * (32 * 1024 * 1024))
+    decoded = iter_decoded([encoded], encoding, max_size=1024 * 1024)
+    sizes = []
+    with pytest.raises(DecompressionBombError):
+        for chunk in decoded:
+            sizes.append(len(chunk))
+    # brotli stops growing its output buffer once it reaches the limit
+    assert sizes and max(sizes) < 2 * CHUNK_SIZE
+    assert sum(sizes) <= 1024 * 1024
+
+
+def test_unsupported_and_invalid_encodings():
+    with pytest.raises(UnsupportedEncodingError):
+        decode_body(BODY, 'compress')
+    with pytest.raises(DecodingError):
+        decode_body(b'not gzip at all', 'gzip')
+
+
+def test_parse_content_encoding():
+    assert parse_content_encoding('GZIP, identity , br') == ['gzip', 'br']
+    assert parse_content_encoding('') == []
+
+
+def test_response_keeps_wire_body():
+    encoded = gzip.compress(BODY)
+    response = Response(
+        code=200,
+        message='OK',
+        headers={'content-encoding': 'gzip'},
+        body=encoded,
+    )
+    assert response.body == encoded
+    assert response.decoded_body == BODY
+    assert response.to_dict()['body'] == BODY.decode()
+
+
+def test_response_falls_back_to_stored_body():
+    response = Response(
+        code=200,
+        message='OK',
+        headers={'Content-Encoding': 'gzip'},
+        body=BODY,
+    )
+    assert response.to_dict()['body'] == BODY.decode()
+    assert response == Response(code=200, message='OK', headers={}, body=BODY)
@@ -0,0 +1,217 @@
+import gzip
+import io
+import json
+import sqlite3
+
+import pytest
+
+from src.capture import SQLiteCapture
+from src.db import init_db
+from src.har import HarError, export_har, import_har, iter_entries, iter_har_entries
+from src.header_store import header_store
+from src.request import Request
+from src.response import Response
+from src.websocket import CLIENT, SERVER, TEXT, Message
+
+
+RAW_REQUEST = (
+    b'POST /submit?a=1&a=2&b=x HTTP/1.1\r\nHost: example.com:8080\r\n'
+    b'Cookie: session=abc\r\nContent-Type: application/json\r\n'
+    b'Content-Length: 7\r\n\r\n{"k":1}'
+)
+BODY = b'hello world ' * 20
+RAW_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Type: text/plain\r\n'
+    b'Set-Cookie: id=1; Path=/; HttpOnly\r\nSet-Cookie: theme=dark\r\n'
+    b'Content-Length: %d\r\n\r\n'
+) % len(gzip.compress(BODY)) + gzip.compress(BODY)
+
+
+def _db() -> sqlite3.Connection:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    return db_conn
+
+
+def _export(db_conn: sqlite3.Connection, **filters) -> dict:
+    out = io.StringIO()
+    export_har(db_conn, out, **filters)
+    return json.loads(out.getvalue())
+
+
+def _save(db_conn, raw_request=RAW_REQUEST, raw_response=RAW_RESPONSE, is_https=False):
+    return SQLiteCapture(db_conn).save_exchange(
+        Request.from_raw_request(raw_request),
+        Response.from_raw_response(raw_response) if raw_response else None,
+        is_https,
+    )
+
+
+def test_export_maps_exchange_to_har_entry():
+    db_conn = _db()
+    _save(db_conn)
+
+    har = _export(db_conn)
+    assert har['log']['version'] == '1.2'
+    (entry,) = har['log']['entries']
+
+    request = entry['request']
+    assert request['method'] == 'POST'
+    assert request['url'] == 'http://example.com:8080/submit?a=1&a=2&b=x'
+    assert request['queryString'] == [
+        {'name': 'a', 'value': '1'},
+        {'name': 'a', 'value': '2'},
+        {'name': 'b', 'value': 'x'},
+    ]
+    assert request['cookies'] == [{'name': 'session', 'value': 'abc'}]
+    assert request['postData']['text'] == '{"k":1}'
+
+    response = entry['response']
+    assert response['status'] == 200
+    assert response['content']['text'] == BODY.decode()
+    assert response['content']['size'] == len(BODY)
+    assert response['bodySize'] == len(gzip.compress(BODY))
+    assert [c['name'] for c in response['cookies']] == ['id', 'theme']
+    assert response['cookies'][0]['httpOnly'] is True
+    assert [h['name'] for h in response['headers']].count('Set-Cookie') == 2
+
+
+def test_export_filters():
+    db_conn = _db()
+    first = _save(db_conn)
+    _save(db_conn, b'GET / HTTP/1.1\r\nHost: other.example\r\n\r\n', None, True)
+    db_conn.execute('UPDATE request SET created_at = 100 WHERE id = ?', (first,))
+    db_conn.commit()
+
+    def urls(**filters):
+        return [
+            e['request']['url'] for e in _export(db_conn, **filters)['log']['entries']
+        ]
+
+    assert urls(host='other.example') == ['https://other.example/']
+    assert urls(until=200) == ['http://example.com:8080/submit?a=1&a=2&b=x']
+    assert urls(since=200) == ['https://other.example/']
+    assert urls(ids=[first]) == ['http://example.com:8080/submit?a=1&a=2&b=x']
+    # a missing response becomes HAR's zero status
+    assert _export(db_conn, host='other.example')['log']['entries'][0][
+        'response']['status'] == 0
+
+
+def test_export_pages_through_batches():
+    db_conn = _db()
+    for _ in range(7):
+        _save(db_conn)
+    assert len(list(iter_entries(db_conn, batch_size=3))) == 7
+
+
+def test_round_trip_between_databases():
+    source = _db()
+    _save(source, is_https=True)
+    request_id = _save(
+        source,
+        b'GET /chat HTTP/1.1\r\nHost: example.com\r\n'
+        b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n',
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n',
+    )
+    capture = SQLiteCapture(source)
+    capture.streams['s'] = request_id
+    capture.save_messages('s', [
+        Message(CLIENT, TEXT, b'ping', 4, False, 1.5),
+        Message(SERVER, 2, b'\x00\xff', 2, False, 2.5),
+    ], True)
+
+    text = io.StringIO()
+    export_har(source, text)
+    exported = io.BytesIO(text.getvalue().encode())
+
+    target = _db()
+    assert import_har(target, exported, batch_size=1) == (2, 0)
+
+    store = header_store(target)
+    request = Request.from_db(target.execute(
+        'SELECT * FROM request WHERE path = ?', ('/submit',),
+    ).fetchone(), store)
+    assert (request.host, request.port) == ('example.com', 8080)
+    assert request.get_params == {'a': ['1', '2'], 'b': 'x'}
+    assert request.body == b'{"k":1}'
+    assert target.execute(
+        'SELECT is_https FROM request WHERE path = ?', ('/submit',),
+    ).fetchone() == (1,)
+
+    response = Response.from_db(target.execute(
+        'SELECT * FROM response WHERE code = 200',
+    ).fetchone(), store)
+    assert response.body == BODY
+    assert response.content_encoding is None
+    assert response.decoded_body == BODY
+
+    assert target.execute(
+        'SELECT direction, opcode, payload, created_at FROM websocket_message',
+    ).fetchall() == [(CLIENT, TEXT, b'ping', 1.5), (SERVER, 2, b'\x00\xff', 2.5)]
+
+    # a second export of the imported rows is the same document
+    again = _export(target)['log']['entries']
+    first = _export(source)['log']['entries']
+    assert [e['request']['url'] for e in again] == [e['request']['url'] for e in first]
+    assert again[1]['_webSocketMessages'] == first[1]['_webSocketMessages']
+
+
+def test_reader_handles_arbitrary_chunk_boundaries():
+    document = json.dumps({
+        'log': {
+            'version': '1.2',
+            'pages': [{'title': '{"entries": [1]}'}],
+            'entries': [{'n': i, 'text': 'é' * i} for i in range(20)],
+            'comment': 12345,
+        },
+    }).encode()
+    entries = list(iter_har_entries(io.BytesIO(document), chunk_size=1))
+    assert [entry['n'] for entry in entries] == list(range(20))
+
+
+def test_import_skips_unusable_entries_and_rejects_invalid_json():
+    db_conn = _db()
+    document = json.dumps({'log': {'entries': [
+        {'request': {'method': 'GET', 'url': 'ftp://example.com/'}},
+        {
+            'startedDateTime': '2024-01-01T00:00:00.000Z',
+            'request': {'method': 'GET', 'url': 'https://example.com/a', 'headers': [
+                {'name': ':authority', 'value': 'example.com'},
+                {'name': 'Accept', 'value': '*/*'},
+            ]},
+            'response': {'status': 204, 'headers': [], 'content': {}},
+        },
+    ]}}).encode()
+    assert import_har(db_conn, io.BytesIO(document)) == (1, 1)
+    assert db_conn.execute(
+        'SELECT port, created_at FROM request',
+    ).fetchall() == [(443, 1704067200.0)]
+    assert db_conn.execute('SELECT code, message FROM response').fetchall() == [
+        (204, 'No Content'),
+    ]
+
+    with pytest.raises(HarError):
+        import_har(db_conn, io.BytesIO(b'{"log": {"entries": [{"a": 1} {"b": 2}]}}'))
+
+
+def test_entry_failing_after_its_request_leaves_no_rows(monkeypatch):
+    db_conn = _db()
+    save_to_db = Response.save_to_db
+
+    def fail_on_500(self, *args, **kwargs):
+        if self.code == 500:
+            raise ValueError('cannot store response')
+        return save_to_db(self, *args, **kwargs)
+
+    monkeypatch.setattr(Response, 'save_to_db', fail_on_500)
+    document = json.dumps({'log': {'entries': [
+        {
+            'request': {'method': 'GET', 'url': f'https://example.com/{status}', 'headers': []},
+            'response': {'status': status, 'headers': [], 'content': {}},
+        }
+        for status in (500, 200)
+    ]}}).encode()
+
+    assert import_har(db_conn, io.BytesIO(document)) == (1, 1)
+    assert db_conn.execute('SELECT path FROM request').fetchall() == [('/200',)]
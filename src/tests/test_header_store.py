@@ -0,0 +1,125 @@
+import copy
+import json
+import sqlite3
+
+from src.capture import EXCHANGE, SQLiteCapture
+from src.db import init_db
+from src.header_store import header_store, pack_refs, unpack_refs
+from src.request import Request
+from src.response import Response
+
+
+def _db() -> sqlite3.Connection:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    return db_conn
+
+
+def test_refs_round_trip():
+    assert unpack_refs(pack_refs([1, 2, 70000, 2])) == (1, 2, 70000, 2)
+    assert unpack_refs(pack_refs([])) == ()
+
+
+def test_fields_are_interned_once():
+    db_conn = _db()
+    store = header_store(db_conn)
+    fields = [('Accept', '*/*'), ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')]
+
+    first = store.encode(fields)
+    second = store.encode(list(reversed(fields)))
+
+    assert db_conn.execute('SELECT COUNT(*) FROM header_field').fetchone() \
+        == (3,)
+    assert store.decode(first) == fields
+    assert unpack_refs(second) == tuple(reversed(unpack_refs(first)))
+
+
+def test_decode_with_cold_cache():
+    db_conn = _db()
+    fields = [('Host', 'example.com'), ('Accept', '*/*')]
+    refs = header_store(db_conn).encode(fields)
+
+    # :memory: databases do not share the cache between stores
+    assert header_store(db_conn).decode(refs) == fields
+
+
+def test_response_keeps_order_and_duplicates():
+    db_conn = _db()
+    response = Response.from_raw_response(
+        b'HTTP/1.1 200 OK\r\n'
+        b'Set-Cookie: a=1\r\n'
+        b'Server: test\r\n'
+        b'Set-Cookie: b=2\r\n'
+        b'Content-Length: 0\r\n\r\n',
+    )
+    response.save_to_db(1, db_conn)
+    row = db_conn.execute('SELECT * FROM response').fetchone()
+
+    loaded = Response.from_db(row, header_store(db_conn))
+    assert row[4] is None
+    assert loaded.header_fields == [
+        ('Set-Cookie', 'a=1'),
+        ('Server', 'test'),
+        ('Set-Cookie', 'b=2'),
+        ('Content-Length', '0'),
+    ]
+    assert loaded.headers['Set-Cookie'] == 'b=2'
+
+
+def test_legacy_json_rows_are_still_read():
+    db_conn = _db()
+    db_conn.execute(
+        'INSERT INTO request (method, host, port, path, get_params, headers, '
+        'cookies, body, post_params, is_https) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        ('GET', 'example.com', 80, '/', '{}',
+         json.dumps({'Host': 'example.com'}), '{}', None, '{}', False),
+    )
+    row = db_conn.execute('SELECT * FROM request').fetchone()
+    store = header_store(db_conn)
+
+    request = Request.from_db(row, store)
+    assert request.headers == {'Host': 'example.com'}
+    request.save_to_db(db_conn, store=store)
+    row = db_conn.execute('SELECT * FROM request WHERE id = 2').fetchone()
+    assert Request.from_db(row, store).header_fields == \
+        [('Host', 'example.com')]
+
+
+def test_loaded_request_can_be_copied():
+    db_conn = _db()
+    request = Request.from_raw_request(
+        b'GET /?a=1 HTTP/1.1\r\nHost: example.com\r\n\r\n',
+    )
+    request.save_to_db(db_conn)
+    row = db_conn.execute('SELECT * FROM request').fetchone()
+
+    loaded = Request.from_db(row, header_store(db_conn))
+    copied = copy.deepcopy(loaded)
+    assert copied.headers == {'Host': 'example.com'}
+    assert copied._header_store is None
+
+
+def test_rolled_back_fields_are_not_shared(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    db_conn = sqlite3.connect(db_path)
+    init_db(db_conn)
+
+    def request(header: str) -> Request:
+        return Request.from_raw_request(
+            f'GET / HTTP/1.1\r\nHost: example.com\r\n{header}\r\n\r\n'.encode(),
+        )
+
+    # the broken response undoes the record, and with it the new X-A field
+    SQLiteCapture(db_conn).write_batch([
+        (EXCHANGE, request('X-A: 1'), object(), False, None, 1.0),
+        (EXCHANGE, request('X-B: 2'), None, False, None, 2.0),
+        (EXCHANGE, request('X-A: 1'), None, False, None, 3.0),
+    ])
+
+    reader = sqlite3.connect(db_path)
+    rows = reader.execute('SELECT * FROM request ORDER BY id').fetchall()
+    assert [Request.from_db(row, header_store(reader)).header_fields for row in rows] == [
+        [('Host', 'example.com'), ('X-B', '2')],
+        [('Host', 'example.com'), ('X-A', '1')],
+    ]
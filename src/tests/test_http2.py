@@ -0,0 +1,256 @@
+from collections import OrderedDict
+import shutil
+import socket
+import ssl
+import threading
+import time
+from unittest.mock import MagicMock
+
+import h2.config
+import h2.connection
+import h2.events
+import pytest
+
+import config
+from conftest import openssl
+from src import proxy
+from src.cert_store import CertStore
+from src.http2 import Http2Observer
+from src.proxy import ProxyRequestHandler, ThreadingProxy
+
+
+def _h2_pair():
+    client = h2.connection.H2Connection()
+    server = h2.connection.H2Connection(
+        h2.config.H2Configuration(client_side=False),
+    )
+    client.initiate_connection()
+    server.initiate_connection()
+    return client, server
+
+
+def test_observer_captures_interleaved_streams():
+    client, server = _h2_pair()
+    exchanges = []
+    observer = Http2Observer(lambda *exchange: exchanges.append(exchange))
+
+    def relay():
+        # one byte at a time, so frames are split at every offset
+        for data, feed, peer in (
+            (client.data_to_send(), observer.client_data, server),
+            (server.data_to_send(), observer.server_data, client),
+        ):
+            for i in range(len(data)):
+                feed(data[i:i + 1])
+            peer.receive_data(data)
+
+    relay()
+    # headers bigger than a frame are split into CONTINUATION frames
+    client.send_headers(1, [
+        (':method', 'GET'), (':scheme', 'https'),
+        (':authority', 'example.com'), (':path', '/a?x=1'),
+        ('x-big', 'v' * 40000),
+    ], end_stream=True)
+    client.send_headers(3, [
+        (':method', 'POST'), (':scheme', 'https'),
+        (':authority', 'example.com:8443'), (':path', '/b'),
+    ])
+    client.send_data(3, b'body', end_stream=True)
+    relay()
+
+    server.send_headers(3, [(':status', '201'), ('content-type', 'text/plain')])
+    server.send_headers(1, [(':status', '200')])
+    server.send_data(3, b'created', end_stream=True)
+    server.send_data(1, b'first', end_stream=True)
+    relay()
+
+    assert not observer.failed
+    (post, created), (get, first) = exchanges
+    assert (post.method, post.host, post.port, post.path, post.body) == (
+        'POST', 'example.com', 8443, '/b', b'body',
+    )
+    assert (created.code, created.message, created.body) == (201, 'Created', b'created')
+    assert ('content-type', 'text/plain') in created.header_fields
+    assert (get.method, get.host, get.port, get.path, get.query) == (
+        'GET', 'example.com', 443, '/a', 'x=1',
+    )
+    assert len(dict(get.header_fields)['x-big']) == 40000
+    assert (first.code, first.body) == (200, b'first')
+    assert first.duration is not None
+
+
+class Origin:
+    # answers every h2 stream with the request path and body, and falls
+    # back to one HTTP/1.1 response
+    def __init__(self, cert: str, key: str) -> None:
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(cert, key)
+        self.context.set_alpn_protocols(['h2', 'http/1.1'])
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.protocols = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn: socket.socket):
+        with self.context.wrap_socket(conn, server_side=True) as tls:
+            protocol = tls.selected_alpn_protocol()
+            self.protocols.append(protocol)
+            if protocol != 'h2':
+                tls.recv(65536)
+                tls.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nh1')
+                return
+            h2_conn = h2.connection.H2Connection(
+                h2.config.H2Configuration(client_side=False),
+            )
+            h2_conn.initiate_connection()
+            tls.sendall(h2_conn.data_to_send())
+            paths, bodies = {}, {}
+            while data := tls.recv(65536):
+                for event in h2_conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        paths[event.stream_id] = dict(event.headers)[b':path']
+                        bodies[event.stream_id] = b''
+                    elif isinstance(event, h2.events.DataReceived):
+                        bodies[event.stream_id] += event.data
+                        h2_conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id,
+                        )
+                    elif isinstance(event, h2.events.StreamEnded):
+                        stream_id = event.stream_id
+                        h2_conn.send_headers(stream_id, [(':status', '200')])
+                        h2_conn.send_data(
+                            stream_id,
+                            paths[stream_id] + b' ' + bodies[stream_id],
+                            end_stream=True,
+                        )
+                tls.sendall(h2_conn.data_to_send())
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def tunnel(tmp_path, monkeypatch):
+    cert, key = str(tmp_path / 'origin.crt'), str(tmp_path / 'origin.key')
+    openssl(
+        'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-keyout', key, '-out', cert, '-subj', '/CN=127.0.0.1',
+        '-addext', 'subjectAltName=IP:127.0.0.1',
+    )
+    monkeypatch.setattr(config, 'UPSTREAM_CA_FILE', cert)
+    monkeypatch.setattr(config, 'HTTP2_ENABLED', True)
+    monkeypatch.setattr(proxy, '_upstream_contexts', {})
+    monkeypatch.setattr(proxy, '_upstream_h2', OrderedDict())
+
+    def generate(host: str, serial: int):
+        # the intercepting certificate is not checked by the test client;
+        # the store removes the files it is given
+        return shutil.copy(cert, tmp_path / f'{serial}.crt'), key
+
+    monkeypatch.setattr(proxy, 'cert_store', CertStore(
+        path=str(tmp_path / 'certs.db'),
+        ca_cert=cert,
+        cert_key=key,
+        generate=generate,
+    ))
+
+    origin = Origin(cert, key)
+    capture = MagicMock()
+    server = ThreadingProxy(('127.0.0.1', 0), ProxyRequestHandler, capture)
+    threading.Thread(
+        target=server.serve_forever,
+        kwargs={'poll_interval': 0.05},
+        daemon=True,
+    ).start()
+
+    def connect(protocol: str) -> ssl.SSLSocket:
+        sock = socket.create_connection(server.server_address, timeout=5)
+        sock.sendall(
+            f'CONNECT 127.0.0.1:{origin.port} HTTP/1.1\r\n\r\n'.encode(),
+        )
+        assert sock.recv(4096).startswith(b'HTTP/1.1 200')
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.set_alpn_protocols([protocol])
+        return context.wrap_socket(sock)
+
+    yield connect, origin, capture
+    server.shutdown()
+    server.server_close()
+    origin.close()
+
+
+def test_streams_are_multiplexed_through_the_tunnel(tunnel):
+    connect, origin, capture = tunnel
+    with connect('h2') as tls:
+        assert tls.selected_alpn_protocol() == 'h2'
+        client = h2.connection.H2Connection()
+        client.initiate_connection()
+        for stream_id, path in ((1, '/one'), (3, '/two')):
+            client.send_headers(stream_id, [
+                (':method', 'POST'), (':scheme', 'https'),
+                (':authority', f'127.0.0.1:{origin.port}'), (':path', path),
+            ])
+        client.send_data(3, b'second', end_stream=True)
+        client.send_data(1, b'first', end_stream=True)
+        tls.sendall(client.data_to_send())
+
+        bodies, ended = {1: b'', 3: b''}, set()
+        while ended != {1, 3}:
+            for event in client.receive_data(tls.recv(65536)):
+                if isinstance(event, h2.events.DataReceived):
+                    bodies[event.stream_id] += event.data
+                elif isinstance(event, h2.events.StreamEnded):
+                    ended.add(event.stream_id)
+            tls.sendall(client.data_to_send())
+    assert bodies == {1: b'/one first', 3: b'/two second'}
+    assert origin.protocols == ['h2']
+
+    # streams are captured after their last frame was relayed
+    deadline = time.monotonic() + 5
+    while capture.save_exchange.call_count < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    captured = sorted(
+        (call.args[0].path, call.args[0].body, call.args[1].code, call.args[1].body)
+        for call in capture.save_exchange.call_args_list
+    )
+    assert captured == [
+        ('/one', b'first', 200, b'/one first'),
+        ('/two', b'second', 200, b'/two second'),
+    ]
+
+
+def test_http1_client_gets_an_http1_upstream(tunnel):
+    connect, origin, capture = tunnel
+    with connect('http/1.1') as tls:
+        assert tls.selected_alpn_protocol() == 'http/1.1'
+        tls.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+        assert tls.recv(4096).endswith(b'h1')
+    # the h2 connection opened first is replaced by one without ALPN
+    assert origin.protocols == ['h2', None]
+
+    # the host is known to take h2 now, so the upstream handshake waits
+    # for the client's choice
+    with connect('http/1.1') as tls:
+        tls.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+        assert tls.recv(4096).endswith(b'h1')
+    with connect('h2') as tls:
+        assert tls.selected_alpn_protocol() == 'h2'
+        client = h2.connection.H2Connection()
+        client.initiate_connection()
+        tls.sendall(client.data_to_send())
+        # the origin's settings arrive once the tunnel reached it
+        assert any(
+            isinstance(event, h2.events.RemoteSettingsChanged)
+            for event in client.receive_data(tls.recv(65536))
+        )
+    assert origin.protocols[2:] == [None, 'h2']
@@ -0,0 +1,240 @@
+from email.utils import formatdate
+
+from conftest import FakeClock
+from src.http_cache import HTTPCache, is_storable, parse_cache_control
+from src.request import Request
+from src.response import Response
+
+
+NOW = 1_700_000_000.0
+
+
+class Origin:
+    def __init__(self, *responses) -> None:
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, request: Request) -> Response:
+        self.requests.append(request)
+        return self.responses.pop(0)
+
+
+def _request(path: str = '/a', method: str = 'GET', headers: dict = {}) -> Request:
+    raw_headers = ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+    return Request.from_raw_request(
+        f'{method} {path} HTTP/1.1\r\nHost: example.com\r\n{raw_headers}\r\n'
+        .encode()
+    )
+
+
+def _response(code: int = 200, body: bytes = b'hello', **headers) -> Response:
+    fields = [
+        (name.replace('_', '-').title() if name != 'etag' else 'ETag', value)
+        for name, value in headers.items()
+    ]
+    fields.append(('Date', formatdate(NOW, usegmt=True)))
+    return Response(
+        code=code,
+        message='OK',
+        header_fields=fields,
+        body=body,
+    )
+
+
+def _cache(tmp_path=None, clock=None, **kwargs) -> HTTPCache:
+    return HTTPCache(
+        disk_dir=str(tmp_path / 'cache') if tmp_path else None,
+        clock=clock or FakeClock(NOW),
+        **kwargs,
+    )
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('max-age=60, No-Cache, private="x"') == {
+        'max-age': '60',
+        'no-cache': None,
+        'private': 'x',
+    }
+
+
+def test_fresh_response_is_served_from_cache():
+    clock = FakeClock(NOW)
+    cache = _cache(clock=clock)
+    origin = Origin(_response(cache_control='max-age=60'))
+
+    assert not cache.fetch(_request(), origin).from_cache
+    clock.now += 30
+    hit = cache.fetch(_request(), origin)
+
+    assert hit.from_cache
+    assert hit.body == b'hello'
+    assert hit.headers['Age'] == '30'
+    assert hit.headers['Content-Length'] == '5'
+    assert len(origin.requests) == 1
+
+
+def test_stale_response_is_revalidated():
+    clock = FakeClock(NOW)
+    cache = _cache(clock=clock)
+    origin = Origin(
+        _response(cache_control='max-age=10', etag='"v1"'),
+        _response(304, b'', cache_control='max-age=100', etag='"v1"'),
+    )
+
+    cache.fetch(_request(), origin)
+    clock.now += 20
+    revalidated = cache.fetch(_request(), origin)
+
+    assert revalidated.from_cache
+    assert revalidated.body == b'hello'
+    assert origin.requests[1].headers['If-None-Match'] == '"v1"'
+    assert 'If-None-Match' not in origin.requests[0].headers
+
+    # the 304 refreshed the stored freshness lifetime
+    clock.now += 50
+    assert cache.fetch(_request(), origin).from_cache
+    assert len(origin.requests) == 2
+
+
+def test_304_to_client_validators_is_not_stored():
+    cache = _cache()
+    origin = Origin(
+        _response(304, b'', cache_control='max-age=100', etag='"v1"'),
+        _response(cache_control='max-age=100', etag='"v1"'),
+    )
+
+    conditional = cache.fetch(_request(headers={'If-None-Match': '"v1"'}), origin)
+    assert (conditional.code, conditional.from_cache) == (304, False)
+
+    # a second client without validators gets the full body from the origin
+    full = cache.fetch(_request(), origin)
+    assert (full.code, full.body, full.from_cache) == (200, b'hello', False)
+    assert len(origin.requests) == 2
+    assert cache.fetch(_request(), origin).from_cache
+
+
+def test_range_requests_bypass_the_cache():
+    cache = _cache()
+    origin = Origin(
+        _response(206, b'he', cache_control='max-age=100', content_range='bytes 0-1/5'),
+        _response(cache_control='max-age=100'),
+    )
+
+    partial = cache.fetch(_request(headers={'Range': 'bytes=0-1'}), origin)
+    assert (partial.code, partial.body) == (206, b'he')
+
+    full = cache.fetch(_request(), origin)
+    assert (full.code, full.body, full.from_cache) == (200, b'hello', False)
+    # a range is not answered from the stored full response either
+    ranged = cache.fetch(_request(headers={'Range': 'bytes=0-1'}), Origin(_response(206, b'he')))
+    assert (ranged.code, ranged.from_cache) == (206, False)
+    assert cache.fetch(_request(), origin).from_cache
+    assert not is_storable(_request(), _response(206, b'he', cache_control='max-age=100'))
+
+
+def test_changed_response_replaces_entry():
+    clock = FakeClock(NOW)
+    cache = _cache(clock=clock)
+    origin = Origin(
+        _response(body=b'old', cache_control='max-age=10', last_modified='Mon, 01 Jan 2024 00:00:00 GMT'),
+        _response(body=b'new', cache_control='max-age=60'),
+    )
+
+    cache.fetch(_request(), origin)
+    clock.now += 20
+    response = cache.fetch(_request(), origin)
+    assert origin.requests[1].headers['If-Modified-Since'] == \
+        'Mon, 01 Jan 2024 00:00:00 GMT'
+    assert not response.from_cache
+    assert cache.fetch(_request(), origin).body == b'new'
+
+
+def test_vary_keeps_separate_variants():
+    cache = _cache()
+    origin = Origin(
+        _response(body=b'gzip', cache_control='max-age=60', vary='Accept-Encoding'),
+        _response(body=b'plain', cache_control='max-age=60', vary='Accept-Encoding'),
+    )
+
+    cache.fetch(_request(headers={'Accept-Encoding': 'gzip'}), origin)
+    cache.fetch(_request(headers={'Accept-Encoding': 'identity'}), origin)
+
+    assert cache.fetch(
+        _request(headers={'Accept-Encoding': 'gzip'}), origin,
+    ).body == b'gzip'
+    assert cache.fetch(
+        _request(headers={'Accept-Encoding': 'identity'}), origin,
+    ).body == b'plain'
+    assert len(origin.requests) == 2
+
+
+def test_request_directives_bypass_fresh_entries():
+    cache = _cache()
+    origin = Origin(
+        _response(cache_control='max-age=60'),
+        _response(body=b'again', cache_control='max-age=60'),
+    )
+    cache.fetch(_request(), origin)
+    response = cache.fetch(_request(headers={'Cache-Control': 'no-cache'}), origin)
+    assert response.body == b'again'
+
+
+def test_unsafe_method_invalidates():
+    cache = _cache()
+    origin = Origin(
+        _response(cache_control='max-age=60'),
+        _response(201, b''),
+        _response(body=b'fresh', cache_control='max-age=60'),
+    )
+    cache.fetch(_request(), origin)
+    cache.fetch(_request(method='POST'), origin)
+    assert cache.fetch(_request(), origin).body == b'fresh'
+
+
+def test_is_storable():
+    assert is_storable(_request(), _response(cache_control='max-age=1'))
+    assert not is_storable(_request(), _response(cache_control='no-store'))
+    assert not is_storable(_request(), _response(cache_control='private, max-age=60'))
+    assert not is_storable(_request(), _response(vary='*'))
+    assert not is_storable(_request(method='POST'), _response(cache_control='max-age=1'))
+    assert not is_storable(_request(), _response(set_cookie='a=1', cache_control='max-age=1'))
+    assert not is_storable(
+        _request(headers={'Authorization': 'Bearer x'}),
+        _response(cache_control='max-age=60'),
+    )
+    assert is_storable(
+        _request(headers={'Authorization': 'Bearer x'}),
+        _response(cache_control='public, max-age=60'),
+    )
+    assert not is_storable(_request(), _response(code=500))
+
+
+def test_memory_tier_spills_to_disk(tmp_path):
+    cache = _cache(tmp_path, memory_bytes=4000)
+    origin = Origin(*[
+        _response(body=bytes([i]) * 300, cache_control='max-age=60')
+        for i in range(20)
+    ])
+    for i in range(20):
+        cache.fetch(_request(f'/{i}'), origin)
+
+    assert cache.memory_total <= 4000
+    assert cache.disk.total > 0
+    hit = cache.fetch(_request('/0'), origin)
+    assert hit.from_cache and hit.body == bytes([0]) * 300
+
+    # a new cache on the same directory finds the demoted entries
+    reopened = _cache(tmp_path, memory_bytes=4000)
+    assert reopened.fetch(_request('/1'), Origin()).body == bytes([1]) * 300
+
+
+def test_disk_tier_evicts_oldest(tmp_path):
+    cache = _cache(tmp_path, memory_bytes=1000, disk_bytes=2000)
+    origin = Origin(*[
+        _response(body=b'x' * 500, cache_control='max-age=60')
+        for _ in range(10)
+    ])
+    for i in range(10):
+        cache.fetch(_request(f'/{i}'), origin)
+    assert cache.disk.total <= 2000
+    assert cache.lookup(_request('/0')) is None
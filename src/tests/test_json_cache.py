@@ -0,0 +1,28 @@
+from src.json_cache import JSONCache, make_etag
+
+
+def test_entries_carry_their_etag():
+    cache = JSONCache(1000)
+    body, etag = cache.put(('request', 1), b'{"id": 1}')
+    assert etag == make_etag(b'{"id": 1}')
+    assert cache.get(('request', 1)) == (body, etag)
+    assert cache.get(('request', 2)) is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = JSONCache(800)
+    for i in range(8):
+        cache.put(i, b'x' * 100)
+    cache.get(0)
+    cache.put(8, b'x' * 100)
+
+    assert cache.total <= 800
+    assert cache.get(0) is not None
+    assert cache.get(1) is None
+
+
+def test_large_records_are_not_cached():
+    cache = JSONCache(800)
+    body, etag = cache.put('big', b'x' * 101)
+    assert etag == make_etag(body)
+    assert len(cache) == 0
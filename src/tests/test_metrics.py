@@ -0,0 +1,89 @@
+import pytest
+
+from src.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_render():
+    registry = Registry()
+    counter = Counter(
+        'test_total',
+        'Test counter.',
+        labelnames=('kind',),
+        registry=registry,
+    )
+    counter.labels('http').inc()
+    counter.labels('http').inc(2)
+    counter.labels('connect').inc()
+
+    assert registry.render() == (
+        '# HELP test_total Test counter.\n'
+        '# TYPE test_total counter\n'
+        'test_total{kind="connect"} 1\n'
+        'test_total{kind="http"} 3\n'
+    )
+
+
+def test_counter_rejects_negative_amount():
+    counter = Counter('test_total', 'Test counter.', registry=None)
+    with pytest.raises(ValueError):
+        counter.inc(-1)
+
+
+def test_labeled_counter_only_goes_up():
+    counter = Counter(
+        'test_total',
+        'Test counter.',
+        labelnames=('kind',),
+        registry=None,
+    )
+    child = counter.labels('http')
+    child.inc(2)
+    with pytest.raises(ValueError):
+        child.inc(-1)
+    assert not hasattr(child, 'dec')
+    assert not hasattr(child, 'set')
+    assert child.get() == 2
+
+
+def test_labels_arity_is_checked():
+    counter = Counter(
+        'test_total',
+        'Test counter.',
+        labelnames=('kind',),
+        registry=None,
+    )
+    with pytest.raises(ValueError):
+        counter.labels('a', 'b')
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_gauge_function():
+    gauge = Gauge('test_gauge', 'Test gauge.', registry=None, function=lambda: 7)
+    assert gauge.samples() == ['test_gauge 7']
+
+
+def test_gauge_track_inprogress():
+    gauge = Gauge('test_gauge', 'Test gauge.', registry=None)
+    with gauge.track_inprogress():
+        assert gauge.get() == 1
+    assert gauge.get() == 0
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram(
+        'test_seconds',
+        'Test histogram.',
+        registry=None,
+        buckets=(0.1, 1),
+    )
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    assert histogram.samples() == [
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        'test_seconds_sum 3.65',
+        'test_seconds_count 4',
+    ]
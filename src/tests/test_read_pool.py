@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from src.db import enable_wal, init_db
+from src.read_pool import PoolTimeout, ReadPool
+
+
+def _database(tmp_path) -> tuple[str, sqlite3.Connection]:
+    path = str(tmp_path / 'proxy.db')
+    writer = sqlite3.connect(path, timeout=0)
+    init_db(writer)
+    enable_wal(writer)
+    return path, writer
+
+
+def _insert(writer: sqlite3.Connection):
+    writer.execute("INSERT INTO request (method) VALUES ('GET')")
+    writer.commit()
+
+
+def _count(db_conn: sqlite3.Connection) -> int:
+    return db_conn.execute('SELECT COUNT(*) FROM request').fetchone()[0]
+
+
+def test_connections_are_read_only(tmp_path):
+    path, _ = _database(tmp_path)
+    db_conn = ReadPool(path).acquire()
+    with pytest.raises(sqlite3.OperationalError):
+        db_conn.execute("INSERT INTO request (method) VALUES ('GET')")
+
+
+def test_snapshot_does_not_block_the_writer(tmp_path):
+    path, writer = _database(tmp_path)
+    _insert(writer)
+    pool = ReadPool(path)
+
+    db_conn = pool.acquire()
+    assert _count(db_conn) == 1
+    # the writer commits while the snapshot is open, without waiting
+    _insert(writer)
+    assert _count(db_conn) == 1
+    pool.release(db_conn)
+
+    db_conn = pool.acquire()
+    assert _count(db_conn) == 2
+    pool.release(db_conn)
+
+    unpinned = pool.acquire(snapshot=False)
+    _insert(writer)
+    assert _count(unpinned) == 3
+
+
+def test_pool_is_bounded_and_reuses_connections(tmp_path):
+    path, _ = _database(tmp_path)
+    pool = ReadPool(path, size=1, timeout=0.01)
+    db_conn = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    pool.release(db_conn)
+    assert pool.acquire() is db_conn
@@ -0,0 +1,109 @@
+import copy
+import pickle
+import sqlite3
+
+from src.consts import NEW_LINE
+from src.db import init_db
+from src.header_store import header_store
+from src.request import Request
+from src.response import Response
+
+
+RAW_REQUEST = NEW_LINE.join([
+    'POST /login?next=%2Fhome&lang=en HTTP/1.1',
+    'Host: example.com:8080',
+    'Cookie: session=abc; theme=dark',
+    'Content-Type: application/x-www-form-urlencoded',
+    'Content-Length: 17',
+    '',
+    'user=bob&pass=123',
+]).encode()
+
+RAW_RESPONSE = NEW_LINE.join([
+    'HTTP/1.1 200 OK',
+    'Content-Type: text/plain',
+    'Set-Cookie: session=xyz',
+    'Content-Length: 5',
+    '',
+    'hello',
+]).encode()
+
+
+def _db() -> sqlite3.Connection:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    return db_conn
+
+
+def test_raw_request_fields_are_parsed_lazily():
+    request = Request.from_raw_request(RAW_REQUEST)
+    assert request._get_params is None
+    assert request._post_params is None
+    assert request._cookies is None
+
+    assert (request.host, request.port, request.path) == \
+        ('example.com', 8080, '/login')
+    assert request.get_params == {'next': '/home', 'lang': 'en'}
+    assert request.post_params == {'user': ['bob'], 'pass': ['123']}
+    assert request.cookies['theme'].value == 'dark'
+
+
+def test_request_from_db_round_trip():
+    db_conn = _db()
+    request = Request.from_raw_request(RAW_REQUEST)
+    request_id = request.save_to_db(db_conn, trace_id='trace')
+    row = db_conn.execute(
+        'SELECT * FROM request WHERE id = ?', (request_id,),
+    ).fetchone()
+
+    store = header_store(db_conn)
+    loaded = Request.from_db(row, store)
+    assert loaded._headers is None
+    assert loaded.to_db_row(store) == request.to_db_row(store)
+    assert loaded.headers['Host'] == 'example.com:8080'
+    assert loaded.get_params == {'next': '/home', 'lang': 'en'}
+    assert loaded.cookies['session'].value == 'abc'
+    assert loaded.trace_id == 'trace'
+
+
+def test_request_without_cookies_skips_cookie_parsing():
+    request = Request.from_raw_request(
+        b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n',
+    )
+    assert request.to_db_row(header_store(_db()))[6] == '{}'
+    assert request._cookies is None
+
+
+def test_request_copies_and_pickles():
+    request = Request.from_raw_request(RAW_REQUEST)
+    modified = copy.deepcopy(request)
+    modified.get_params['lang'] = "en'"
+    assert request.get_params['lang'] == 'en'
+
+    store = header_store(_db())
+    restored = pickle.loads(pickle.dumps(request))
+    assert restored.to_db_row(store) == request.to_db_row(store)
+
+
+def test_injection_points_use_lazy_fields():
+    request = Request.from_raw_request(
+        b'GET /?q=1 HTTP/1.1\r\nHost: example.com\r\n'
+        b'Cookie: id=7\r\n\r\n',
+    )
+    modified = list(request)
+    assert len(modified) == 2 * 3
+    assert modified[0].get_params == {'q': "1'"}
+
+
+def test_response_from_db_round_trip():
+    db_conn = _db()
+    response = Response.from_raw_response(RAW_RESPONSE)
+    response.save_to_db(1, db_conn)
+    row = db_conn.execute('SELECT * FROM response').fetchone()
+
+    store = header_store(db_conn)
+    loaded = Response.from_db(row, store)
+    assert loaded._headers is None
+    assert loaded.to_db_row(1, store) == response.to_db_row(1, store)
+    assert loaded.headers['Content-Type'] == 'text/plain'
+    assert loaded.to_dict()['body'] == 'hello'
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import time
+
+from src.db import init_db
+from src.header_store import header_store
+from src.request import Request
+from src.response import Response
+from src.retention import (
+    Retention,
+    RetentionPolicy,
+    list_partitions,
+    open_partition,
+    partition_day,
+    partition_path,
+)
+
+
+RAW_REQUEST = b'GET /?a=1 HTTP/1.1\r\nHost: example.com\r\nX-Test: 1\r\n\r\n'
+RAW_RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+DAY = 24 * 60 * 60
+
+
+def _capture(db_path: str, count: int, created_at: float) -> list[int]:
+    db_conn = sqlite3.connect(db_path)
+    init_db(db_conn)
+    request_ids = []
+    for _ in range(count):
+        request_id = Request.from_raw_request(RAW_REQUEST).save_to_db(db_conn)
+        Response.from_raw_response(RAW_RESPONSE).save_to_db(request_id, db_conn)
+        request_ids.append(request_id)
+    db_conn.execute(
+        f'UPDATE request SET created_at = ? '
+        f'WHERE id IN ({",".join("?" * len(request_ids))})',
+        (created_at, *request_ids),
+    )
+    db_conn.commit()
+    db_conn.close()
+    return request_ids
+
+
+def _count(db_conn: sqlite3.Connection, table: str) -> int:
+    return db_conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+
+
+def test_rotate_moves_old_rows_into_day_partition(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    archive_dir = str(tmp_path / 'archive')
+    now = time.time()
+    old_ids = _capture(db_path, 3, now - 2 * DAY)
+    _capture(db_path, 2, now)
+
+    retention = Retention(db_path, archive_dir, RetentionPolicy(hot_seconds=DAY))
+    assert retention.rotate(now) == 3
+    retention.close()
+
+    db_conn = sqlite3.connect(db_path)
+    assert _count(db_conn, 'request') == 2
+    assert _count(db_conn, 'response') == 2
+
+    day = partition_day(now - 2 * DAY)
+    assert list_partitions(archive_dir) == [day]
+    partition_conn = open_partition(day, archive_dir)
+    rows = partition_conn.execute('SELECT * FROM request ORDER BY id').fetchall()
+    assert [row[0] for row in rows] == old_ids
+    assert _count(partition_conn, 'response') == 3
+
+    # header refs resolve against the dictionary copied into the partition
+    request = Request.from_db(rows[0], header_store(partition_conn))
+    assert request.headers['X-Test'] == '1'
+
+
+def test_rows_captured_out_of_order_land_in_their_own_day(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    archive_dir = str(tmp_path / 'archive')
+    now = time.time()
+    # an imported HAR gets higher ids than what was captured after it
+    later_ids = _capture(db_path, 2, now - 2 * DAY)
+    earlier_ids = _capture(db_path, 2, now - 4 * DAY)
+
+    retention = Retention(db_path, archive_dir, RetentionPolicy(hot_seconds=DAY))
+    assert retention.rotate(now) == 4
+    retention.close()
+
+    for created_at, ids in ((now - 4 * DAY, earlier_ids), (now - 2 * DAY, later_ids)):
+        partition_conn = open_partition(partition_day(created_at), archive_dir)
+        rows = partition_conn.execute('SELECT id FROM request ORDER BY id').fetchall()
+        assert [row[0] for row in rows] == ids
+        assert _count(partition_conn, 'response') == 2
+
+
+def test_rotate_keeps_live_database_under_max_rows(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    archive_dir = str(tmp_path / 'archive')
+    now = time.time()
+    request_ids = _capture(db_path, 10, now)
+
+    retention = Retention(
+        db_path,
+        archive_dir,
+        RetentionPolicy(hot_seconds=DAY, max_rows=4),
+    )
+    assert retention.rotate(now) == 6
+    retention.close()
+
+    db_conn = sqlite3.connect(db_path)
+    remaining = [row[0] for row in db_conn.execute('SELECT id FROM request')]
+    assert remaining == request_ids[6:]
+
+
+def test_partition_is_read_only(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    archive_dir = str(tmp_path / 'archive')
+    now = time.time()
+    _capture(db_path, 1, now - 2 * DAY)
+    retention = Retention(db_path, archive_dir, RetentionPolicy(hot_seconds=DAY))
+    retention.rotate(now)
+    retention.close()
+
+    partition_conn = open_partition(partition_day(now - 2 * DAY), archive_dir)
+    try:
+        partition_conn.execute('DELETE FROM request')
+    except sqlite3.OperationalError as e:
+        assert 'readonly' in str(e)
+    else:
+        raise AssertionError('partition was writable')
+    assert open_partition('../proxy', archive_dir) is None
+    assert open_partition('1970-01-01', archive_dir) is None
+
+
+def test_expire_partitions_by_age_and_size(tmp_path):
+    archive_dir = tmp_path / 'archive'
+    archive_dir.mkdir()
+    now = time.time()
+    days = [partition_day(now - offset * DAY) for offset in (40, 3, 2, 1)]
+    for day in days:
+        with open(partition_path(day, str(archive_dir)), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    retention = Retention(
+        str(tmp_path / 'proxy.db'),
+        str(archive_dir),
+        RetentionPolicy(archive_days=30, archive_max_bytes=2500),
+    )
+    assert retention.expire_partitions(now) == days[:2]
+    retention.close()
+    assert list_partitions(str(archive_dir)) == days[2:]
+
+
+def test_vacuum_returns_free_pages(tmp_path):
+    db_path = str(tmp_path / 'proxy.db')
+    now = time.time()
+    _capture(db_path, 200, now - 2 * DAY)
+
+    retention = Retention(
+        db_path,
+        str(tmp_path / 'archive'),
+        RetentionPolicy(hot_seconds=DAY),
+    )
+    size_before = os.path.getsize(db_path)
+    retention.rotate(now)
+    assert retention.vacuum() > 0
+    assert retention.db_conn.execute('PRAGMA freelist_count').fetchone() == (0,)
+    retention.close()
+    assert os.path.getsize(db_path) < size_before
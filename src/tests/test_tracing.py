@@ -0,0 +1,68 @@
+import threading
+import time
+
+from src import tracing
+from src.profiler import SamplingProfiler
+
+
+def test_span_without_trace_is_noop():
+    with tracing.span('parse') as trace:
+        assert trace is None
+
+
+def test_trace_records_spans():
+    trace = tracing.start_trace(('127.0.0.1', 1234))
+    with tracing.span('parse'):
+        pass
+    with tracing.span('capture'):
+        pass
+    with tracing.span('capture'):
+        pass
+
+    assert tracing.current_trace_id() == trace.trace_id
+    assert tracing.end_trace() is trace
+    assert tracing.current_trace() is None
+    assert [span.name for span in trace.spans] == [
+        'parse', 'capture', 'capture',
+    ]
+    assert set(trace.stage_totals()) == {'parse', 'capture'}
+    assert trace.to_dict()['client'] == '127.0.0.1'
+
+
+def test_traces_are_thread_local():
+    trace = tracing.start_trace()
+    seen = []
+    thread = threading.Thread(
+        target=lambda: seen.append(tracing.current_trace()),
+    )
+    thread.start()
+    thread.join()
+    tracing.end_trace()
+
+    assert seen == [None]
+    assert trace.duration is not None
+
+
+def _busy_worker(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler_collects_stacks():
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_worker, args=(stop,))
+    worker.start()
+
+    profiler = SamplingProfiler(interval=0.001)
+    assert profiler.start()
+    assert not profiler.start()
+    time.sleep(0.05)
+    assert profiler.stop()
+    stop.set()
+    worker.join()
+
+    assert profiler.sample_count > 0
+    assert '_busy_worker' in profiler.collapsed()
+
+    profiler.reset()
+    assert profiler.collapsed() == ''
@@ -0,0 +1,96 @@
+import random
+import sqlite3
+
+from src.capture import EXCHANGE, SQLiteCapture
+from src.db import init_db
+from src.request import Request
+from src.response import Response
+from src import traffic_stats
+from src.traffic_stats import SKETCH_RELATIVE_ACCURACY, LatencySketch
+
+
+def _db() -> sqlite3.Connection:
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    return db_conn
+
+
+def _exchange(host: str, code: int | None, body: bytes, duration: float) -> tuple:
+    request = Request.from_raw_request(
+        f'POST / HTTP/1.1\r\nHost: {host}\r\nContent-Length: 2\r\n\r\nhi'.encode(),
+    )
+    response = None
+    if code is not None:
+        response = Response.from_raw_response(
+            f'HTTP/1.1 {code} X\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body,
+        )
+        response.duration = duration
+    return request, response
+
+
+def test_sketch_quantiles_stay_within_the_relative_accuracy():
+    rng = random.Random(7)
+    values = sorted(rng.lognormvariate(-3, 1) for _ in range(5000))
+    first, second = LatencySketch(), LatencySketch()
+    for i, value in enumerate(values):
+        (first if i % 2 else second).add(value)
+    merged = LatencySketch.from_bytes(first.to_bytes())
+    merged.merge(second)
+
+    assert merged.count == len(values)
+    for q in (0.5, 0.9, 0.99):
+        exact = values[int(q * (len(values) - 1))]
+        assert abs(merged.quantile(q) - exact) <= exact * SKETCH_RELATIVE_ACCURACY * 1.01
+
+
+def test_capture_writer_keeps_aggregates_up_to_date():
+    db_conn = _db()
+    capture = SQLiteCapture(db_conn)
+    minute = 1_700_000_040
+    capture.write_batch([
+        (EXCHANGE, *_exchange('a.com', 200, b'x' * 10, 0.1), False, None, minute + 1),
+        (EXCHANGE, *_exchange('a.com', 200, b'x' * 30, 0.3), False, None, minute + 2),
+        (EXCHANGE, *_exchange('a.com', 503, b'', 0.2), False, None, minute + 70),
+        (EXCHANGE, *_exchange('b.com', None, b'', 0), False, None, minute + 3),
+    ])
+    capture.save_exchange(*_exchange('a.com', 404, b'no', 0.05))
+
+    a, b = traffic_stats.query(db_conn, minute, minute + 120)
+    assert (a['host'], a['requests'], a['request_bytes'], a['response_bytes']) == (
+        'a.com', 3, 6, 40,
+    )
+    assert a['status'] == {'2xx': 2, '5xx': 1}
+    assert abs(a['error_rate'] - 1 / 3) < 1e-9
+    assert abs(a['latency']['p50'] - 0.2) <= 0.2 * SKETCH_RELATIVE_ACCURACY
+    assert (b['host'], b['status'], b['latency']['count']) == ('b.com', {'none': 1}, 0)
+
+    series = traffic_stats.query(
+        db_conn, minute, minute + 120, host='a.com', by_minute=True,
+    )
+    assert [(row['minute'], row['requests']) for row in series] == [
+        (minute, 2), (minute + 60, 1),
+    ]
+
+
+def test_aggregates_are_rebuilt_from_raw_rows():
+    db_conn = _db()
+    capture = SQLiteCapture(db_conn)
+    for i in range(20):
+        capture.write_batch([
+            (EXCHANGE, *_exchange(f'h{i % 3}.com', 200 + i % 2 * 300, b'x' * i, i / 100),
+             False, None, 1_700_000_000 + i * 17),
+        ])
+    def rows():
+        return [
+            (*row[:6], sorted(LatencySketch.from_bytes(row[6]).buckets.items()))
+            for table, _ in traffic_stats.TABLES
+            for row in db_conn.execute(
+                f'SELECT * FROM {table} ORDER BY period, host, status_class',
+            )
+        ]
+
+    incremental = rows()
+    db_conn.execute('DELETE FROM traffic_minute')
+    db_conn.execute('DELETE FROM traffic_hour')
+    assert traffic_stats.rebuild(db_conn) == 20
+    assert rows() == incremental
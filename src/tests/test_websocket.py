@@ -0,0 +1,201 @@
+import pickle
+import sqlite3
+import struct
+import zlib
+
+import pytest
+
+from src.capture import EXCHANGE, MESSAGES, SQLiteCapture
+from src.db import init_db
+from src.request import Request
+from src.response import Response
+from src.websocket import (
+    BINARY,
+    CLIENT,
+    CONTINUATION,
+    PING,
+    SERVER,
+    TEXT,
+    FrameParser,
+    WebSocketError,
+    WebSocketStream,
+    is_upgrade,
+    parse_deflate_params,
+    unmask,
+)
+
+
+MASK = b'\x12\x34\x56\x78'
+
+
+def _frame(
+    opcode: int,
+    payload: bytes,
+    fin: bool = True,
+    mask: bytes | None = None,
+    rsv1: bool = False,
+) -> bytes:
+    first = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    mask_bit = 0x80 if mask else 0
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first, mask_bit | length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', first, mask_bit | 126, length)
+    else:
+        header = struct.pack('!BBQ', first, mask_bit | 127, length)
+    if mask:
+        return header + mask + unmask(payload, mask)
+    return header + payload
+
+
+def _deflate(compressor, payload: bytes) -> bytes:
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    assert data.endswith(b'\x00\x00\xff\xff')
+    return data[:-4]
+
+
+def _compressor():
+    return zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+
+def test_masked_frames_split_across_feeds():
+    data = _frame(TEXT, b'hello', mask=MASK) + _frame(BINARY, b'x' * 300, mask=MASK)
+    parser = FrameParser(CLIENT)
+
+    messages = []
+    for i in range(len(data)):
+        messages += parser.feed(data[i:i + 1])
+
+    assert [(m.opcode, m.payload) for m in messages] == [
+        (TEXT, b'hello'),
+        (BINARY, b'x' * 300),
+    ]
+
+
+def test_fragmented_message_with_interleaved_ping():
+    data = (
+        _frame(TEXT, b'hel', fin=False)
+        + _frame(PING, b'are you there')
+        + _frame(CONTINUATION, b'lo')
+    )
+    messages = FrameParser(SERVER).feed(data)
+    assert [(m.opcode, m.payload) for m in messages] == [
+        (PING, b'are you there'),
+        (TEXT, b'hello'),
+    ]
+
+
+def test_protocol_errors_are_raised():
+    with pytest.raises(WebSocketError):
+        FrameParser(SERVER).feed(_frame(CONTINUATION, b'x'))
+    with pytest.raises(WebSocketError):
+        FrameParser(SERVER).feed(_frame(PING, b'x', fin=False))
+    with pytest.raises(WebSocketError):
+        FrameParser(SERVER).feed(_frame(TEXT, b'x', rsv1=True))
+
+
+def test_permessage_deflate_with_context_takeover():
+    deflate = parse_deflate_params('permessage-deflate; client_max_window_bits')
+    compressor = _compressor()
+    data = b''.join(
+        _frame(TEXT, _deflate(compressor, b'repeated payload'), rsv1=True)
+        for _ in range(3)
+    )
+    messages = FrameParser(SERVER, deflate).feed(data)
+    assert [m.payload for m in messages] == [b'repeated payload'] * 3
+
+
+def test_permessage_deflate_without_context_takeover():
+    deflate = parse_deflate_params(
+        'permessage-deflate; client_no_context_takeover',
+    )
+    assert deflate == {CLIENT: True, SERVER: False}
+
+    data = b''.join(
+        _frame(TEXT, _deflate(_compressor(), b'payload %d' % i), mask=MASK, rsv1=True)
+        for i in range(3)
+    )
+    messages = FrameParser(CLIENT, deflate).feed(data)
+    assert [m.payload for m in messages] == [b'payload 0', b'payload 1', b'payload 2']
+
+
+def test_large_messages_are_truncated():
+    parser = FrameParser(SERVER, max_message_size=100)
+    (message,) = parser.feed(
+        _frame(BINARY, b'a' * 150, fin=False) + _frame(CONTINUATION, b'b' * 150),
+    )
+    assert message.payload == b'a' * 100
+    assert message.size == 300
+    assert message.truncated
+
+    deflate = parse_deflate_params('permessage-deflate')
+    parser = FrameParser(SERVER, deflate, max_message_size=100)
+    (message,) = parser.feed(
+        _frame(TEXT, _deflate(_compressor(), b'z' * 200_000), rsv1=True),
+    )
+    assert len(message.payload) == 100
+    assert message.size == 200_000
+
+
+def test_messages_survive_pickling():
+    (message,) = FrameParser(SERVER).feed(_frame(TEXT, b'hi'))
+    copy = pickle.loads(pickle.dumps(message))
+    assert (copy.direction, copy.opcode, copy.payload) == (SERVER, TEXT, b'hi')
+
+
+def test_is_upgrade():
+    assert is_upgrade({'Connection': 'keep-alive, Upgrade', 'Upgrade': 'websocket'})
+    assert not is_upgrade({'Connection': 'keep-alive', 'Upgrade': 'websocket'})
+    assert not is_upgrade({'Connection': 'upgrade'})
+
+
+def test_stream_messages_are_linked_to_the_upgrade_request():
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    capture = SQLiteCapture(db_conn)
+
+    request = Request.from_raw_request(
+        b'GET /chat HTTP/1.1\r\nHost: example.com\r\n'
+        b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n'
+    )
+    response = Response.from_raw_response(
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Connection: Upgrade\r\nUpgrade: websocket\r\n\r\n'
+    )
+    request_id = capture.save_exchange(request, response, False, 'stream')
+
+    stream = WebSocketStream(capture, 'stream')
+    stream.feed(CLIENT, _frame(TEXT, b'ping', mask=MASK))
+    stream.feed(SERVER, _frame(TEXT, b'pong'))
+    # an invalid frame stops parsing only for its direction
+    stream.feed(SERVER, _frame(CONTINUATION, b'?'))
+    stream.feed(CLIENT, _frame(TEXT, b'bye', mask=MASK))
+    stream.close()
+
+    assert db_conn.execute(
+        'SELECT request_id, direction, payload FROM websocket_message ORDER BY id',
+    ).fetchall() == [
+        (request_id, CLIENT, b'ping'),
+        (request_id, SERVER, b'pong'),
+        (request_id, CLIENT, b'bye'),
+    ]
+    assert capture.streams == {}
+
+
+def test_writer_resolves_stream_ids():
+    db_conn = sqlite3.connect(':memory:')
+    init_db(db_conn)
+    capture = SQLiteCapture(db_conn)
+    request = Request.from_raw_request(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+    (message,) = FrameParser(SERVER).feed(_frame(TEXT, b'hi'))
+
+    capture.write_batch([
+        (EXCHANGE, request, None, False, 'stream'),
+        (MESSAGES, 'stream', [message], True),
+    ])
+
+    assert db_conn.execute(
+        'SELECT request.path, websocket_message.payload FROM websocket_message '
+        'JOIN request ON request.id = websocket_message.request_id',
+    ).fetchall() == [('/', b'hi')]
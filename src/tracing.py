@@ -0,0 +1,129 @@
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+SLOW_TRACE_SECONDS = 5.0
+RECENT_TRACES = 256
+
+
+_local = threading.local()
+
+recent_traces = deque(maxlen=RECENT_TRACES)
+
+
+class Span:
+    __slots__ = ('name', 'start', 'duration')
+
+    def __init__(self, name: str, start: float, duration: float) -> None:
+        self.name = name
+        self.start = start
+        self.duration = duration
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            'name': self.name,
+            'offset': round(self.start - origin, 6),
+            'duration': round(self.duration, 6),
+        }
+
+
+class Trace:
+    def __init__(self, client_address=None, origin: float | None = None):
+        self.trace_id = os.urandom(8).hex()
+        self.client = client_address[0] if client_address else None
+        self.started_at = time.time()
+        self.origin = origin if origin is not None else time.perf_counter()
+        self.duration = None
+        self.spans: list[Span] = []
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans.append(Span(name, start, end - start))
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_span(name, start, time.perf_counter())
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.origin
+
+    def stage_totals(self) -> dict[str, float]:
+        totals = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0) + span.duration
+        return totals
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'client': self.client,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'spans': [span.to_dict(self.origin) for span in self.spans],
+        }
+
+    def save_to_db(self, db_conn: sqlite3.Connection, commit: bool = True):
+        db_conn.execute('''
+            INSERT OR REPLACE INTO trace (trace_id, client, started_at, duration, spans)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (
+            self.trace_id,
+            self.client,
+            self.started_at,
+            self.duration,
+            json.dumps([span.to_dict(self.origin) for span in self.spans]),
+        ))
+        if commit:
+            db_conn.commit()
+
+
+def start_trace(client_address=None, origin: float | None = None) -> Trace:
+    trace = Trace(client_address, origin)
+    _local.trace = trace
+    return trace
+
+
+def current_trace() -> Trace | None:
+    return getattr(_local, 'trace', None)
+
+
+def current_trace_id() -> str | None:
+    trace = current_trace()
+    return trace.trace_id if trace else None
+
+
+def end_trace() -> Trace | None:
+    trace = current_trace()
+    if trace is None:
+        return None
+    _local.trace = None
+    trace.finish()
+    recent_traces.append(trace)
+    if trace.duration >= SLOW_TRACE_SECONDS:
+        stages = ', '.join(
+            f'{name}={duration:.3f}s'
+            for name, duration in trace.stage_totals().items()
+        )
+        print(
+            f'slow connection {trace.trace_id} from {trace.client}: '
+            f'{trace.duration:.3f}s ({stages})'
+        )
+    return trace
+
+
+@contextmanager
+def span(name: str):
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name):
+        yield trace
@@ -0,0 +1,300 @@
+import math
+import sqlite3
+import struct
+import time
+
+from src.metrics import Histogram
+
+
+# latencies are kept to this relative accuracy; faster ones share the
+# lowest bucket
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MIN_VALUE = 1e-6
+
+MINUTE = 60
+HOUR = 3600
+# every exchange is counted in both; per-host totals read the hourly rows,
+# so their cost grows with the hours asked for, not with the traffic
+TABLES = (('traffic_minute', MINUTE), ('traffic_hour', HOUR))
+# status_class of exchanges that got no response
+NO_RESPONSE = 0
+
+REBUILD_BATCH_SIZE = 10000
+
+STATS_FLUSH_SECONDS = Histogram(
+    'proxy_stats_flush_seconds',
+    'Merging the traffic aggregates of written exchanges into the database.',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1),
+)
+
+
+class LatencySketch:
+    # logarithmic buckets, so any quantile is within the relative accuracy
+    # of the true value and sketches of different minutes and hosts merge
+    # by adding counts
+    _gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    _log_gamma = math.log(_gamma)
+
+    __slots__ = ('buckets', 'count')
+
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+
+    def add(self, seconds: float):
+        index = math.ceil(
+            math.log(max(seconds, SKETCH_MIN_VALUE)) / self._log_gamma,
+        )
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other: 'LatencySketch'):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def to_bytes(self) -> bytes:
+        flat = [value for bucket in self.buckets.items() for value in bucket]
+        return struct.pack(f'!{len(flat)}i', *flat)
+
+    @classmethod
+    def from_bytes(cls, data: bytes | None) -> 'LatencySketch':
+        # concatenated sketches decode into their merge
+        sketch = cls()
+        values = struct.unpack(f'!{len(data or b"") // 4}i', data or b'')
+        indices, counts = values[0::2], values[1::2]
+        sketch.buckets = dict(zip(indices, counts))
+        if len(sketch.buckets) < len(indices):
+            buckets = sketch.buckets = {}
+            for index, count in zip(indices, counts):
+                buckets[index] = buckets.get(index, 0) + count
+        sketch.count = sum(counts)
+        return sketch
+
+
+class _Aggregate:
+    __slots__ = ('requests', 'request_bytes', 'response_bytes', 'latency')
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = LatencySketch()
+
+
+def status_class(code: int | None) -> int:
+    return NO_RESPONSE if not code else code // 100
+
+
+class TrafficStats:
+    # aggregates of exchanges written in the current transaction, merged
+    # into the aggregate tables by flush() before it commits
+    def __init__(self) -> None:
+        self.pending: dict[tuple[int, str, int], _Aggregate] = {}
+
+    def add(
+        self,
+        host: str,
+        created_at: float,
+        code: int | None,
+        request_bytes: int,
+        response_bytes: int,
+        duration: float | None,
+    ):
+        key = (int(created_at // MINUTE) * MINUTE, host, status_class(code))
+        aggregate = self.pending.get(key)
+        if aggregate is None:
+            aggregate = self.pending[key] = _Aggregate()
+        aggregate.requests += 1
+        aggregate.request_bytes += request_bytes
+        aggregate.response_bytes += response_bytes
+        if duration is not None:
+            aggregate.latency.add(duration)
+
+    def add_exchange(self, request, response, created_at: float):
+        self.add(
+            request.host,
+            created_at,
+            response.code if response is not None else None,
+            len(request.body or b''),
+            len(response.body or b'') if response is not None else 0,
+            response.duration if response is not None else None,
+        )
+
+    def discard(self):
+        self.pending.clear()
+
+    def flush(self, db_conn: sqlite3.Connection):
+        if not self.pending:
+            return
+        with STATS_FLUSH_SECONDS.time():
+            hours: dict[tuple[int, str, int], _Aggregate] = {}
+            for (minute, host, status), aggregate in self.pending.items():
+                key = (minute // HOUR * HOUR, host, status)
+                hour = hours.get(key)
+                if hour is None:
+                    hour = hours[key] = _Aggregate()
+                hour.requests += aggregate.requests
+                hour.request_bytes += aggregate.request_bytes
+                hour.response_bytes += aggregate.response_bytes
+                hour.latency.merge(aggregate.latency)
+            _merge(db_conn, 'traffic_minute', self.pending)
+            _merge(db_conn, 'traffic_hour', hours)
+        self.pending.clear()
+
+
+def _merge(
+    db_conn: sqlite3.Connection,
+    table: str,
+    aggregates: dict[tuple[int, str, int], _Aggregate],
+):
+    for (period, host, status), aggregate in aggregates.items():
+        row = db_conn.execute(
+            f'SELECT latency FROM {table} '
+            'WHERE period = ? AND host = ? AND status_class = ?',
+            (period, host, status),
+        ).fetchone()
+        latency = aggregate.latency
+        if row is not None and row[0]:
+            latency = LatencySketch.from_bytes(row[0])
+            latency.merge(aggregate.latency)
+        db_conn.execute(f'''
+            INSERT INTO {table} (period, host, status_class, requests, request_bytes, response_bytes, latency)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (period, host, status_class) DO UPDATE SET
+                requests = requests + excluded.requests,
+                request_bytes = request_bytes + excluded.request_bytes,
+                response_bytes = response_bytes + excluded.response_bytes,
+                latency = excluded.latency
+        ''', (
+            period,
+            host,
+            status,
+            aggregate.requests,
+            aggregate.request_bytes,
+            aggregate.response_bytes,
+            latency.to_bytes(),
+        ))
+
+
+def rebuild(db_conn: sqlite3.Connection, since: float | None = None) -> int:
+    # recomputes the aggregates from the request and response rows, from
+    # the hour of since on or entirely. Rows already rotated into
+    # partitions are gone from the live database, so their hours are left
+    # as they are.
+    start = 0 if since is None else int(since // HOUR) * HOUR
+    # one transaction, so exchanges captured meanwhile are counted once;
+    # the capture writer waits until it commits
+    for table, _ in TABLES:
+        db_conn.execute(f'DELETE FROM {table} WHERE period >= ?', (start,))
+    rows = db_conn.execute('''
+        SELECT q.host, q.created_at, r.code,
+            length(CAST(q.body AS BLOB)), length(CAST(r.body AS BLOB)), r.duration
+        FROM request q LEFT JOIN response r ON r.request_id = q.id
+        WHERE q.created_at >= ?
+        ORDER BY q.id
+    ''', (start,))
+    stats = TrafficStats()
+    rebuilt = 0
+    for host, created_at, code, request_bytes, response_bytes, duration in rows:
+        stats.add(
+            host,
+            created_at,
+            code,
+            request_bytes or 0,
+            response_bytes or 0,
+            duration,
+        )
+        rebuilt += 1
+        if rebuilt % REBUILD_BATCH_SIZE == 0:
+            stats.flush(db_conn)
+    stats.flush(db_conn)
+    db_conn.commit()
+    return rebuilt
+
+
+def _summary(requests, request_bytes, response_bytes, classes, latency) -> dict:
+    errors = sum(
+        count for status, count in classes.items()
+        if status in ('4xx', '5xx', 'none')
+    )
+    return {
+        'requests': requests,
+        'request_bytes': request_bytes,
+        'response_bytes': response_bytes,
+        'status': classes,
+        'error_rate': errors / requests if requests else 0,
+        'latency': {
+            'count': latency.count,
+            'p50': latency.quantile(0.5),
+            'p90': latency.quantile(0.9),
+            'p99': latency.quantile(0.99),
+        },
+    }
+
+
+def _class_name(status: int) -> str:
+    return 'none' if status == NO_RESPONSE else f'{status}xx'
+
+
+def query(
+    db_conn: sqlite3.Connection,
+    since: float,
+    until: float | None = None,
+    host: str | None = None,
+    by_minute: bool = False,
+) -> list[dict]:
+    # per host over the hours from since up to until, busiest first, or
+    # per minute when by_minute is set
+    table, period = TABLES[0] if by_minute else TABLES[1]
+    until = time.time() if until is None else until
+    sql = (
+        'SELECT period, host, status_class, requests, request_bytes, '
+        f'response_bytes, latency FROM {table} '
+        'WHERE period >= ? AND period <= ?'
+    )
+    params = [int(since // period) * period, until]
+    if host is not None:
+        sql += ' AND host = ?'
+        params.append(host)
+
+    groups: dict = {}
+    latencies: dict = {}
+    for start, row_host, status, requests, request_bytes, response_bytes, latency \
+            in db_conn.execute(sql, params):
+        key = start if by_minute else row_host
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0, 0, {}]
+            latencies[key] = []
+        group[0] += requests
+        group[1] += request_bytes
+        group[2] += response_bytes
+        name = _class_name(status)
+        group[3][name] = group[3].get(name, 0) + requests
+        if latency:
+            latencies[key].append(latency)
+    for key, group in groups.items():
+        group.append(LatencySketch.from_bytes(b''.join(latencies[key])))
+
+    if by_minute:
+        return [
+            {'minute': minute, **_summary(*groups[minute])}
+            for minute in sorted(groups)
+        ]
+    return sorted(
+        ({'host': key, **_summary(*group)} for key, group in groups.items()),
+        key=lambda summary: summary['requests'],
+        reverse=True,
+    )
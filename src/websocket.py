@@ -0,0 +1,337 @@
+import os
+import struct
+import time
+import zlib
+
+from src.encoding import get_header
+from src.metrics import Counter
+import config
+
+
+CLIENT = 'client'
+SERVER = 'server'
+
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+# bounds the memory a single decompress call may allocate
+INFLATE_CHUNK = 64 * 1024
+
+FLUSH_MESSAGES = 64
+FLUSH_SECONDS = 1.0
+
+
+WEBSOCKET_MESSAGES = Counter(
+    'proxy_websocket_messages_total',
+    'WebSocket messages parsed from upgraded connections.',
+    labelnames=('direction',),
+)
+WEBSOCKET_ERRORS = Counter(
+    'proxy_websocket_errors_total',
+    'Upgraded connections whose frames could not be parsed.',
+)
+
+
+class WebSocketError(ValueError):
+    pass
+
+
+def _header_tokens(value: str | None) -> set[str]:
+    if not value:
+        return set()
+    return {token.strip().lower() for token in value.split(',')}
+
+
+def is_upgrade(headers: dict) -> bool:
+    return (
+        'upgrade' in _header_tokens(get_header(headers, 'Connection'))
+        and get_header(headers, 'Upgrade') is not None
+    )
+
+
+def is_websocket(headers: dict) -> bool:
+    return 'websocket' in _header_tokens(get_header(headers, 'Upgrade'))
+
+
+def parse_deflate_params(extensions: str | None) -> dict[str, bool] | None:
+    # the negotiated Sec-WebSocket-Extensions of the 101 response
+    for extension in (extensions or '').split(','):
+        name, *params = [part.strip().lower() for part in extension.split(';')]
+        if name == 'permessage-deflate':
+            names = {param.split('=', 1)[0].strip() for param in params}
+            return {
+                CLIENT: 'client_no_context_takeover' in names,
+                SERVER: 'server_no_context_takeover' in names,
+            }
+    return None
+
+
+def unmask(data: bytes, key: bytes, offset: int = 0) -> bytes:
+    if not data:
+        return data
+    shift = offset % 4
+    key = key[shift:] + key[:shift]
+    length = len(data)
+    mask = (key * (length // 4 + 1))[:length]
+    # one big-integer XOR is far cheaper than a per-byte loop
+    return (
+        int.from_bytes(data, 'little') ^ int.from_bytes(mask, 'little')
+    ).to_bytes(length, 'little')
+
+
+class Message:
+    __slots__ = ('direction', 'opcode', 'payload', 'size', 'truncated', 'created_at')
+
+    def __init__(
+        self,
+        direction: str,
+        opcode: int,
+        payload: bytes,
+        size: int,
+        truncated: bool,
+        created_at: float,
+    ) -> None:
+        self.direction = direction
+        self.opcode = opcode
+        self.payload = payload
+        self.size = size
+        self.truncated = truncated
+        self.created_at = created_at
+
+    def __getstate__(self):
+        return None, {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class _MessageBuffer:
+    # collects one message of a direction and keeps at most max_size bytes
+    # of it; compressed payloads are inflated as they arrive
+    __slots__ = ('opcode', 'inflater', 'chunks', 'stored', 'size', 'max_size')
+
+    def __init__(self, opcode: int, inflater, max_size: int) -> None:
+        self.opcode = opcode
+        self.inflater = inflater
+        self.chunks = []
+        self.stored = 0
+        self.size = 0
+        self.max_size = max_size
+
+    def _keep(self, data: bytes):
+        self.size += len(data)
+        room = self.max_size - self.stored
+        if room > 0 and data:
+            data = data[:room]
+            self.chunks.append(data)
+            self.stored += len(data)
+
+    def _inflate(self, data: bytes):
+        try:
+            out = self.inflater.decompress(data, INFLATE_CHUNK)
+            self._keep(out)
+            while self.inflater.unconsumed_tail:
+                out = self.inflater.decompress(
+                    self.inflater.unconsumed_tail,
+                    INFLATE_CHUNK,
+                )
+                self._keep(out)
+        except zlib.error as e:
+            raise WebSocketError(f'invalid compressed payload: {e}') from None
+
+    def add(self, data: bytes):
+        if self.inflater is None:
+            self._keep(data)
+        else:
+            self._inflate(data)
+
+    def finish(self, direction: str) -> Message:
+        if self.inflater is not None:
+            self._inflate(DEFLATE_TAIL)
+        return Message(
+            direction,
+            self.opcode,
+            b''.join(self.chunks),
+            self.size,
+            self.size > self.stored,
+            time.time(),
+        )
+
+
+class FrameParser:
+    # parses the frames of one direction incrementally; payloads are never
+    # held longer than the chunk they arrived in
+    def __init__(
+        self,
+        direction: str,
+        deflate: dict[str, bool] | None = None,
+        max_message_size: int = config.WEBSOCKET_MAX_MESSAGE_SIZE,
+    ) -> None:
+        self.direction = direction
+        self.max_message_size = max_message_size
+        self.deflate = deflate is not None
+        self.reset_context = bool(deflate and deflate[direction])
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS) if self.deflate else None
+
+        self._header = bytearray()
+        self._remaining = None
+        self._offset = 0
+        self._fin = False
+        self._opcode = 0
+        self._mask = None
+        self._message: _MessageBuffer | None = None
+        self._control: _MessageBuffer | None = None
+        self._messages: list[Message] = []
+
+    def _header_length(self) -> int | None:
+        if len(self._header) < 2:
+            return None
+        length = self._header[1] & 0x7F
+        size = 2 + (2 if length == 126 else 8 if length == 127 else 0)
+        if self._header[1] & 0x80:
+            size += 4
+        return size
+
+    def _start_frame(self):
+        header = bytes(self._header)
+        self._header.clear()
+        first, second = header[0], header[1]
+        self._fin = bool(first & 0x80)
+        rsv1 = bool(first & 0x40)
+        self._opcode = first & 0x0F
+
+        length = second & 0x7F
+        position = 2
+        if length == 126:
+            (length,) = struct.unpack_from('!H', header, position)
+            position += 2
+        elif length == 127:
+            (length,) = struct.unpack_from('!Q', header, position)
+            position += 8
+        self._mask = header[position:position + 4] if second & 0x80 else None
+        self._remaining = length
+        self._offset = 0
+
+        if self._opcode >= CLOSE:
+            if not self._fin or length > 125:
+                raise WebSocketError('invalid control frame')
+            self._control = _MessageBuffer(self._opcode, None, self.max_message_size)
+        elif self._opcode == CONTINUATION:
+            if self._message is None:
+                raise WebSocketError('continuation without a message')
+        else:
+            if self._message is not None:
+                raise WebSocketError('new message before the previous one ended')
+            if rsv1 and not self.deflate:
+                raise WebSocketError('compressed frame without permessage-deflate')
+            self._message = _MessageBuffer(
+                self._opcode,
+                self.inflater if rsv1 else None,
+                self.max_message_size,
+            )
+
+    def _payload(self, data: bytes):
+        if self._mask is not None:
+            data = unmask(data, self._mask, self._offset)
+        self._offset += len(data)
+        target = self._control if self._opcode >= CLOSE else self._message
+        target.add(data)
+
+    def _end_frame(self):
+        self._remaining = None
+        if self._opcode >= CLOSE:
+            self._messages.append(self._control.finish(self.direction))
+            self._control = None
+        elif self._fin:
+            message = self._message
+            self._message = None
+            self._messages.append(message.finish(self.direction))
+            if message.inflater is not None and self.reset_context:
+                self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def feed(self, data: bytes) -> list[Message]:
+        position = 0
+        end = len(data)
+        while position < end:
+            if self._remaining is None:
+                needed = self._header_length()
+                if needed is None:
+                    needed = 2
+                take = min(needed - len(self._header), end - position)
+                self._header += data[position:position + take]
+                position += take
+                needed = self._header_length()
+                if needed is None or len(self._header) < needed:
+                    continue
+                self._start_frame()
+                if self._remaining == 0:
+                    self._end_frame()
+                continue
+
+            take = min(self._remaining, end - position)
+            self._payload(data[position:position + take])
+            position += take
+            self._remaining -= take
+            if self._remaining == 0:
+                self._end_frame()
+
+        messages = self._messages
+        self._messages = []
+        return messages
+
+
+class WebSocketStream:
+    # parses both directions of an upgraded connection and hands the
+    # messages to the capture in batches
+    def __init__(
+        self,
+        capture,
+        stream_id: str,
+        extensions: str | None = None,
+        max_message_size: int = config.WEBSOCKET_MAX_MESSAGE_SIZE,
+    ) -> None:
+        self.capture = capture
+        self.stream_id = stream_id
+        deflate = parse_deflate_params(extensions)
+        self.parsers = {
+            CLIENT: FrameParser(CLIENT, deflate, max_message_size),
+            SERVER: FrameParser(SERVER, deflate, max_message_size),
+        }
+        self.pending: list[Message] = []
+        self.flushed_at = time.monotonic()
+
+    def feed(self, direction: str, data: bytes):
+        parser = self.parsers.get(direction)
+        if parser is None:
+            return
+        try:
+            messages = parser.feed(data)
+        except (WebSocketError, struct.error) as e:
+            # the bytes are still relayed, only parsing of this direction stops
+            WEBSOCKET_ERRORS.inc()
+            print(f'stopped parsing websocket {direction} frames: {e}')
+            del self.parsers[direction]
+            return
+        if messages:
+            WEBSOCKET_MESSAGES.labels(direction).inc(len(messages))
+            self.pending.extend(messages)
+        if len(self.pending) >= FLUSH_MESSAGES or (
+            self.pending
+            and time.monotonic() - self.flushed_at >= FLUSH_SECONDS
+        ):
+            self.flush()
+
+    def flush(self, final: bool = False):
+        if self.pending or final:
+            self.capture.save_messages(self.stream_id, self.pending, final)
+            self.pending = []
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush(final=True)
+
+
+def new_stream_id() -> str:
+    return os.urandom(8).hex()